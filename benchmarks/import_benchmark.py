@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+'''Startup time: how long it takes to import jiant's entry points.
+
+Each module is imported in a fresh Python process, several times, and the
+median wall-clock time is reported. With Python 3.7+, the slowest imports
+(by cumulative time, from -X importtime) are also listed, which shows what
+to defer next (see src/lazy.py).
+
+Usage, from the repository root:
+    python -m benchmarks.import_benchmark
+
+Exits with status 1 if importing main.py takes longer than --budget seconds
+(by default, MAIN_IMPORT_BUDGET; tests/test_import_benchmark.py checks the same).
+run_benchmarks.py also records these timings in its report.
+'''
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+import logging as log
+log.basicConfig(format='%(asctime)s: %(message)s',
+                datefmt='%m/%d %I:%M:%S %p', level=log.INFO)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry points, in roughly increasing order of what they pull in.
+MODULES = ['src.config', 'src.tasks', 'src.preprocess', 'src.models', 'src.trainer', 'main']
+# Seconds that importing main may take. Raise it only with a reason; first see what
+# the slowest imports are, and whether they can be deferred.
+MAIN_IMPORT_BUDGET = 10.0
+
+_IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def _import_once(module, importtime=False):
+    ''' Import module in a new interpreter. Returns (seconds, importtime stderr). '''
+    code = ("import time; start = time.time(); import {}; "
+            "print(time.time() - start)").format(module)
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    c = subprocess.run(cmd, cwd=REPO_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if c.returncode != 0:
+        raise RuntimeError("Importing %s failed:\n%s" % (module, c.stderr.decode()[-2000:]))
+    return float(c.stdout.decode().strip().splitlines()[-1]), c.stderr.decode()
+
+
+def slowest_imports(importtime_output, module, n=10):
+    ''' The n imports under module with the most cumulative time, from -X importtime
+    output, as (name, seconds). Imports nested in one already listed are skipped. '''
+    entries = []  # (name, cumulative seconds, depth)
+    for line in importtime_output.splitlines():
+        m = _IMPORTTIME_LINE.match(line)
+        if m:
+            entries.append((m.group(4), int(m.group(2)) / 1e6, len(m.group(3)) // 2))
+    # Each import is printed after the ones it triggers, indented one level less.
+    parents = [None] * len(entries)
+    stack = []
+    for i in reversed(range(len(entries))):
+        depth = entries[i][2]
+        while stack and entries[stack[-1]][2] >= depth:
+            stack.pop()
+        parents[i] = stack[-1] if stack else None
+        stack.append(i)
+
+    def ancestors(i):
+        while parents[i] is not None:
+            i = parents[i]
+            yield i
+
+    # The module itself and the packages containing it include everything else.
+    skip = {i for i, entry in enumerate(entries) if module == entry[0] or
+            module.startswith(entry[0] + '.')}
+    slowest = []
+    for i in sorted(range(len(entries)), key=lambda i: -entries[i][1]):
+        if i in skip or any(j in slowest for j in ancestors(i)):
+            continue
+        slowest.append(i)
+        if len(slowest) == n:
+            break
+    return [(entries[i][0], entries[i][1]) for i in slowest]
+
+
+def time_imports(modules=MODULES, n_runs=3):
+    ''' Median import time of each module, in a fresh process each run. Returns a
+    list of records, as for the stages in run_benchmarks.py. '''
+    records = []
+    for module in modules:
+        times = [_import_once(module)[0] for _ in range(n_runs)]
+        record = {'stage': 'import', 'task': module, 'seconds': statistics.median(times),
+                  'items': None, 'runs': times}
+        if sys.version_info >= (3, 7):
+            record['slowest_imports'] = slowest_imports(
+                _import_once(module, importtime=True)[1], module)
+        log.info("import %-16s %.3fs (median of %d)", module, record['seconds'], n_runs)
+        records.append(record)
+    return records
+
+
+def main(cl_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, default=",".join(MODULES),
+                        help="Comma-separated modules to import.")
+    parser.add_argument('--n_runs', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=MAIN_IMPORT_BUDGET,
+                        help="Fail if importing main takes longer than this (seconds). "
+                        "0 to disable.")
+    parser.add_argument('--report', type=str, default="",
+                        help="If set, write the timings to this JSON file.")
+    args = parser.parse_args(cl_args)
+
+    records = time_imports(args.modules.split(","), args.n_runs)
+    for record in records:
+        for name, seconds in record.get('slowest_imports', []):
+            log.info("\t%s: %-40s %.3fs", record['task'], name, seconds)
+    if args.report:
+        with open(args.report, 'w') as fd:
+            json.dump(records, fd, indent=2)
+
+    main_times = [r['seconds'] for r in records if r['task'] == 'main']
+    if args.budget and main_times and main_times[0] > args.budget:
+        log.error("Importing main took %.3fs, over the budget of %.3fs",
+                  main_times[0], args.budget)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+'''End-to-end benchmark of the preprocessing and training pipeline.
+
+Generates synthetic data (see synthetic_data.py), then times each stage of
+the pipeline separately on CPU with a small random-weight encoder (see
+benchmark.conf), and writes a JSON report.
+
+Usage, from the repository root:
+    python -m benchmarks.run_benchmarks --output_dir /tmp/jiant-bench \
+        --report /tmp/jiant-bench/report.json
+
+To compare against a report from another commit:
+    python -m benchmarks.run_benchmarks --output_dir /tmp/jiant-bench \
+        --report new.json --baseline old.json
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import itertools
+import contextlib
+import subprocess
+
+import logging as log
+log.basicConfig(format='%(asctime)s: %(message)s',
+                datefmt='%m/%d %I:%M:%S %p', level=log.INFO)
+
+import torch
+from allennlp.data import Vocabulary
+from allennlp.data.iterators import BucketIterator
+from allennlp.data.token_indexers import TokenCharactersIndexer
+
+from src import config
+from src import evaluate
+from src import preprocess
+from src import quantization
+from src import serialize
+from src.models import build_model
+from src.utils import maybe_make_dir
+
+from . import import_benchmark
+from . import synthetic_data
+
+BENCHMARK_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "benchmark.conf")
+
+
+class StageTimer(object):
+    ''' Records wall-clock time for named pipeline stages.
+
+    Usage:
+        with timer.stage("index", task="sst") as record:
+            ...
+            record['items'] = n_examples
+    '''
+
+    def __init__(self):
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **tags):
+        record = {'stage': name}
+        record.update(tags)
+        record['items'] = None
+        start = time.time()
+        yield record
+        record['seconds'] = time.time() - start
+        if record['items'] and record['seconds'] > 0:
+            record['items_per_sec'] = record['items'] / record['seconds']
+        log.info("Stage %s %s: %.3fs", name, str(tags) if tags else "",
+                 record['seconds'])
+        self.records.append(record)
+
+
+def _git_sha():
+    try:
+        c = subprocess.run(["git", "rev-parse", "HEAD"], timeout=10,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return c.stdout.decode().strip()
+    except Exception:
+        return None
+
+
+def _stage_key(record):
+    return (record['stage'], record.get('task'), record.get('split'))
+
+
+def compare_reports(report, baseline):
+    ''' Log the ratio of stage times against a baseline report. '''
+    baseline_times = {_stage_key(r): r['seconds'] for r in baseline['stages']}
+    log.info("Comparison to baseline %s (ratio > 1 is slower):",
+             baseline.get('git_sha'))
+    for record in report['stages']:
+        key = _stage_key(record)
+        if key not in baseline_times or baseline_times[key] <= 0:
+            continue
+        log.info("\t%-50s %8.3fs  %6.2fx", " / ".join(k for k in key if k),
+                 record['seconds'], record['seconds'] / baseline_times[key])
+
+
+def run(args):
+    task_names = preprocess.parse_task_list_arg(args.tasks)
+    data_dir = os.path.join(args.output_dir, "data")
+    project_dir = os.path.join(args.output_dir, "exp")
+    timer = StageTimer()
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+
+    # Startup: import times of the entry points, each in a fresh process.
+    timer.records.extend(import_benchmark.time_imports())
+
+    with timer.stage("generate_data"):
+        synthetic_data.generate(data_dir, task_names, args.n_train, args.n_val,
+                                args.n_test, vocab_size=args.vocab_size,
+                                max_len=args.max_len, seed=args.seed)
+
+    # defaults.conf references these; they're overridden below.
+    for env_var in ["NFS_PROJECT_PREFIX", "JIANT_PROJECT_PREFIX", "JIANT_DATA_DIR",
+                    "WORD_EMBS_FILE"]:
+        os.environ.setdefault(env_var, args.output_dir)
+    overrides = ('project_dir = "{}", data_dir = "{}", train_tasks = "{}", '
+                 'eval_tasks = "{}", batch_size = {:d}, max_seq_len = {:d}').format(
+                     project_dir, data_dir, ",".join(task_names),
+                     ",".join(task_names), args.batch_size, args.max_len + 2)
+    params = config.params_from_file(BENCHMARK_CONF, overrides)
+    maybe_make_dir(params.exp_dir)
+    maybe_make_dir(params.run_dir)
+
+    # 1) Load and tokenize raw data.
+    with timer.stage("get_tasks") as record:
+        tasks, _, _ = preprocess.get_tasks(
+            task_names, task_names, params.max_seq_len, path=params.data_dir,
+            scratch_path=params.exp_dir, load_pkl=False,
+            nli_prob_probe_path=params['nli-prob'].probe_path,
+            max_targ_v_size=params.max_targ_word_v_size)
+        record['items'] = sum(sum(t.example_counts.values()) for t in tasks)
+    for task in tasks:
+        setattr(task, "_classifier_name", task.name)
+
+    # 2) Build vocabulary.
+    with timer.stage("get_words"):
+        word2freq, char2freq = preprocess.get_words(tasks)
+    with timer.stage("get_vocab") as record:
+        vocab = preprocess.get_vocab(word2freq, char2freq,
+                                     {'word': params.max_word_v_size,
+                                      'char': params.max_char_v_size})
+        for task in tasks:
+            preprocess.add_task_label_vocab(vocab, task)
+        record['items'] = len(word2freq)
+    vocab_path = os.path.join(params.exp_dir, "vocab")
+    vocab.save_to_files(vocab_path)
+    vocab = Vocabulary.from_files(vocab_path)
+    params.max_word_v_size = vocab.get_vocab_size('tokens')
+    params.max_char_v_size = vocab.get_vocab_size('chars')
+
+    # 3) Index and serialize.
+    indexers = {"chars": TokenCharactersIndexer("chars")}
+    preproc_dir = os.path.join(params.exp_dir, "preproc")
+    maybe_make_dir(preproc_dir)
+    for task in tasks:
+        for split in preprocess.ALL_SPLITS:
+            record_file = preprocess._get_serialized_record_path(task.name, split,
+                                                                 preproc_dir)
+            with timer.stage("index_split", task=task.name, split=split) as record:
+                preprocess._index_split(task, split, indexers, vocab, record_file)
+                record['items'] = task.example_counts[split]
+
+    # 4) Read serialized records back.
+    for task in tasks:
+        for split in preprocess.ALL_SPLITS:
+            record_file = preprocess._get_serialized_record_path(task.name, split,
+                                                                 preproc_dir)
+            with timer.stage("read_records", task=task.name, split=split) as record:
+                record['items'] = sum(1 for _ in serialize.read_records(record_file))
+        task.train_data = preprocess._get_instance_generator(task.name, "train",
+                                                             preproc_dir)
+        task.val_data = preprocess._get_instance_generator(task.name, "val",
+                                                           preproc_dir)
+        task.test_data = preprocess._get_instance_generator(task.name, "test",
+                                                            preproc_dir)
+
+    # 5) Batch iteration, as in SamplingMultiTaskTrainer._setup_training.
+    for task in tasks:
+        instance = next(iter(task.train_data))
+        sorting_keys = [(field, pad_field)
+                        for field, pad_dict in instance.get_padding_lengths().items()
+                        for pad_field in pad_dict]
+        iterator = BucketIterator(sorting_keys=sorting_keys,
+                                  max_instances_in_memory=10000,
+                                  batch_size=args.batch_size,
+                                  biggest_batch_first=True)
+        with timer.stage("iterate_batches", task=task.name, split="train") as record:
+            record['items'] = sum(1 for _ in iterator(task.train_data, num_epochs=1,
+                                                      cuda_device=-1))
+
+    # 6) Forward and backward passes.
+    with timer.stage("build_model"):
+        model = build_model(params, vocab, None, tasks)
+    model.train()
+    for task in tasks:
+        instance = next(iter(task.train_data))
+        sorting_keys = [(field, pad_field)
+                        for field, pad_dict in instance.get_padding_lengths().items()
+                        for pad_field in pad_dict]
+        iterator = BucketIterator(sorting_keys=sorting_keys,
+                                  batch_size=args.batch_size)
+        batches = list(itertools.islice(
+            iterator(task.train_data, num_epochs=None, cuda_device=-1),
+            args.n_steps))
+        with timer.stage("forward_backward", task=task.name, split="train") as record:
+            n_exs = 0
+            for batch in batches:
+                model.zero_grad()
+                out = model.forward(task, batch)
+                out['loss'].backward()
+                n_exs += out['n_exs']
+            record['items'] = float(n_exs)
+        task.get_metrics(reset=True)
+
+    # 7) Evaluation and prediction writing.
+    with timer.stage("evaluate", split="val") as record:
+        val_results, val_preds = evaluate.evaluate(model, tasks, args.batch_size,
+                                                   -1, "val")
+        record['items'] = sum(task.example_counts['val'] for task in tasks)
+    with timer.stage("write_preds", split="val"):
+        evaluate.write_preds(tasks, val_preds, params.run_dir, 'val')
+
+    # 8) Evaluation with a dynamically quantized (int8) model, as with eval_quantize.
+    int8_metrics = None
+    qmodel = quantization.quantize_model(model)
+    if qmodel is not None:
+        with timer.stage("evaluate_int8", split="val") as record:
+            q_val_results, _ = evaluate.evaluate(qmodel, tasks, args.batch_size, -1, "val")
+            record['items'] = sum(task.example_counts['val'] for task in tasks)
+        int8_metrics = {task.val_metric: {'fp32': val_results[task.val_metric],
+                                          'int8': q_val_results[task.val_metric]}
+                        for task in tasks}
+
+    report = {
+        'git_sha': _git_sha(),
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'stages': timer.records,
+        'int8_metrics': int8_metrics,
+        'total_seconds': sum(r['seconds'] for r in timer.records),
+    }
+    return report
+
+
+def main(cl_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help="Directory for synthetic data and experiment files.")
+    parser.add_argument('--report', type=str, default="",
+                        help="Output file (JSON). Defaults to "
+                             "<output_dir>/benchmark_report.json")
+    parser.add_argument('--baseline', type=str, default="",
+                        help="Report from a previous run to compare against.")
+    parser.add_argument('--tasks', type=str,
+                        default="sst,rte,edges-spr2,wiki103",
+                        help="Tasks to benchmark. Must have synthetic data "
+                             "generators: %s" % ", ".join(synthetic_data.GENERATORS))
+    parser.add_argument('--n_train', type=int, default=2000)
+    parser.add_argument('--n_val', type=int, default=500)
+    parser.add_argument('--n_test', type=int, default=500)
+    parser.add_argument('--vocab_size', type=int, default=2000)
+    parser.add_argument('--max_len', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_steps', type=int, default=20,
+                        help="Number of forward/backward steps per task.")
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help="Torch CPU threads. Fixed for reproducibility.")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(cl_args)
+
+    report = run(args)
+    report_path = args.report or os.path.join(args.output_dir,
+                                              "benchmark_report.json")
+    with open(report_path, 'w') as fd:
+        json.dump(report, fd, indent=2)
+    log.info("Wrote benchmark report to %s (total %.2fs)", report_path,
+             report['total_seconds'])
+
+    if args.baseline:
+        with open(args.baseline) as fd:
+            compare_reports(report, json.load(fd))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    sys.exit(0)
@@ -0,0 +1,141 @@
+'''Generate synthetic datasets in the on-disk formats expected by the task
+loaders in src/tasks.py, so the pipeline can be benchmarked without
+downloading any data.
+
+Layout, relative to the output data_dir:
+    SST-2/{train,dev,test}.tsv          -> 'sst' (single sentence)
+    RTE/{train,dev,test}.tsv            -> 'rte' (sentence pair)
+    edges/spr2/*.edges.json.retokenized.MosesTokenizer, labels.txt
+                                        -> 'edges-spr2' (edge probing)
+    WikiText103/{train,valid,test}.sentences.txt
+                                        -> 'wiki103' (language modeling)
+'''
+import os
+import json
+import random
+import logging as log
+
+EDGE_LABELS = ["awareness", "change_of_location", "change_of_state",
+               "existed_after", "existed_before", "existed_during",
+               "instigation", "volition"]
+
+# Task name -> function(data_dir, split sizes, rng, vocab, max_len)
+GENERATORS = {}
+
+
+def _register(task_name):
+    def _wrap(fn):
+        GENERATORS[task_name] = fn
+        return fn
+    return _wrap
+
+
+def make_vocab(vocab_size):
+    ''' Synthetic word list. Lowercase alphabetic, so that Moses tokenization
+    leaves words unchanged, and at least as long as the widest char CNN
+    filter. '''
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = []
+    for i in range(vocab_size):
+        word, n = "", i
+        while True:
+            word += letters[n % 26]
+            n //= 26
+            if n == 0:
+                break
+        words.append(word.ljust(4, "q") + "xx")
+    return words
+
+
+def _sentence(rng, vocab, max_len, min_len=3):
+    return [rng.choice(vocab) for _ in range(rng.randint(min_len, max_len))]
+
+
+def _write_tsv(path, header, rows):
+    with open(path, 'w') as fd:
+        fd.write("\t".join(header) + "\n")
+        for row in rows:
+            fd.write("\t".join(str(c) for c in row) + "\n")
+
+
+@_register('sst')
+def make_sst(data_dir, sizes, rng, vocab, max_len):
+    task_dir = os.path.join(data_dir, "SST-2")
+    os.makedirs(task_dir, exist_ok=True)
+    for split, fname in [('train', 'train.tsv'), ('val', 'dev.tsv')]:
+        rows = [(" ".join(_sentence(rng, vocab, max_len)), rng.randint(0, 1))
+                for _ in range(sizes[split])]
+        _write_tsv(os.path.join(task_dir, fname), ["sentence", "label"], rows)
+    rows = [(i, " ".join(_sentence(rng, vocab, max_len)))
+            for i in range(sizes['test'])]
+    _write_tsv(os.path.join(task_dir, "test.tsv"), ["index", "sentence"], rows)
+
+
+@_register('rte')
+def make_rte(data_dir, sizes, rng, vocab, max_len):
+    task_dir = os.path.join(data_dir, "RTE")
+    os.makedirs(task_dir, exist_ok=True)
+    header = ["index", "sentence1", "sentence2", "label"]
+    labels = ["entailment", "not_entailment"]
+    for split, fname in [('train', 'train.tsv'), ('val', 'dev.tsv')]:
+        rows = [(i, " ".join(_sentence(rng, vocab, max_len)),
+                 " ".join(_sentence(rng, vocab, max_len)), rng.choice(labels))
+                for i in range(sizes[split])]
+        _write_tsv(os.path.join(task_dir, fname), header, rows)
+    rows = [(i, " ".join(_sentence(rng, vocab, max_len)),
+             " ".join(_sentence(rng, vocab, max_len)))
+            for i in range(sizes['test'])]
+    _write_tsv(os.path.join(task_dir, "test.tsv"), header[:3], rows)
+
+
+def _random_span(rng, n_tokens):
+    start = rng.randrange(n_tokens)
+    return [start, rng.randint(start + 1, min(n_tokens, start + 3))]
+
+
+@_register('edges-spr2')
+def make_edges_spr2(data_dir, sizes, rng, vocab, max_len):
+    task_dir = os.path.join(data_dir, "edges", "spr2")
+    os.makedirs(task_dir, exist_ok=True)
+    with open(os.path.join(task_dir, "labels.txt"), 'w') as fd:
+        fd.write("\n".join(EDGE_LABELS) + "\n")
+    suffix = ".retokenized.MosesTokenizer"
+    for split, fname in [('train', 'train.edges.json'), ('val', 'dev.edges.json'),
+                         ('test', 'test.edges.json')]:
+        with open(os.path.join(task_dir, fname + suffix), 'w') as fd:
+            for _ in range(sizes[split]):
+                tokens = _sentence(rng, vocab, max_len)
+                targets = []
+                for _ in range(rng.randint(1, 4)):
+                    labels = rng.sample(EDGE_LABELS, rng.randint(1, 3))
+                    targets.append({'span1': _random_span(rng, len(tokens)),
+                                    'span2': _random_span(rng, len(tokens)),
+                                    'label': labels})
+                fd.write(json.dumps({'text': " ".join(tokens),
+                                     'targets': targets}))
+                fd.write("\n")
+
+
+@_register('wiki103')
+def make_wiki103(data_dir, sizes, rng, vocab, max_len):
+    task_dir = os.path.join(data_dir, "WikiText103")
+    os.makedirs(task_dir, exist_ok=True)
+    for split, fname in [('train', 'train.sentences.txt'),
+                         ('val', 'valid.sentences.txt'),
+                         ('test', 'test.sentences.txt')]:
+        with open(os.path.join(task_dir, fname), 'w') as fd:
+            for _ in range(sizes[split]):
+                fd.write(" ".join(_sentence(rng, vocab, max_len)) + "\n")
+
+
+def generate(data_dir, task_names, n_train, n_val, n_test,
+             vocab_size=2000, max_len=20, seed=42):
+    ''' Write synthetic data for task_names under data_dir. '''
+    rng = random.Random(seed)
+    vocab = make_vocab(vocab_size)
+    sizes = {'train': n_train, 'val': n_val, 'test': n_test}
+    for task_name in task_names:
+        assert task_name in GENERATORS, \
+            "No synthetic data generator for task '%s'" % task_name
+        log.info("Generating synthetic data for %s: %s", task_name, str(sizes))
+        GENERATORS[task_name](data_dir, sizes, rng, vocab, max_len)
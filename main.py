@@ -19,8 +19,11 @@ log.basicConfig(format='%(asctime)s: %(message)s',
 
 import torch
 
+from src import checkpoint
 from src import config
+from src import distributed
 from src import gcp
+from src import quantization
 
 from src.utils import assert_for_log, maybe_make_dir, load_model_state
 from src.preprocess import build_tasks
@@ -28,6 +31,33 @@ from src.models import build_model
 from src.trainer import build_trainer, build_trainer_params
 from src.tasks import NLITypeProbingTask
 from src import evaluate
+from src.parallel_eval import train_eval_tasks_in_parallel
+
+
+def get_quantized_eval_model(args, model, tasks, val_results, val_seconds):
+    ''' Quantize model for test predictions (see src/quantization.py), if the quantized
+    model's validation metrics are within eval_quantize_tolerance of val_results, which
+    took val_seconds to compute. Otherwise, return model. '''
+    assert_for_log(args.cuda < 0, "eval_quantize is only supported on CPU (cuda = -1).")
+    qmodel = quantization.quantize_model(model)
+    if qmodel is None:
+        return model
+    start_time = time.time()
+    q_val_results, _ = evaluate.evaluate(qmodel, tasks, args.batch_size, args.cuda, "val")
+    q_val_seconds = time.time() - start_time
+    n_examples = sum(task.n_val_examples for task in tasks)
+    log.info("Validation throughput: fp32 %.1f examples/sec, int8 %.1f examples/sec (%.2fx)",
+             n_examples / val_seconds, n_examples / q_val_seconds, val_seconds / q_val_seconds)
+    mismatches = quantization.compare_metrics(val_results, q_val_results, tasks,
+                                              args.eval_quantize_tolerance)
+    if mismatches:
+        log.warning("Quantized model differs from fp32 by more than %.4f on %s; "
+                    "using the fp32 model for test predictions.", args.eval_quantize_tolerance,
+                    ", ".join("%s (%.4f vs. %.4f)" % m for m in mismatches))
+        return model
+    log.info("Quantized model matches fp32 within %.4f; using it for test predictions.",
+             args.eval_quantize_tolerance)
+    return qmodel
 
 
 def handle_arguments(cl_arguments):
@@ -49,6 +79,9 @@ def handle_arguments(cl_arguments):
                         "subprocess, serving on the port given by "
                         "--tensorboard_port.")
     parser.add_argument('--tensorboard_port', type=int, default=6006)
+    parser.add_argument('--local_rank', type=int, default=0,
+                        help="Set by torch.distributed.launch. Unused; with distributed = 1, "
+                        "the rank is read from the environment.")
 
     return parser.parse_args(cl_arguments)
 
@@ -98,7 +131,14 @@ def main(cl_arguments):
     maybe_make_dir(args.project_dir)  # e.g. /nfs/jsalt/exp/$HOSTNAME
     maybe_make_dir(args.exp_dir)      # e.g. <project_dir>/jiant-demo
     maybe_make_dir(args.run_dir)      # e.g. <project_dir>/jiant-demo/sst
-    log.getLogger().addHandler(log.FileHandler(args.local_log_path))
+    if args.distributed:
+        assert_for_log(args.cuda < 0, "Distributed training is only supported on CPU (cuda = -1).")
+        distributed.init(args.distributed_backend)
+    if distributed.is_main_process():
+        log.getLogger().addHandler(log.FileHandler(args.local_log_path))
+    else:
+        log.getLogger().addHandler(log.FileHandler(
+            "%s.rank%d" % (args.local_log_path, distributed.get_rank())))
 
     if cl_args.remote_log:
         gcp.configure_remote_logging(args.remote_log_name)
@@ -116,11 +156,13 @@ def main(cl_arguments):
 
     log.info("Parsed args: \n%s", args)
 
-    config_file = os.path.join(args.run_dir, "params.conf")
-    config.write_params(args, config_file)
-    log.info("Saved config to %s", config_file)
+    if distributed.is_main_process():
+        config_file = os.path.join(args.run_dir, "params.conf")
+        config.write_params(args, config_file)
+        log.info("Saved config to %s", config_file)
 
     seed = random.randint(1, 10000) if args.random_seed < 0 else args.random_seed
+    seed = distributed.broadcast_int(seed)  # all ranks must use the same seed
     random.seed(seed)
     torch.manual_seed(seed)
     log.info("Using random seed %d", seed)
@@ -140,7 +182,12 @@ def main(cl_arguments):
     # Prepare data #
     log.info("Loading tasks...")
     start_time = time.time()
+    # In distributed training, rank 0 does any preprocessing before the other ranks load it.
+    if not distributed.is_main_process():
+        distributed.barrier()
     train_tasks, eval_tasks, vocab, word_embs = build_tasks(args)
+    if distributed.is_main_process():
+        distributed.barrier()
     if any([t.val_metric_decreases for t in train_tasks]) and any(
             [not t.val_metric_decreases for t in train_tasks]):
         log.warn("\tMixing training tasks with increasing and decreasing val metrics!")
@@ -195,7 +242,7 @@ def main(cl_arguments):
         steps_log.append("Evaluating model on tasks: %s" % args.eval_tasks)
 
     # Start Tensorboard if requested
-    if cl_args.tensorboard:
+    if cl_args.tensorboard and distributed.is_main_process():
         tb_logdir = os.path.join(args.run_dir, "tensorboard")
         _run_background_tensorboard(tb_logdir, cl_args.tensorboard_port)
 
@@ -243,6 +290,11 @@ def main(cl_arguments):
         eval_best = glob.glob(os.path.join(args.run_dir,
                                            "model_state_eval_best.th"))
         if len(eval_best) > 0:
+            # eval_best is updated in place, so check it wasn't interrupted mid-write.
+            assert_for_log(not checkpoint.has_manifest(args.run_dir, "eval_best.th") or
+                           checkpoint.is_complete(args.run_dir, "eval_best.th"),
+                           "Checkpoint %s is incomplete; its last write was interrupted."
+                           % eval_best[0])
             load_model_state(
                 model,
                 eval_best[0],
@@ -276,54 +328,72 @@ def main(cl_arguments):
         assert_for_log(not elmo_scalars or args.sep_embs_for_skip,
                        "Error: ELMo scalars loaded and will be updated in train_for_eval but "
                        "they should not be updated! Check sep_embs_for_skip flag or make an issue.")
-        for task in eval_tasks:
-            # Skip mnli-diagnostic
-            # This has to be handled differently than probing tasks because probing tasks require the "is_probing_task"
-            # to be set to True. For mnli-diagnostic this flag will be False because it is part of GLUE and
-            # "is_probing_task is global flag specific to a run, not to a task.
-            if task.name == 'mnli-diagnostic':
-                continue
-            pred_module = getattr(model, "%s_mdl" % task.name)
-            to_train = elmo_scalars + [(n, p)
-                                       for n, p in pred_module.named_parameters() if p.requires_grad]
-            # Look for <task_name>_<param_name>, then eval_<param_name>
-            params = build_trainer_params(args, task_names=[task.name, 'eval'])
-            trainer, _, opt_params, schd_params = build_trainer(params, model,
-                                                                args.run_dir,
-                                                                task.val_metric_decreases)
-            best_epoch = trainer.train([task], task.val_metric,
-                                       args.batch_size, 1,
-                                       args.weighting_method, args.scaling_method,
-                                       to_train, opt_params, schd_params,
-                                       args.shared_optimizer, load_model=False, phase="eval")
-
-            # Now that we've trained a model, revert to the normal checkpoint logic for this task.
-            task_names_to_avoid_loading.remove(task.name)
-
-            # The best checkpoint will accumulate the best parameters for each task.
-            # This logic looks strange. We think it works.
-            best_epoch = best_epoch[task.name]
-            layer_path = os.path.join(args.run_dir, "model_state_eval_best.th")
-            load_model_state(
-                model,
-                layer_path,
-                args.cuda,
-                skip_task_models=task_names_to_avoid_loading,
-                strict=strict)
+        if args.train_for_eval_parallel:
+            # Skip mnli-diagnostic, as below.
+            tasks_to_train = [task for task in eval_tasks if task.name != 'mnli-diagnostic']
+            train_eval_tasks_in_parallel(args, model, tasks_to_train, args.train_for_eval_parallel)
+            # The model now holds the best parameters for each task.
+            for task in tasks_to_train:
+                task_names_to_avoid_loading.remove(task.name)
+        else:
+            for task in eval_tasks:
+                # Skip mnli-diagnostic
+                # This has to be handled differently than probing tasks because probing tasks require the "is_probing_task"
+                # to be set to True. For mnli-diagnostic this flag will be False because it is part of GLUE and
+                # "is_probing_task is global flag specific to a run, not to a task.
+                if task.name == 'mnli-diagnostic':
+                    continue
+                pred_module = getattr(model, "%s_mdl" % task.name)
+                to_train = elmo_scalars + [(n, p)
+                                           for n, p in pred_module.named_parameters() if p.requires_grad]
+                # Look for <task_name>_<param_name>, then eval_<param_name>
+                params = build_trainer_params(args, task_names=[task.name, 'eval'])
+                trainer, _, opt_params, schd_params = build_trainer(params, model,
+                                                                    args.run_dir,
+                                                                    task.val_metric_decreases)
+                best_epoch = trainer.train([task], task.val_metric,
+                                           args.batch_size, 1,
+                                           args.weighting_method, args.scaling_method,
+                                           to_train, opt_params, schd_params,
+                                           args.shared_optimizer, load_model=False, phase="eval")
+
+                # Now that we've trained a model, revert to the normal checkpoint logic for this task.
+                task_names_to_avoid_loading.remove(task.name)
+
+                # The best checkpoint will accumulate the best parameters for each task.
+                # This logic looks strange. We think it works.
+                best_epoch = best_epoch[task.name]
+                # Only this task's parameters have changed since the last load, so only read those.
+                layer_path = os.path.join(args.run_dir, "model_state_eval_best.th")
+                load_model_state(
+                    model,
+                    layer_path,
+                    args.cuda,
+                    skip_task_models=task_names_to_avoid_loading,
+                    strict=strict,
+                    prefixes=["%s_mdl." % task.name] + [n for n, _ in elmo_scalars])
 
-    if args.do_eval:
+    # All ranks have the same model, so only one needs to evaluate it.
+    if args.do_eval and distributed.is_main_process():
         # Evaluate #
         log.info("Evaluating...")
+        val_start_time = time.time()
         val_results, val_preds = evaluate.evaluate(model, eval_tasks,
                                                    args.batch_size,
                                                    args.cuda, "val")
+        val_seconds = time.time() - val_start_time
 
         splits_to_write = evaluate.parse_write_preds_arg(args.write_preds)
         if 'val' in splits_to_write:
             evaluate.write_preds(eval_tasks, val_preds, args.run_dir, 'val',
                                  strict_glue_format=args.write_strict_glue_format)
         if 'test' in splits_to_write:
-            _, te_preds = evaluate.evaluate(model, eval_tasks,
+            # The quantized model is only used for test predictions.
+            test_model = model
+            if args.eval_quantize:
+                test_model = get_quantized_eval_model(args, model, eval_tasks, val_results,
+                                                      val_seconds)
+            _, te_preds = evaluate.evaluate(test_model, eval_tasks,
                                             args.batch_size, args.cuda, "test")
             evaluate.write_preds(tasks, te_preds, args.run_dir, 'test',
                                  strict_glue_format=args.write_strict_glue_format)
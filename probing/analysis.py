@@ -7,6 +7,7 @@ import io
 import json
 import collections
 import itertools
+import shutil
 import logging as log
 
 import pandas as pd
@@ -24,6 +25,56 @@ def _get_nested_vals(record, outer_key):
             for key, value in record.get(outer_key, {}).items()}
 
 
+def confusion_counts(y_true: np.ndarray, y_proba: np.ndarray,
+                     threshold=0.5) -> Dict[str, np.ndarray]:
+    """Compute per-label confusion counts in a single pass.
+
+    Args:
+        y_true: [num_targets, num_labels] array of k-hot labels
+        y_proba: [num_targets, num_labels] array of predicted scores
+        threshold: predict a label if its score is >= threshold. If this is a
+            [num_thresholds] array, counts are computed for every threshold at
+            once.
+
+    Returns:
+        dict of int64 arrays: tp, fp, fn, tn. Each is [num_labels], or
+        [num_labels, num_thresholds] for an array of thresholds.
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    y_proba = np.asarray(y_proba)
+    threshold = np.asarray(threshold)
+    if threshold.ndim > 0:
+        # Broadcast to [num_targets, num_labels, num_thresholds].
+        y_true = y_true[..., None]
+        y_proba = y_proba[..., None]
+    y_pred = y_proba >= threshold
+    num_targets = y_true.shape[0]
+    tp = np.count_nonzero(y_true & y_pred, axis=0).astype(np.int64)
+    true_count = np.count_nonzero(y_true, axis=0).astype(np.int64)
+    pred_count = np.count_nonzero(y_pred, axis=0).astype(np.int64)
+    fp = pred_count - tp
+    fn = true_count - tp
+    tn = num_targets - tp - fp - fn
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn}
+
+
+def scores_from_counts(tp, fp, fn, tn) -> Dict[str, np.ndarray]:
+    """Compute binary F1 and accuracy from (arrays of) confusion counts.
+
+    Matches sklearn.metrics.f1_score, which returns 0 if there are no true or
+    predicted positives.
+    """
+    tp, fp, fn, tn = (np.asarray(c, dtype=np.int64) for c in (tp, fp, fn, tn))
+    f1_denom = 2 * tp + fp + fn
+    total = tp + fp + fn + tn
+    f1 = np.divide(2.0 * tp, f1_denom, out=np.zeros(tp.shape),
+                   where=(f1_denom > 0))
+    acc = np.divide((tp + tn).astype(np.float64), total,
+                    out=np.zeros(tp.shape), where=(total > 0))
+    return {'f1_score': f1, 'acc_score': acc,
+            'true_count': tp + fn, 'pred_count': tp + fp}
+
+
 class EdgeProbingExample(object):
     """Wrapper object to handle an edge probing example.
 
@@ -68,14 +119,20 @@ class Predictions(object):
     # preds has the following fields:
     preds.vocab       # allennlp.data.Vocabulary object
     preds.example_df  # DataFrame of example info (sentence text)
-    preds.target_df   # DataFrame of target info (spans, labels,
-                      #   predicted scores, etc.)
+    preds.target_df   # DataFrame of target info (spans, labels, etc.)
+    preds.label_khot  # [num_targets, num_labels] array of k-hot labels
+    preds.preds_proba # [num_targets, num_labels] array of predicted scores
 
+    The first call to from_run() converts the JSON predictions into a
+    columnar store (see PREDS_STORE_SUFFIX), which later calls memory-map
+    instead of re-parsing the JSON.
     """
 
     def _split_and_flatten_records(self, records: Iterable[Dict]):
         ex_records = []  # long-form example records, minus targets
         tr_records = []  # long-form target records with 'idx' column
+        khot_rows = []  # k-hot label vectors, one per target
+        proba_rows = []  # predicted scores, one per target
         for idx, r in enumerate(records):
             d = {'text': r['text'], 'idx': idx}
             d.update(_get_nested_vals(r, 'info'))
@@ -91,8 +148,20 @@ class Predictions(object):
                     d['span2'] = tuple(t['span2'])
                 d.update(_get_nested_vals(t, 'info'))
                 d.update(_get_nested_vals(t, 'preds'))
+                # Dense columns are kept out of the DataFrame.
+                d['label.ids'] = self._labels_to_ids(d['label'])
+                khot_rows.append(self._label_ids_to_khot(d['label.ids']))
+                proba_rows.append(d.pop('preds.proba', None))
                 tr_records.append(d)
-        return ex_records, tr_records
+
+        num_labels = self._get_num_labels()
+        label_khot = np.array(khot_rows, dtype=np.int32).reshape(-1, num_labels)
+        preds_proba = np.full((len(proba_rows), num_labels), np.nan,
+                              dtype=np.float32)
+        for i, proba in enumerate(proba_rows):
+            if proba is not None:
+                preds_proba[i] = proba
+        return ex_records, tr_records, label_khot, preds_proba
 
     def _labels_to_ids(self, labels: List[str]) -> List[int]:
         return [self.vocab.get_token_index(l, namespace=self.label_namespace)
@@ -116,17 +185,26 @@ class Predictions(object):
         self.all_labels = [self._get_label(i)
                            for i in range(self._get_num_labels())]
 
-        ex_records, tr_records = self._split_and_flatten_records(records)
-        self.example_df = pd.DataFrame.from_records(ex_records)
-        self.example_df.set_index('idx', inplace=True, drop=False)
-        self.target_df = pd.DataFrame.from_records(tr_records)
+        if records is None:
+            # Populated by _from_store()
+            return
 
-        # Apply indexing to labels
-        self.target_df['label.ids'] = self.target_df['label'].map(
-            self._labels_to_ids)
-        # Convert labels to k-hot to align to predictions
-        self.target_df['label.khot'] = self.target_df['label.ids'].map(
-            self._label_ids_to_khot)
+        ex_records, tr_records, label_khot, preds_proba = \
+            self._split_and_flatten_records(records)
+        example_df = pd.DataFrame.from_records(ex_records)
+        target_df = pd.DataFrame.from_records(tr_records)
+        self._set_data(example_df, target_df, label_khot, preds_proba)
+
+    def _set_data(self, example_df: pd.DataFrame, target_df: pd.DataFrame,
+                  label_khot: np.ndarray, preds_proba: np.ndarray):
+        assert len(target_df) == len(label_khot) == len(preds_proba)
+        self.example_df = example_df
+        self.example_df.set_index('idx', inplace=True, drop=False)
+        self.target_df = target_df
+        # K-hot labels and predicted scores are kept only in these dense
+        # arrays, rather than as per-target columns of target_df.
+        self.label_khot = label_khot
+        self.preds_proba = preds_proba
 
         # Placeholders, will compute later if requested.
         # Use non-underscore versions to access via propert getters.
@@ -134,16 +212,18 @@ class Predictions(object):
         self._target_df_long = None  # long-form targets (melted by label)
 
     def _make_wide_target_df(self):
-        log.info("Generating wide-form target DataFrame. May be slow... ")
-        # Expand labels to columns
-        expanded_y_true = self.target_df['label.khot'].apply(pd.Series)
-        expanded_y_true.columns = ["label.true." + l for l in self.all_labels]
-        expanded_y_pred = self.target_df['preds.proba'].apply(pd.Series)
-        expanded_y_pred.columns = ["preds.proba." + l for l in self.all_labels]
-        wide_df = pd.concat([self.target_df, expanded_y_true, expanded_y_pred],
+        log.info("Generating wide-form target DataFrame...")
+        # Expand labels to columns, directly from the dense arrays.
+        expanded_y_true = pd.DataFrame(
+            self.label_khot, index=self.target_df.index,
+            columns=["label.true." + l for l in self.all_labels])
+        expanded_y_pred = pd.DataFrame(
+            self.preds_proba, index=self.target_df.index,
+            columns=["preds.proba." + l for l in self.all_labels])
+        DROP_COLS = ["label", "label.ids"]
+        wide_df = pd.concat([self.target_df.drop(labels=DROP_COLS, axis=1),
+                             expanded_y_true, expanded_y_pred],
                             axis='columns')
-        DROP_COLS = ["preds.proba", "label", "label.ids", "label.khot"]
-        wide_df.drop(labels=DROP_COLS, axis=1, inplace=True)
         log.info("Done!")
         return wide_df
 
@@ -156,17 +236,16 @@ class Predictions(object):
 
     def _make_long_target_df(self):
         df = self.target_df
-        log.info("Generating long-form target DataFrame. May be slow... ")
+        log.info("Generating long-form target DataFrame...")
         num_targets = len(df)
+        num_labels = len(self.all_labels)
         # Index into self.target_df for other metadata.
-        idxs = np.tile(df.index, (len(self.all_labels), 1)).T.flatten()
+        idxs = np.repeat(df.index.values, num_labels)
         # Repeat labels for each target.
         labels = np.tile(self.all_labels, num_targets)
-        # Flatten lists using numpy - *much* faster than using Pandas.
-        label_true  = np.array(df['label.khot'].tolist(),
-                               dtype=np.int32).flatten()
-        preds_proba = np.array(df['preds.proba'].tolist(),
-                               dtype=np.float32).flatten()
+        # Row-major flattening matches the (target, label) order above.
+        label_true = np.asarray(self.label_khot, dtype=np.int32).ravel()
+        preds_proba = np.asarray(self.preds_proba, dtype=np.float32).ravel()
         assert len(label_true) == len(preds_proba)
         assert len(label_true) == len(labels)
         # Reconstruct a DataFrame.
@@ -196,47 +275,123 @@ class Predictions(object):
         record['pred_count'] = sum(y_pred)
         return record
 
-    def score_by_label(self) -> pd.DataFrame:
-        """Compute metrics for each label, and in the aggregate."""
-        long_df = self.target_df_long
-        gb = long_df.groupby(by=["label"])
-        records = []
-        for label, idxs in gb.groups.items():
-            sub_df = long_df.loc[idxs]
-            record = self.score_long_df(sub_df)
-            record['label'] = label
-            records.append(record)
-        score_df = pd.DataFrame.from_records(records)
+    def score_by_label(self, thresholds: Iterable[float] = None) -> pd.DataFrame:
+        """Compute metrics for each label, and in the aggregate.
+
+        Scores are computed from per-label TP/FP/FN/TN counts over the dense
+        [num_targets, num_labels] arrays, rather than the long-form DataFrame.
+
+        Args:
+            thresholds: optional list of decision thresholds to sweep over.
+                If given, returns scores for each threshold, with an added
+                'threshold' column. Counts for all thresholds are computed in
+                the same pass. Default is to score at 0.5.
+
+        Returns:
+            DataFrame with one row per label, plus "_macro_avg_" and
+            "_micro_avg_" rows (for each threshold).
+        """
+        sweep = thresholds is not None
+        thresholds = np.asarray(list(thresholds) if sweep else [0.5],
+                                dtype=np.float64)
+        # Each count is [num_labels, num_thresholds].
+        counts = confusion_counts(self.label_khot, self.preds_proba,
+                                  threshold=thresholds)
+        # Sort by label name, for consistency with groupby order.
+        order = np.argsort(self.all_labels, kind='mergesort')
+        labels = [self.all_labels[i] for i in order]
+        per_label = scores_from_counts(**{k: v[order]
+                                          for k, v in counts.items()})
         ##
-        # Compute macro average
-        agg_map = {}
-        for col in score_df.columns:
-            if col.endswith("_score"):
-                agg_map[col] = 'mean'
-            elif col.endswith("_count"):
-                agg_map[col] = 'sum'
-            elif col == "label":
-                pass
-            else:
-                log.warning("Unsupported column '%s'", col)
-        macro_avg = score_df.agg(agg_map)
-        macro_avg['label'] = "_macro_avg_"
-        score_df = score_df.append(macro_avg, ignore_index=True)
+        # Macro average: mean of scores, sum of counts.
+        macro_avg = {k: (v.mean(axis=0) if k.endswith("_score") else v.sum(axis=0))
+                     for k, v in per_label.items()}
         ##
-        # Compute micro average
-        micro_avg = pd.Series(self.score_long_df(long_df))
-        micro_avg['label'] = "_micro_avg_"
-        score_df = score_df.append(micro_avg, ignore_index=True)
-
+        # Micro average: score the pooled counts.
+        micro_avg = scores_from_counts(**{k: v.sum(axis=0)
+                                          for k, v in counts.items()})
         ##
-        # Move "label" column to the beginning.
-        cols = list(score_df.columns)
-        cols.insert(0, cols.pop(cols.index("label")))
-        score_df = score_df.reindex(columns=cols)
-        return score_df
+        # One block of rows per threshold: labels, then the averages.
+        cols = ["f1_score", "acc_score", "true_count", "pred_count"]
+        row_labels = labels + ["_macro_avg_", "_micro_avg_"]
+        data = {"label": row_labels * len(thresholds)}
+        for col in cols:
+            values = np.concatenate([per_label[col], macro_avg[col][None],
+                                     micro_avg[col][None]])
+            data[col] = values.T.ravel()
+        if not sweep:
+            return pd.DataFrame(data, columns=["label"] + cols)
+        data["threshold"] = np.repeat(thresholds, len(row_labels))
+        return pd.DataFrame(data, columns=["label"] + cols + ["threshold"])
+
+    ##
+    # Columnar store: a directory next to the predictions JSON, holding the
+    # dense label and score matrices as .npy files (memory-mapped on load)
+    # and the remaining metadata as pickled DataFrames.
+    PREDS_STORE_SUFFIX = ".preds_store"
+    _STORE_META_FILE = "source.json"
+
+    @staticmethod
+    def _source_fingerprint(preds_file: str) -> Dict:
+        stat = os.stat(preds_file)
+        return {'path': os.path.abspath(preds_file),
+                'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def save_store(self, store_dir: str, preds_file: str = None):
+        """Write this set of predictions as a columnar store.
+
+        If preds_file is given, record its size and mtime so that stale
+        stores can be detected by load_store().
+        """
+        tmp_dir = store_dir + ".tmp.%d" % os.getpid()
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.example_df.to_pickle(os.path.join(tmp_dir, "example_df.pkl"))
+        self.target_df.to_pickle(os.path.join(tmp_dir, "target_df.pkl"))
+        np.save(os.path.join(tmp_dir, "label_khot.npy"),
+                np.asarray(self.label_khot, dtype=np.int32))
+        np.save(os.path.join(tmp_dir, "preds_proba.npy"),
+                np.asarray(self.preds_proba, dtype=np.float32))
+        meta = {'label_namespace': self.label_namespace,
+                'source': (self._source_fingerprint(preds_file)
+                           if preds_file else None)}
+        with open(os.path.join(tmp_dir, self._STORE_META_FILE), 'w') as fd:
+            json.dump(meta, fd)
+        # Swap in the complete store, so readers never see a partial one.
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(tmp_dir, store_dir)
+        log.info("Wrote columnar predictions to %s", store_dir)
 
     @classmethod
-    def from_run(cls, run_dir: str, task_name: str, split_name: str):
+    def load_store(cls, vocab: Vocabulary, store_dir: str,
+                   preds_file: str = None, mmap_mode='r'):
+        """Load predictions from a columnar store.
+
+        Returns None if the store is missing, or if preds_file is given and
+        has changed since the store was written.
+        """
+        meta_path = os.path.join(store_dir, cls._STORE_META_FILE)
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as fd:
+            meta = json.load(fd)
+        if preds_file and meta['source'] != cls._source_fingerprint(preds_file):
+            log.info("Columnar store %s is stale; ignoring.", store_dir)
+            return None
+
+        preds = cls(vocab, None, label_namespace=meta['label_namespace'])
+        example_df = pd.read_pickle(os.path.join(store_dir, "example_df.pkl"))
+        target_df = pd.read_pickle(os.path.join(store_dir, "target_df.pkl"))
+        label_khot = np.load(os.path.join(store_dir, "label_khot.npy"),
+                             mmap_mode=mmap_mode)
+        preds_proba = np.load(os.path.join(store_dir, "preds_proba.npy"),
+                              mmap_mode=mmap_mode)
+        preds._set_data(example_df, target_df, label_khot, preds_proba)
+        return preds
+
+    @classmethod
+    def from_run(cls, run_dir: str, task_name: str, split_name: str,
+                 use_store: bool = True):
         # Load vocabulary
         exp_dir = os.path.dirname(run_dir.rstrip("/"))
         vocab_path = os.path.join(exp_dir, "vocab")
@@ -246,9 +401,24 @@ class Predictions(object):
 
         # Load predictions
         preds_file = os.path.join(run_dir, f"{task_name}_{split_name}.json")
+        store_dir = os.path.join(run_dir, f"{task_name}_{split_name}"
+                                          + cls.PREDS_STORE_SUFFIX)
+        if use_store:
+            preds = cls.load_store(vocab, store_dir, preds_file=preds_file)
+            if preds is not None:
+                log.info("Loaded predictions from %s" % store_dir)
+                return preds
+
         log.info("Loading predictions from %s" % preds_file)
-        return cls(vocab, utils.load_json_data(preds_file),
-                   label_namespace=label_namespace)
+        preds = cls(vocab, utils.load_json_data(preds_file),
+                    label_namespace=label_namespace)
+        if use_store:
+            try:
+                preds.save_store(store_dir, preds_file=preds_file)
+            except OSError as e:
+                log.warning("Unable to write columnar store to %s: %s",
+                            store_dir, str(e))
+        return preds
 
 
 class Comparison(object):
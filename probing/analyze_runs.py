@@ -8,11 +8,17 @@
 #
 # Output will be a long-form TSV file containing aggregated and per-class
 # predictions for each run.
+#
+# Pass --cache /path/to/scores.sqlite to make repeated invocations
+# incremental: only runs whose predictions or logs have changed (by size
+# and mtime) will be re-scored.
 
 import sys
 import os
 import re
 import json
+import pickle
+import sqlite3
 import collections
 import argparse
 from tqdm import tqdm
@@ -28,6 +34,56 @@ import analysis
 from typing import List, Tuple, Iterable
 
 
+class ResultCache(object):
+    """SQLite-backed cache of per-file results.
+
+    Entries are keyed on (kind, path), and are only returned if the file's
+    size and mtime match those recorded when the entry was written.
+    Values are pickled DataFrames.
+    """
+
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results ("
+                           "kind TEXT, path TEXT, size INTEGER, mtime REAL, "
+                           "data BLOB, PRIMARY KEY (kind, path))")
+        self._conn.commit()
+
+    @staticmethod
+    def fingerprint(path: str) -> Tuple[int, float]:
+        """Return (size, mtime) for path, or None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def get(self, kind: str, path: str):
+        fp = self.fingerprint(path)
+        if fp is None:
+            return None
+        row = self._conn.execute("SELECT size, mtime, data FROM results "
+                                 "WHERE kind = ? AND path = ?",
+                                 (kind, os.path.abspath(path))).fetchone()
+        if row is None or tuple(row[:2]) != fp:
+            return None
+        return pickle.loads(row[2])
+
+    def put(self, kind: str, path: str, fp: Tuple[int, float], value):
+        """Store value for path. fp should be taken *before* reading the
+        file, so that concurrent modifications invalidate the entry."""
+        if fp is None or value is None:
+            return
+        self._conn.execute("INSERT OR REPLACE INTO results VALUES "
+                           "(?, ?, ?, ?, ?)",
+                           (kind, os.path.abspath(path), fp[0], fp[1],
+                            pickle.dumps(value)))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
 def find_tasks_and_splits(run_path: str) -> List[Tuple[str, str]]:
     """Find tasks and splits for a particular run."""
     matcher = r"([\w-]+)_(train|val|test)\.json"
@@ -42,6 +98,10 @@ def find_tasks_and_splits(run_path: str) -> List[Tuple[str, str]]:
     return matches
 
 
+def get_preds_path(run_path: str, task: str, split: str) -> str:
+    return os.path.join(run_path, f"{task}_{split}.json")
+
+
 def get_run_info(run_path: str, log_name="log.log") -> pd.DataFrame:
     """Extract some run information from the log text."""
     log_path = os.path.join(run_path, log_name)
@@ -61,6 +121,20 @@ def get_run_info(run_path: str, log_name="log.log") -> pd.DataFrame:
     return pd.DataFrame.from_records(train_stats)
 
 
+def get_run_info_cached(run_path: str, cache: ResultCache,
+                        log_name="log.log") -> pd.DataFrame:
+    """Wrapper for get_run_info, using cache if available."""
+    if cache is None:
+        return get_run_info(run_path, log_name=log_name)
+    log_path = os.path.join(run_path, log_name)
+    run_info = cache.get("run_info", log_path)
+    if run_info is None:
+        fp = cache.fingerprint(log_path)
+        run_info = get_run_info(run_path, log_name=log_name)
+        cache.put("run_info", log_path, fp, run_info)
+    return run_info
+
+
 def analyze_run(run_path: str, task: str, split: str) -> pd.DataFrame:
     log.info("Analyzing: '%s' / %s' / '%s'", run_path, task, split)
     preds = analysis.Predictions.from_run(run_path, task, split)
@@ -72,7 +146,7 @@ def analyze_run(run_path: str, task: str, split: str) -> pd.DataFrame:
     return scores
 
 def _analyze_run(item):
-    return analyze_run(*item)
+    return item, analyze_run(*item)
 
 def main(args):
     parser = argparse.ArgumentParser()
@@ -82,30 +156,55 @@ def main(args):
                         help="Input files.")
     parser.add_argument('--parallel', type=int, default=1,
                         help="Number of runs to process in parallel.")
+    parser.add_argument('--cache', type=str, default="",
+                        help="SQLite file to cache scores in. If set, only "
+                             "new or changed runs will be re-scored.")
     args = parser.parse_args(args)
 
+    cache = ResultCache(args.cache) if args.cache else None
+
     work_items = []
+    fingerprints = {}
     run_info = []
+    all_scores = []
     for run_path in args.inputs:
         for task, split in find_tasks_and_splits(run_path):
-            work_items.append((run_path, task, split))
+            item = (run_path, task, split)
+            if cache is not None:
+                preds_path = get_preds_path(*item)
+                score = cache.get("scores", preds_path)
+                if score is not None:
+                    all_scores.append(score)
+                    continue
+                fingerprints[item] = cache.fingerprint(preds_path)
+            work_items.append(item)
         # Global run info from log file.
-        run_info.append(get_run_info(run_path))
+        run_info.append(get_run_info_cached(run_path, cache))
+    if cache is not None:
+        log.info("Found %d cached results, %d to score.", len(all_scores),
+                 len(work_items))
+
+    def _add_score(item, score):
+        all_scores.append(score)
+        if cache is not None:
+            cache.put("scores", get_preds_path(*item), fingerprints[item],
+                      score)
 
-    all_scores = []
     if args.parallel > 1:
         from multiprocessing import Pool
         log.info("Processing runs in parallel with %d workers", args.parallel)
         log.getLogger().setLevel(log.WARNING)  # hide INFO spam
         pool = Pool(args.parallel)
-        for score in tqdm(pool.imap_unordered(_analyze_run, work_items),
-                          total=len(work_items)):
-            all_scores.append(score)
+        for item, score in tqdm(pool.imap_unordered(_analyze_run, work_items),
+                                total=len(work_items)):
+            _add_score(item, score)
         log.getLogger().setLevel(log.INFO)  # re-enable
     else:
-        for score in tqdm(map(_analyze_run, work_items),
-                          total=len(work_items)):
-            all_scores.append(score)
+        for item, score in tqdm(map(_analyze_run, work_items),
+                                total=len(work_items)):
+            _add_score(item, score)
+    if cache is not None:
+        cache.close()
 
     long_scores = pd.concat(run_info + all_scores, axis=0,
                             ignore_index=True, sort=False)
@@ -31,30 +31,62 @@ def wrap_singleton_string(item: Union[Sequence, str]):
 
 
 class EdgeProbingDatasetStats(object):
+    """Accumulate summary statistics over edge probing records.
+
+    Stats objects are mergeable: (a + b) gives the same result as calling
+    update() on both sets of records, so files or chunks of files can be
+    processed independently and reduced.
+    """
+
+    # Lengths >= this go in the last histogram bin.
+    MAX_HIST_LENGTH = 512
+
+    # Counters that are merged by max() instead of sum().
+    _MAX_KEYS = ('token.max_count', 'targets.max_count')
 
     def __init__(self):
         self._stats = collections.Counter()
+        self._label_counts = collections.Counter()
+        # Fixed-size histograms, indexed by length.
+        hist_size = self.MAX_HIST_LENGTH + 1
+        self._hists = {
+            'token.count': np.zeros(hist_size, dtype=np.int64),
+            'targets.count': np.zeros(hist_size, dtype=np.int64),
+            'targets.span1.length': np.zeros(hist_size, dtype=np.int64),
+            'targets.span2.length': np.zeros(hist_size, dtype=np.int64),
+        }
+
+    def _hist_index(self, length: int) -> int:
+        return min(length, self.MAX_HIST_LENGTH)
 
     def update(self, record: Dict):
         stats = self._stats
+        hists = self._hists
 
         stats['count'] += 1
-        tokens = record['text'].split()
-        stats['token.count'] += len(tokens)
-        stats['token.count2'] += len(tokens)**2  # for computing RMS
-        stats['token.max_count'] = max(len(tokens), stats['token.max_count'])
+        num_tokens = len(record['text'].split())
+        stats['token.count'] += num_tokens
+        stats['token.count2'] += num_tokens**2  # for computing RMS
+        stats['token.max_count'] = max(num_tokens, stats['token.max_count'])
+        hists['token.count'][self._hist_index(num_tokens)] += 1
 
         # Target stats
         targets = record.get('targets', [])
         stats['targets.count'] += len(targets)
         stats['targets.max_count'] = max(len(targets), stats['targets.max_count'])
+        hists['targets.count'][self._hist_index(len(targets))] += 1
         for target in targets:
             labels = wrap_singleton_string(target['label'])
             stats['targets.label.count'] += len(labels)
+            self._label_counts.update(labels)
             span1 = target.get('span1', [-1, -1])
-            stats['targets.span1.length'] += (max(span1) - min(span1))
+            span1_length = max(span1) - min(span1)
+            stats['targets.span1.length'] += span1_length
+            hists['targets.span1.length'][self._hist_index(span1_length)] += 1
             span2 = target.get('span2', [-1, -1])
-            stats['targets.span2.length'] += (max(span2) - min(span2))
+            span2_length = max(span2) - min(span2)
+            stats['targets.span2.length'] += span2_length
+            hists['targets.span2.length'][self._hist_index(span2_length)] += 1
 
     def compute(self, record_iter: Iterable[Dict]):
         for record in record_iter:
@@ -65,6 +97,49 @@ class EdgeProbingDatasetStats(object):
             self.update(record)
             yield record
 
+    def __iadd__(self, other: 'EdgeProbingDatasetStats'):
+        for key, value in other._stats.items():
+            if key in self._MAX_KEYS:
+                self._stats[key] = max(self._stats[key], value)
+            else:
+                self._stats[key] += value
+        self._label_counts.update(other._label_counts)
+        for key, hist in other._hists.items():
+            self._hists[key] += hist
+        return self
+
+    def __add__(self, other: 'EdgeProbingDatasetStats'):
+        result = EdgeProbingDatasetStats()
+        result += self
+        result += other
+        return result
+
+    def __radd__(self, other):
+        # Support sum() over a list of stats, which starts from 0.
+        if other == 0:
+            return self + EdgeProbingDatasetStats()
+        return NotImplemented
+
+    @property
+    def label_counts(self) -> collections.Counter:
+        """Number of targets with each label."""
+        return self._label_counts
+
+    def histograms(self) -> pd.DataFrame:
+        """Length histograms, as a DataFrame indexed by length.
+
+        The last row counts all lengths >= MAX_HIST_LENGTH.
+        """
+        df = pd.DataFrame(self._hists)
+        df.index.name = 'length'
+        return df
+
+    def _hist_quantile(self, key: str, q: float) -> int:
+        cdf = np.cumsum(self._hists[key])
+        if cdf[-1] == 0:
+            return 0
+        return int(np.searchsorted(cdf, q * cdf[-1]))
+
     def to_series(self, **kw):
         stats = self._stats
         s = pd.Series(kw, dtype=object)
@@ -80,6 +155,10 @@ class EdgeProbingDatasetStats(object):
         s['targets.label.mean_count'] = stats['targets.label.count'] / stats['targets.count']
         s['targets.span1.mean_length'] = stats['targets.span1.length'] / stats['targets.count']
         s['targets.span2.mean_length'] = stats['targets.span2.length'] / stats['targets.count']
+        # Quantiles from histograms.
+        s['token.p50_count'] = self._hist_quantile('token.count', 0.50)
+        s['token.p95_count'] = self._hist_quantile('token.count', 0.95)
+        s['targets.label.num_distinct'] = len(self._label_counts)
         return s
 
     def format(self, **kw):
@@ -7,6 +7,9 @@
 #
 # Will print dataset size, num targets, etc. to stdout, and optionally write
 # stats to a TSV file if -o <file> is given.
+#
+# Use --parallel N to process files, and chunks of large files, in a pool of
+# N workers; per-chunk stats are merged with EdgeProbingDatasetStats.__add__.
 
 import sys
 import os
@@ -22,6 +25,41 @@ log.basicConfig(format='%(asctime)s: %(message)s',
 import pandas as pd
 from data import utils
 
+from typing import Iterable, List, Tuple
+
+
+def _iter_chunk_lines(fname: str, start: int, end: int) -> Iterable[bytes]:
+    """Yield lines that start in the byte range [start, end).
+
+    A chunk owns every line whose first byte is in its range, so adjacent
+    chunks cover the file exactly once.
+    """
+    with open(fname, 'rb') as fd:
+        if start > 0:
+            # Skip the line owned by the previous chunk.
+            fd.seek(start - 1)
+            fd.readline()
+        while fd.tell() < end:
+            line = fd.readline()
+            if not line:
+                break
+            yield line
+
+
+def analyze_chunk(item: Tuple[str, int, int]) -> Tuple[str, utils.EdgeProbingDatasetStats]:
+    fname, start, end = item
+    stats = utils.EdgeProbingDatasetStats()
+    stats.compute(json.loads(line.decode('utf-8'))
+                  for line in _iter_chunk_lines(fname, start, end)
+                  if line.strip())
+    return fname, stats
+
+
+def make_chunks(fname: str, chunk_size: int) -> List[Tuple[str, int, int]]:
+    size = os.path.getsize(fname)
+    return [(fname, start, min(start + chunk_size, size))
+            for start in range(0, max(size, 1), chunk_size)]
+
 
 def analyze_file(fname: str):
     pd.options.display.float_format = '{:.2f}'.format
@@ -33,17 +71,51 @@ def analyze_file(fname: str):
     return stats.to_series(_name=fname)
 
 
+def analyze_files_parallel(fnames: List[str], num_workers: int,
+                           chunk_size: int):
+    """Compute stats over chunks in a process pool, then reduce by file."""
+    from multiprocessing import Pool
+    pd.options.display.float_format = '{:.2f}'.format
+    work_items = []
+    for fname in fnames:
+        work_items.extend(make_chunks(fname, chunk_size))
+    log.info("Processing %d files (%d chunks) with %d workers",
+             len(fnames), len(work_items), num_workers)
+    stats_by_file = collections.OrderedDict(
+        (fname, utils.EdgeProbingDatasetStats()) for fname in fnames)
+    pool = Pool(num_workers)
+    for fname, stats in tqdm(pool.imap_unordered(analyze_chunk, work_items),
+                             total=len(work_items)):
+        stats_by_file[fname] += stats
+    pool.close()
+    pool.join()
+    all_stats = []
+    for fname, stats in stats_by_file.items():
+        log.info(stats.format(_name=fname))
+        all_stats.append(stats.to_series(_name=fname))
+    return all_stats
+
+
 def main(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', dest='output', type=str, default="",
                         help="Output file (TSV).")
     parser.add_argument('-i', dest='inputs', type=str, nargs="+",
                         help="Input files.")
+    parser.add_argument('--parallel', type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument('--chunk_size_mb', type=int, default=64,
+                        help="Split files into chunks of this size when "
+                             "running in parallel.")
     args = parser.parse_args(args)
 
-    all_stats = []
-    for fname in args.inputs:
-        all_stats.append(analyze_file(fname))
+    if args.parallel > 1:
+        all_stats = analyze_files_parallel(args.inputs, args.parallel,
+                                           args.chunk_size_mb * 2**20)
+    else:
+        all_stats = []
+        for fname in args.inputs:
+            all_stats.append(analyze_file(fname))
     df = pd.DataFrame(all_stats)
     df.set_index("_name", inplace=True)
     if args.output:
@@ -0,0 +1,117 @@
+'''Serve predictions from a trained model over HTTP.
+
+Loads a run's config, the experiment's vocabulary and tasks, and a model
+checkpoint, then answers prediction requests for single-sentence and
+sentence-pair tasks (see src/serving.py for the protocol):
+
+    python serve.py --config_file $RUN_DIR/params.conf \
+        --model_state $RUN_DIR/model_state_eval_best.th --port 8000
+
+    curl -s localhost:8000/predict \
+        -d '{"task": "mrpc", "sentence1": "A man is eating.", "sentence2": "A person eats."}'
+
+Concurrent requests are batched; --max_batch_size and --max_latency_ms
+trade off throughput against how long a request waits for a batch to fill.
+'''
+# pylint: disable=no-member
+import argparse
+import os
+import pickle as pkl
+import sys
+
+import logging as log
+log.basicConfig(format='%(asctime)s: %(message)s',
+                datefmt='%m/%d %I:%M:%S %p', level=log.INFO)
+
+import torch
+from allennlp.data import Vocabulary
+
+from src import config
+from src import preprocess
+from src import quantization
+from src import serving
+from src.models import build_model
+from src.utils import assert_for_log, load_model_state
+
+
+def handle_arguments(cl_arguments):
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--config_file', '-c', type=str, nargs="+", required=True,
+                        help="Config file(s) (.conf) for the model, usually the run's params.conf.")
+    parser.add_argument('--overrides', '-o', type=str, default=None,
+                        help="Parameter overrides, as valid HOCON string.")
+    parser.add_argument('--model_state', type=str, required=True,
+                        help="Model checkpoint (model_state_*.th) to serve.")
+    parser.add_argument('--tasks', type=str, default="",
+                        help="Tasks to serve (comma-separated). Defaults to the config's eval_tasks.")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default="",
+                        help="If set, listen on this Unix socket instead of a TCP port.")
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_latency_ms', type=float, default=10.0,
+                        help="Longest a request waits for others to batch with.")
+    return parser.parse_args(cl_arguments)
+
+
+def main(cl_arguments):
+    ''' Load a trained model, and serve predictions until interrupted. '''
+    cl_args = handle_arguments(cl_arguments)
+    args = config.params_from_file(cl_args.config_file, cl_args.overrides)
+    if args.cuda >= 0 and not torch.cuda.is_available():
+        log.warning("CUDA is not available; serving on CPU.")
+        args.cuda = -1
+    if args.cuda >= 0:
+        torch.cuda.set_device(args.cuda)
+
+    # Tasks, vocab and embeddings were saved to exp_dir during preprocessing.
+    train_task_names = preprocess.parse_task_list_arg(args.train_tasks)
+    eval_task_names = preprocess.parse_task_list_arg(args.eval_tasks)
+    tasks, _, _ = preprocess.get_tasks(train_task_names, eval_task_names, args.max_seq_len,
+                                       path=args.data_dir, scratch_path=args.exp_dir,
+                                       load_pkl=True,
+                                       nli_prob_probe_path=args['nli-prob'].probe_path,
+                                       max_targ_v_size=args.max_targ_word_v_size)
+    for task in tasks:
+        task_classifier = config.get_task_attr(args, task.name, "use_classifier")
+        setattr(task, "_classifier_name", task_classifier if task_classifier else task.name)
+    vocab = Vocabulary.from_files(os.path.join(args.exp_dir, 'vocab'))
+    args.max_word_v_size = vocab.get_vocab_size('tokens')
+    args.max_char_v_size = vocab.get_vocab_size('chars')
+    word_embs = None
+    if args.word_embs != 'none':
+        word_embs = pkl.load(open(os.path.join(args.exp_dir, 'embs.pkl'), 'rb'))
+
+    model = build_model(args, vocab, word_embs, tasks)
+    load_model_state(model, cl_args.model_state, args.cuda, strict=False)
+    model.eval()
+    if args.eval_quantize:
+        assert_for_log(args.cuda < 0, "eval_quantize is only supported on CPU (cuda = -1).")
+        model = quantization.quantize_model(model) or model
+
+    serve_names = preprocess.parse_task_list_arg(cl_args.tasks) if cl_args.tasks \
+        else eval_task_names
+    predictor = serving.Predictor(model, [task for task in tasks if task.name in serve_names],
+                                  vocab, preprocess.build_indexers(args), args.max_seq_len,
+                                  cuda_device=args.cuda)
+    assert_for_log(predictor.task_names, "None of the tasks %s can be served." % serve_names)
+    batcher = serving.MicroBatcher(predictor.predict, max_batch_size=cl_args.max_batch_size,
+                                   max_latency=cl_args.max_latency_ms / 1000.0)
+    server = serving.make_server(predictor, batcher, host=cl_args.host, port=cl_args.port,
+                                 unix_socket=cl_args.unix_socket or None)
+    log.info("Serving %s on %s", ", ".join(predictor.task_names),
+             cl_args.unix_socket or "http://%s:%d" % (cl_args.host, cl_args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if cl_args.unix_socket and os.path.exists(cl_args.unix_socket):
+            os.remove(cl_args.unix_socket)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    sys.exit(0)
@@ -2,10 +2,13 @@
 import numpy as np
 from overrides import overrides
 from allennlp.training.metrics.metric import Metric
-from sklearn.metrics import matthews_corrcoef, confusion_matrix
-from scipy.stats import pearsonr, spearmanr
 import torch
 
+from ..lazy import lazy_import
+
+sklearn_metrics = lazy_import("sklearn.metrics")
+scipy_stats = lazy_import("scipy.stats")
+
 
 @Metric.register("fastMatthews")
 class FastMatthews(Metric):
@@ -31,7 +34,7 @@ class FastMatthews(Metric):
         assert predictions.dtype in [np.int32, np.int64, int]
         assert labels.dtype in [np.int32, np.int64, int]
 
-        C = confusion_matrix(labels.ravel(), predictions.ravel(),
+        C = sklearn_metrics.confusion_matrix(labels.ravel(), predictions.ravel(),
                              labels=np.arange(self.n_classes, dtype=np.int32))
         assert C.shape == (self.n_classes, self.n_classes)
         self._C += C
@@ -74,18 +77,19 @@ class Correlation(Metric):
     def __init__(self, corr_type):
         self._predictions = []
         self._labels = []
-        if corr_type == 'pearson':
-            corr_fn = pearsonr
-        elif corr_type == 'spearman':
-            corr_fn = spearmanr
-        elif corr_type == 'matthews':
-            corr_fn = matthews_corrcoef
-        else:
+        if corr_type not in ['pearson', 'spearman', 'matthews']:
             raise ValueError("Correlation type not supported")
-        self._corr_fn = corr_fn
+        self._corr_fn = None  # looked up on first use, to defer importing SciPy and sklearn
         self.corr_type = corr_type
 
     def _correlation(self, labels, predictions):
+        if self._corr_fn is None:
+            if self.corr_type == 'pearson':
+                self._corr_fn = scipy_stats.pearsonr
+            elif self.corr_type == 'spearman':
+                self._corr_fn = scipy_stats.spearmanr
+            else:
+                self._corr_fn = sklearn_metrics.matthews_corrcoef
         corr = self._corr_fn(labels, predictions)
         if self.corr_type in ['pearson', 'spearman']:
             corr = corr[0]
@@ -0,0 +1,359 @@
+""" Checkpoint writing helpers.
+
+A checkpoint is a set of files named <prefix>_<suffix>, e.g.
+model_state_main_epoch_3.best_macro.th, plus a manifest, written last, that
+lists the files and their sizes. While a checkpoint is being (re)written, its
+manifest marks it as in progress. A checkpoint is complete iff its manifest
+exists, isn't in progress, and all listed files match. Each file is written
+to a temporary name and atomically renamed, so a crash mid-write never leaves
+a torn file under a checkpoint name.
+
+CheckpointWriter snapshots state to CPU memory on the calling thread, then
+writes on a background thread so training can continue.
+
+Model states can be written in an indexed format (see save_indexed): raw
+tensor data followed by a JSON index of names, dtypes, shapes and offsets.
+Readers memory-map the file and copy out only the tensors they need, and
+writers can overwrite a subset of tensors in place. Plain torch.save files
+are still read transparently.
+"""
+import os
+import copy
+import json
+import mmap
+import time
+import queue
+import struct
+import threading
+import collections
+import logging as log
+
+import numpy as np
+import torch
+
+# The manifest shares the "<prefix>_state_<suffix>" naming of the other
+# checkpoint files, so that the trainer's glob-based renaming and cleanup
+# of old checkpoints applies to it too. Its contents are JSON.
+MANIFEST_PREFIX = "manifest_state"
+
+
+def get_path(dirname, prefix, suffix):
+    return os.path.join(dirname, "{}_{}".format(prefix, suffix))
+
+
+def get_manifest_path(dirname, suffix):
+    return get_path(dirname, MANIFEST_PREFIX, suffix)
+
+
+def _tmp_path(path):
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, ".tmp." + basename)
+
+
+def snapshot_to_cpu(obj):
+    ''' Deep-copy obj, moving any tensors to CPU. Handles (nested) dicts,
+    lists and tuples, such as model and optimizer state dicts. '''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    elif isinstance(obj, dict):
+        new_obj = type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):  # module state dicts carry version info
+            new_obj._metadata = copy.deepcopy(obj._metadata)
+        return new_obj
+    elif isinstance(obj, list):
+        return [snapshot_to_cpu(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(snapshot_to_cpu(v) for v in obj)
+    else:
+        return copy.deepcopy(obj)
+
+
+def atomic_torch_save(obj, path):
+    ''' torch.save to a temporary file, then rename into place. '''
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'wb') as fd:
+        torch.save(obj, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_path, path)
+
+
+def _atomic_write_json(obj, path):
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as fd:
+        json.dump(obj, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_path, path)
+
+
+# Indexed format: [tensor data][JSON index][index length: uint64][magic]
+INDEX_MAGIC = b"JNTIDX01"
+_FOOTER = struct.Struct("<Q8s")
+_ALIGN = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _tensor_to_array(tensor):
+    # Not np.ascontiguousarray, which turns 0-dim arrays into 1-dim ones.
+    arr = tensor.detach().cpu().numpy()
+    return arr if arr.flags['C_CONTIGUOUS'] else arr.copy(order='C')
+
+
+def is_indexed(path):
+    ''' Check whether path is a checkpoint in the indexed format. '''
+    try:
+        with open(path, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            if fd.tell() < _FOOTER.size:
+                return False
+            fd.seek(-_FOOTER.size, os.SEEK_END)
+            return _FOOTER.unpack(fd.read(_FOOTER.size))[1] == INDEX_MAGIC
+    except IOError:
+        return False
+
+
+def _read_index(fd):
+    ''' Returns (index, offset of the index), where index is an OrderedDict
+    of name -> {dtype, shape, offset, nbytes}. '''
+    fd.seek(0, os.SEEK_END)
+    file_size = fd.tell()
+    fd.seek(-_FOOTER.size, os.SEEK_END)
+    index_len, magic = _FOOTER.unpack(fd.read(_FOOTER.size))
+    assert magic == INDEX_MAGIC, "Not an indexed checkpoint: %s" % fd.name
+    index_start = file_size - _FOOTER.size - index_len
+    fd.seek(index_start)
+    index = json.loads(fd.read(index_len).decode('utf-8'),
+                       object_pairs_hook=collections.OrderedDict)
+    return index, index_start
+
+
+def _write_tensors(fd, tensors, index, data_end):
+    ''' Write tensors, a dict of name -> tensor, at aligned offsets from
+    data_end, recording them in index. Returns the new end of the data. '''
+    for name, tensor in tensors.items():
+        arr = _tensor_to_array(tensor)
+        offset = _aligned(data_end)
+        fd.seek(offset)
+        fd.write(arr.tobytes())
+        index[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape),
+                       'offset': offset, 'nbytes': arr.nbytes}
+        data_end = offset + arr.nbytes
+    return data_end
+
+
+def _write_index(fd, index, data_end):
+    encoded = json.dumps(index).encode('utf-8')
+    fd.seek(data_end)
+    fd.write(encoded)
+    fd.write(_FOOTER.pack(len(encoded), INDEX_MAGIC))
+    fd.truncate()
+    fd.flush()
+    os.fsync(fd.fileno())
+
+
+def save_indexed(state_dict, path):
+    ''' Write a state dict of tensors in the indexed format, atomically. '''
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'wb') as fd:
+        index = collections.OrderedDict()
+        data_end = _write_tensors(fd, state_dict, index, 0)
+        _write_index(fd, index, data_end)
+    os.replace(tmp_path, path)
+
+
+def update_indexed(state_dict, path):
+    ''' Overwrite the given tensors in an existing indexed checkpoint.
+
+    Tensors with the same dtype and shape as the stored ones are rewritten in
+    place; others are appended, and the index is rewritten after them. The rest
+    of the file is untouched. Unlike save_indexed, this is not atomic: a crash
+    during the update can leave a mix of old and new values.
+    '''
+    with open(path, 'r+b') as fd:
+        index, data_end = _read_index(fd)
+        to_append = collections.OrderedDict()
+        for name, tensor in state_dict.items():
+            arr = _tensor_to_array(tensor)
+            entry = index.get(name)
+            if (entry is not None and entry['dtype'] == arr.dtype.str and
+                    entry['shape'] == list(arr.shape)):
+                fd.seek(entry['offset'])
+                fd.write(arr.tobytes())
+            else:
+                to_append[name] = tensor
+        # Appended tensors go where the old index was; the index moves after them.
+        data_end = _write_tensors(fd, to_append, index, data_end)
+        _write_index(fd, index, data_end)
+
+
+def load_indexed(path, keep=None):
+    ''' Load tensors from an indexed checkpoint, as CPU tensors.
+
+    Only the tensors whose names pass keep (if given) are read from disk.
+    '''
+    state_dict = collections.OrderedDict()
+    with open(path, 'rb') as fd:
+        index, _ = _read_index(fd)
+        names = [name for name in index if keep is None or keep(name)]
+        if not names:
+            return state_dict
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for name in names:
+                entry = index[name]
+                dtype = np.dtype(entry['dtype'])
+                # Copy, so that the tensor outlives the mapping. (Don't hold on to
+                # views of buf, or it can't be closed.)
+                state_dict[name] = torch.from_numpy(
+                    np.frombuffer(buf, dtype=dtype, count=entry['nbytes'] // dtype.itemsize,
+                                  offset=entry['offset']).reshape(tuple(entry['shape'])).copy())
+    return state_dict
+
+
+def load_state_dict(path, cuda_device=-1, keep=None):
+    ''' Load a model state from either an indexed or a torch.save checkpoint.
+
+    Args:
+        path: checkpoint path
+        cuda_device: GPU to move tensors to, or -1 for CPU
+        keep: optional function name -> bool, to select which tensors to load.
+            For indexed checkpoints, the others aren't read at all.
+    '''
+    if is_indexed(path):
+        state_dict = load_indexed(path, keep=keep)
+        if cuda_device >= 0:
+            state_dict = collections.OrderedDict(
+                (k, v.cuda(cuda_device)) for k, v in state_dict.items())
+        return state_dict
+    if cuda_device >= 0:
+        state_dict = torch.load(path, map_location=lambda storage, loc: storage.cuda(cuda_device))
+    else:
+        state_dict = torch.load(path, map_location=lambda storage, loc: storage)
+    if keep is not None:
+        for name in [k for k in state_dict if not keep(k)]:
+            del state_dict[name]
+    return state_dict
+
+
+def write_checkpoint(dirname, suffix, files, indexed_prefixes=(), update=False):
+    ''' Write files, a list of (prefix, object), and then the manifest.
+
+    Files whose prefix is in indexed_prefixes are written in the indexed format.
+    If update is set, those are instead updated in place, if they already exist.
+
+    Until the new manifest is written, the manifest marks the checkpoint as in
+    progress, so that a crash partway through (e.g. during an in-place update,
+    which can leave a mix of old and new tensors in a file of the same size)
+    never leaves a checkpoint that is_complete accepts.
+    '''
+    manifest_path = get_manifest_path(dirname, suffix)
+    _atomic_write_json({'files': {}, 'in_progress': True, 'time': time.time()},
+                       manifest_path)
+    sizes = {}
+    for prefix, obj in files:
+        path = get_path(dirname, prefix, suffix)
+        if prefix in indexed_prefixes:
+            if update and is_indexed(path):
+                update_indexed(obj, path)
+            else:
+                save_indexed(obj, path)
+        else:
+            atomic_torch_save(obj, path)
+        sizes[prefix] = os.path.getsize(path)
+    manifest = {'files': sizes, 'time': time.time()}
+    _atomic_write_json(manifest, manifest_path)
+
+
+def has_manifest(dirname, suffix):
+    return os.path.isfile(get_manifest_path(dirname, suffix))
+
+
+def is_complete(dirname, suffix):
+    ''' Check that the manifest for suffix exists and all its files match. '''
+    try:
+        with open(get_manifest_path(dirname, suffix)) as fd:
+            manifest = json.load(fd)
+    except (IOError, ValueError):
+        return False
+    if manifest.get('in_progress'):
+        return False
+    for prefix, size in manifest['files'].items():
+        path = get_path(dirname, prefix, suffix)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+
+class CheckpointWriter(object):
+    ''' Writes checkpoints, optionally on a background thread.
+
+    At most one write is queued behind the one in progress; further calls to
+    save() block until there's room, which bounds the memory held by
+    snapshots. Call wait() before reading back anything that was saved.
+
+    Files with prefixes in indexed_prefixes (state dicts of tensors) are
+    written in the indexed format.
+    '''
+
+    def __init__(self, async_write=True, indexed_prefixes=()):
+        self._async_write = async_write
+        self._indexed_prefixes = tuple(indexed_prefixes)
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+        self._error = None
+
+    def save(self, dirname, suffix, files, callback=None, update=False):
+        ''' Snapshot and write a checkpoint.
+
+        Args:
+            dirname: directory to write to
+            suffix: checkpoint suffix, e.g. "main_epoch_3.th"
+            files: list of (prefix, object) to save, as <prefix>_<suffix>
+            callback: optional function to call (on the writer thread) after
+                the checkpoint is complete
+            update: if set, existing indexed files are updated with the given
+                tensors rather than replaced
+        '''
+        self._raise_if_failed()
+        job = (dirname, suffix,
+               [(prefix, snapshot_to_cpu(obj)) for prefix, obj in files],
+               callback, update)
+        if not self._async_write:
+            self._run_job(*job)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+        self._queue.put(job)
+
+    def wait(self):
+        ''' Block until all queued checkpoints are written. '''
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Checkpoint write failed") from error
+
+    def _run_job(self, dirname, suffix, files, callback, update):
+        start_time = time.time()
+        write_checkpoint(dirname, suffix, files, self._indexed_prefixes, update)
+        log.info("Wrote checkpoint %s in %.2fs", suffix, time.time() - start_time)
+        if callback is not None:
+            callback()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run_job(*job)
+            except BaseException as e:
+                log.exception("Error writing checkpoint %s", job[1])
+                self._error = e
+            finally:
+                self._queue.task_done()
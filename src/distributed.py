@@ -0,0 +1,132 @@
+""" Helpers for multi-process data-parallel training with torch.distributed.
+
+Start one process per rank, with RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT
+set in the environment, e.g. with
+    python -m torch.distributed.launch --nproc_per_node=4 main.py --config_file ...
+and set distributed = 1 in the config.
+
+Every rank runs the same sequence of tasks on a disjoint shard of each task's
+training data. Gradients are averaged across ranks before each optimizer step,
+so all ranks keep identical parameters. When not initialized, every helper
+here behaves as for a single process.
+"""
+import itertools
+import logging as log
+
+import torch
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+try:
+    import torch.distributed as dist
+except ImportError:
+    dist = None
+
+_INITIALIZED = False
+
+# Gradients are all-reduced in flat buckets of about this many bytes.
+_BUCKET_BYTES = 25 * 2**20
+
+
+def _reduce_sum():
+    # torch 0.4 calls this reduce_op; later versions ReduceOp.
+    return getattr(dist, 'ReduceOp', getattr(dist, 'reduce_op', None)).SUM
+
+
+def init(backend="gloo", init_method="env://"):
+    ''' Join the process group. Rank and world size come from the environment. '''
+    global _INITIALIZED
+    assert dist is not None and getattr(dist, 'is_available', lambda: True)(), \
+        "torch.distributed is not available in this installation of PyTorch."
+    dist.init_process_group(backend=backend, init_method=init_method)
+    _INITIALIZED = True
+    log.info("Initialized distributed training: rank %d of %d (%s backend)",
+             get_rank(), get_world_size(), backend)
+
+
+def is_distributed():
+    return _INITIALIZED
+
+
+def get_rank():
+    return dist.get_rank() if _INITIALIZED else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if _INITIALIZED else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def get_shard():
+    ''' Returns (index, num_shards) for this rank, or None if not distributed. '''
+    return (get_rank(), get_world_size()) if _INITIALIZED else None
+
+
+def barrier():
+    if _INITIALIZED:
+        dist.barrier()
+
+
+def broadcast_int(value, src=0):
+    ''' Return src's value of an integer on every rank. '''
+    if not _INITIALIZED:
+        return value
+    tensor = torch.LongTensor([value])
+    dist.broadcast(tensor, src)
+    return int(tensor[0])
+
+
+def broadcast_parameters(model, src=0):
+    ''' Copy src's parameters and buffers to every rank. '''
+    if not _INITIALIZED:
+        return
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def all_reduce_sum(values):
+    ''' Sum a list of floats across ranks. '''
+    if not _INITIALIZED:
+        return list(values)
+    tensor = torch.DoubleTensor([float(v) for v in values])
+    dist.all_reduce(tensor, op=_reduce_sum())
+    return tensor.tolist()
+
+
+def average_gradients(params):
+    ''' Average the gradients of params across ranks, in place.
+
+    Every rank must pass the same params with gradients, in the same order,
+    which holds as long as all ranks train on the same task at each step. '''
+    if not _INITIALIZED:
+        return
+    world_size = float(get_world_size())
+    grads = [p.grad.data for p in params if p.grad is not None]
+    buckets, bucket, bucket_bytes = [], [], 0
+    for grad in grads:
+        if bucket and (grad.type() != bucket[0].type() or bucket_bytes >= _BUCKET_BYTES):
+            buckets.append(bucket)
+            bucket, bucket_bytes = [], 0
+        bucket.append(grad)
+        bucket_bytes += grad.numel() * grad.element_size()
+    if bucket:
+        buckets.append(bucket)
+    for bucket in buckets:
+        flat = _flatten_dense_tensors(bucket)
+        dist.all_reduce(flat, op=_reduce_sum())
+        flat /= world_size
+        for grad, reduced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            grad.copy_(reduced)
+
+
+def shard_iterable(iterable, limit=None):
+    ''' This rank's share of the first limit items of iterable (all items if
+    limit is None), taking every world_size-th item. '''
+    return itertools.islice(iterable, get_rank(), limit, get_world_size())
+
+
+def shard_size(n):
+    ''' Number of items this rank gets from shard_iterable over n items. '''
+    return len(range(get_rank(), n, get_world_size()))
@@ -1,18 +1,21 @@
 """ Helper functions to evaluate a model on a dataset """
 import os
+import csv
 import time
+import itertools
 import logging as log
 
 import json
-import pandas as pd
 from csv import QUOTE_NONE, QUOTE_MINIMAL
 
 import torch
 from allennlp.data.iterators import BasicIterator
 from . import tasks as tasks_module
 from . import preprocess
+from .prediction_sink import PredictionSink
+from .lm_stream import TokenStream
 
-from typing import List, Sequence, Iterable, Tuple, Dict
+from typing import List, Sequence, Iterable, Iterator, Tuple, Dict
 
 LOG_INTERVAL = 30
 
@@ -34,8 +37,9 @@ def parse_write_preds_arg(write_preds_arg: str) -> List[str]:
 
 
 def evaluate(model, tasks: Sequence[tasks_module.Task], batch_size: int,
-             cuda_device: int, split="val") -> Tuple[Dict, pd.DataFrame]:
-    '''Evaluate on a dataset'''
+             cuda_device: int, split="val") -> Tuple[Dict, Dict[str, PredictionSink]]:
+    '''Evaluate on a dataset. Returns metrics, and a PredictionSink of
+    predictions for each task that has them.'''
     FIELDS_TO_EXPORT = ['idx', 'sent1_str', 'sent2_str', 'labels']
     # Enforce that these tasks have the 'idx' field set.
     IDX_REQUIRED_TASK_NAMES = preprocess.ALL_GLUE_TASKS + ['wmt']
@@ -52,10 +56,13 @@ def evaluate(model, tasks: Sequence[tasks_module.Task], batch_size: int,
         log.info("Evaluating on: %s, split: %s", task.name, split)
         last_log = time.time()
         n_examples = 0
-        task_preds = []  # accumulate DataFrames
+        task_preds = PredictionSink()
         assert split in ["train", "val", "test"]
         dataset = getattr(task, "%s_data" % split)
-        generator = iterator(dataset, num_epochs=1, shuffle=False, cuda_device=cuda_device)
+        if isinstance(dataset, TokenStream):
+            generator = dataset.batches(batch_size, num_epochs=1, cuda_device=cuda_device)
+        else:
+            generator = iterator(dataset, num_epochs=1, shuffle=False, cuda_device=cuda_device)
         for batch_idx, batch in enumerate(generator):
             out = model.forward(task, batch, predict=True)
             # We don't want mnli-diagnostic to affect the micro and macro average.
@@ -74,17 +81,13 @@ def evaluate(model, tasks: Sequence[tasks_module.Task], batch_size: int,
             for field in FIELDS_TO_EXPORT:
                 if field in batch:
                     cols[field] = _coerce_list(batch[field])
-
-            # Transpose data using Pandas
-            df = pd.DataFrame(cols)
-            task_preds.append(df)
+            task_preds.append(cols)
 
             if time.time() - last_log > LOG_INTERVAL:
                 log.info("\tTask %s: batch %d", task.name, batch_idx)
                 last_log = time.time()
 
-        # task_preds will be a DataFrame with columns
-        # ['preds'] + FIELDS_TO_EXPORT
+        # task_preds will have columns ['preds'] + FIELDS_TO_EXPORT
         # for GLUE tasks, preds entries should be single scalars.
 
         # Update metrics
@@ -95,16 +98,11 @@ def evaluate(model, tasks: Sequence[tasks_module.Task], batch_size: int,
         all_metrics["macro_avg"] += all_metrics[task.val_metric]
         n_examples_overall += n_examples
 
-        if not task_preds:
+        if len(task_preds) == 0:
             log.warning("Task %s: has no predictions!", task.name)
             continue
 
-        # Combine task_preds from each batch to a single DataFrame.
-        task_preds = pd.concat(task_preds, ignore_index=True)
-        # Store predictions, sorting by index if given.
-        if 'idx' in task_preds.columns:
-            log.info("Task '%s': sorting predictions by 'idx'", task.name)
-            task_preds.sort_values(by=['idx'], inplace=True)
+        # Predictions are read back sorted by 'idx', if given.
         all_preds[task.name] = task_preds
         log.info("Finished evaluating on: %s", task.name)
 
@@ -122,19 +120,19 @@ def write_preds(tasks: Iterable[tasks_module.Task], all_preds, pred_dir, split_n
                         task.name, split_name)
             continue
 
-        preds_df = all_preds[task.name]
+        preds = all_preds[task.name]
         # Tasks that use _write_glue_preds:
         glue_style_tasks = (preprocess.ALL_NLI_PROBING_TASKS
                             + preprocess.ALL_GLUE_TASKS + ['wmt'])
         if task.name in glue_style_tasks:
             # Strict mode: strict GLUE format (no extra cols)
             strict = (strict_glue_format and task.name in preprocess.ALL_GLUE_TASKS)
-            _write_glue_preds(task.name, preds_df, pred_dir, split_name,
+            _write_glue_preds(task.name, preds, pred_dir, split_name,
                               strict_glue_format=strict)
             log.info("Task '%s': Wrote predictions to %s", task.name, pred_dir)
         elif isinstance(task, tasks_module.EdgeProbingTask):
             # Edge probing tasks, have structured output.
-            _write_edge_preds(task, preds_df, pred_dir, split_name)
+            _write_edge_preds(task, preds, pred_dir, split_name)
             log.info("Task '%s': Wrote predictions to %s", task.name, pred_dir)
         else:
             log.warning("Task '%s' not supported by write_preds().",
@@ -166,7 +164,7 @@ def _get_pred_filename(task_name, pred_dir, split_name, strict_glue_format):
 
 
 def _write_edge_preds(task: tasks_module.EdgeProbingTask,
-                      preds_df: pd.DataFrame,
+                      preds: PredictionSink,
                       pred_dir: str, split_name: str,
                       join_with_input: bool=True):
     ''' Write predictions for edge probing task.
@@ -180,19 +178,31 @@ def _write_edge_preds(task: tasks_module.EdgeProbingTask,
     preds_file = os.path.join(pred_dir, f"{task.name}_{split_name}.json")
     # Each row of 'preds' is a NumPy object, need to convert to list for
     # serialization.
-    preds_df = preds_df.copy()
-    preds_df['preds'] = [a.tolist() for a in preds_df['preds']]
+    rows = preds.rows()
     if join_with_input:
-        preds_df.set_index(['idx'], inplace=True)
         # Load input data and join by row index.
         log.info("Task '%s': joining predictions with input split '%s'",
                  task.name, split_name)
         records = task.get_split_text(split_name)
-        # TODO: update this with more prediction types, when available.
-        records = (task.merge_preds(r, {'proba': preds_df.at[i, 'preds']})
-                   for i, r in enumerate(records))
+
+        def _merge(records, rows):
+            # Rows are sorted by idx, so this is a merge join. There should be
+            # exactly one prediction per input record.
+            missing = object()
+            for i, (record, row) in enumerate(itertools.zip_longest(records, rows,
+                                                                    fillvalue=missing)):
+                assert row is not missing, \
+                    "Task '%s': missing prediction for line %d" % (task.name, i)
+                assert record is not missing, \
+                    "Task '%s': prediction for line %d, past the end of the input" % (
+                        task.name, i)
+                assert row['idx'] == i, \
+                    "Task '%s': missing prediction for line %d" % (task.name, i)
+                # TODO: update this with more prediction types, when available.
+                yield task.merge_preds(record, {'proba': row['preds'].tolist()})
+        records = _merge(records, rows)
     else:
-        records = (row.to_dict() for _, row in preds_df.iterrows())
+        records = (dict(row, preds=row['preds'].tolist()) for row in rows)
 
     with open(preds_file, 'w') as fd:
         for record in records:
@@ -200,7 +210,28 @@ def _write_edge_preds(task: tasks_module.EdgeProbingTask,
             fd.write("\n")
 
 
-def _write_glue_preds(task_name: str, preds_df: pd.DataFrame,
+# Output column name -> (input column name, value for missing entries)
+GLUE_PRED_COLUMNS = [('index', 'idx', -1),
+                     ('prediction', 'preds', None),
+                     ('sentence_1', 'sent1_str', ""),
+                     ('sentence_2', 'sent2_str', ""),
+                     ('true_label', 'labels', -1)]
+
+
+def _glue_pred_rows(preds: PredictionSink, sort_by_idx: bool=True) -> Iterator[Dict]:
+    ''' Rows of preds, with columns renamed to match output headers and
+    missing values filled in. '''
+    renames = {in_col: out_col for out_col, in_col, _ in GLUE_PRED_COLUMNS}
+    defaults = {out_col: default for out_col, _, default in GLUE_PRED_COLUMNS}
+    for row in preds.rows(sort_by_idx):
+        out_row = dict(defaults)
+        for name, value in row.items():
+            if value is not None:
+                out_row[renames.get(name, name)] = value
+        yield out_row
+
+
+def _write_glue_preds(task_name: str, preds: PredictionSink,
                       pred_dir: str, split_name: str,
                       strict_glue_format: bool=False):
     ''' Write predictions to separate files located in pred_dir.
@@ -210,21 +241,27 @@ def _write_glue_preds(task_name: str, preds_df: pd.DataFrame,
 
     Args:
         task_name: task name
-        preds_df: predictions DataFrame for a single task, as returned by
-            evaluate().
+        preds: predictions for a single task, as returned by evaluate().
         pred_dir: directory to write predictions
         split_name: name of this split ('train', 'val', or 'test')
         strict_glue_format: if true, writes format compatible with GLUE
             website.
     '''
-    def _apply_pred_map(preds_df, pred_map, key='prediction'):
-        """ Apply preds_map, in-place. """
-        preds_df[key] = [pred_map[p] for p in preds_df[key]]
-
-    def _write_preds_with_pd(preds_df: pd.DataFrame, pred_file: str,
-                             write_type=int):
-        """ Write TSV file in GLUE format, using Pandas. """
-
+    def _apply_pred_map(rows, pred_map, key='prediction'):
+        """ Apply preds_map to each row, in-place. """
+        for row in rows:
+            row[key] = pred_map[row[key]]
+            yield row
+
+    def _format_value(value):
+        if value is None:
+            return ""
+        if isinstance(value, float):
+            return "%.3f" % value
+        return value
+
+    def _write_preds_tsv(rows: Iterable[Dict], pred_file: str):
+        """ Stream TSV file in GLUE format. """
         required_cols = ['index', 'prediction']
         if strict_glue_format:
             cols_to_write = required_cols
@@ -232,98 +269,55 @@ def _write_glue_preds(task_name: str, preds_df: pd.DataFrame,
             log.info("Task '%s', split '%s': writing %s in "
                      "strict GLUE format.", task_name, split_name, pred_file)
         else:
-            all_cols = set(preds_df.columns)
+            renames = {in_col: out_col for out_col, in_col, _ in GLUE_PRED_COLUMNS}
+            all_cols = set(out_col for out_col, _, _ in GLUE_PRED_COLUMNS)
+            all_cols.update(renames.get(name, name) for name in preds.columns)
             # make sure we write index and prediction as first columns,
             # then all the other ones we can find.
             cols_to_write = (required_cols +
                              sorted(list(all_cols.difference(required_cols))))
             quoting = QUOTE_MINIMAL
-        preds_df.to_csv(pred_file, sep="\t", index=False, float_format="%.3f",
-                        quoting=quoting, columns=cols_to_write)
-
-    if len(preds_df) == 0:  # catch empty lists
+        with open(pred_file, 'w', newline='') as fd:
+            writer = csv.writer(fd, delimiter="\t", quoting=quoting,
+                                lineterminator="\n")
+            writer.writerow(cols_to_write)
+            for row in rows:
+                writer.writerow([_format_value(row.get(col)) for col in cols_to_write])
+
+    if len(preds) == 0:  # catch empty lists
         log.warning("Task '%s': predictions are empty!", task_name)
         return
 
-    def _add_default_column(df, name: str, val):
-        """ Ensure column exists and missing values = val. """
-        if name not in df:
-            df[name] = val
-        df[name].fillna(value=val, inplace=True)
-
-    preds_df = preds_df.copy()
-    _add_default_column(preds_df, 'idx', -1)
-    _add_default_column(preds_df, 'sent1_str', "")
-    _add_default_column(preds_df, 'sent2_str', "")
-    _add_default_column(preds_df, 'labels', -1)
-    # Rename columns to match output headers.
-    preds_df.rename({"idx": "index",
-                     "preds": "prediction",
-                     "sent1_str": "sentence_1",
-                     "sent2_str": "sentence_2",
-                     "labels": "true_label"},
-                    axis='columns', inplace=True)
-
     if task_name == 'mnli' and split_name == 'test':  # 9796 + 9847 + 1104 = 20747
-        assert len(preds_df) == 20747, "Missing predictions for MNLI!"
+        assert len(preds) == 20747, "Missing predictions for MNLI!"
         log.info("There are %d examples in MNLI, 20747 were expected",
-                 len(preds_df))
-        # Sort back to original order. Otherwise mismatched, matched and diagnostic would be mixed together
+                 len(preds))
+        # Keep the original order. Otherwise mismatched, matched and diagnostic would be mixed together
         # Mismatched, matched and diagnostic all begin by index 0.
-        preds_df.sort_index(inplace=True)
         pred_map = {0: 'neutral', 1: 'entailment', 2: 'contradiction'}
-        _apply_pred_map(preds_df, pred_map, 'prediction')
-        _write_preds_with_pd(preds_df.iloc[:9796], os.path.join(
+        rows = _apply_pred_map(_glue_pred_rows(preds, sort_by_idx=False), pred_map, 'prediction')
+        _write_preds_tsv(itertools.islice(rows, 9796), os.path.join(
             pred_dir, _get_pred_filename('mnli-m', pred_dir, split_name, strict_glue_format)))
-        _write_preds_with_pd(preds_df.iloc[9796:19643], os.path.join(
+        _write_preds_tsv(itertools.islice(rows, 9847), os.path.join(
             pred_dir, _get_pred_filename('mnli-mm', pred_dir, split_name, strict_glue_format)))
-        _write_preds_with_pd(preds_df.iloc[19643:], os.path.join(
+        _write_preds_tsv(rows, os.path.join(
             pred_dir, _get_pred_filename('diagnostic', pred_dir, split_name, strict_glue_format)))
+        log.info("Wrote predictions for task: %s", task_name)
+        return
 
-    elif task_name in ['rte', 'qnli']:
+    rows = _glue_pred_rows(preds)
+    if task_name in ['rte', 'qnli']:
         pred_map = {0: 'not_entailment', 1: 'entailment'}
-        _apply_pred_map(preds_df, pred_map, 'prediction')
-        _write_preds_with_pd(
-            preds_df,
-            _get_pred_filename(
-                task_name,
-                pred_dir,
-                split_name,
-                strict_glue_format))
+        rows = _apply_pred_map(rows, pred_map, 'prediction')
     elif task_name in ['sts-b']:
-        preds_df['prediction'] = [min(max(0., pred * 5.), 5.)
-                                  for pred in preds_df['prediction']]
-        _write_preds_with_pd(
-            preds_df,
-            _get_pred_filename(
-                task_name,
-                pred_dir,
-                split_name,
-                strict_glue_format),
-            write_type=float)
+        rows = (dict(row, prediction=min(max(0., row['prediction'] * 5.), 5.))
+                for row in rows)
     elif task_name in ['wmt']:
         # convert each prediction to a single string if we find a list of tokens
-        if isinstance(preds_df['prediction'][0], list):
-            assert isinstance(preds_df['prediction'][0][0], str)
-            preds_df['prediction'] = [' '.join(pred)
-                                      for pred in preds_df['prediction']]
-        _write_preds_with_pd(
-            preds_df,
-            _get_pred_filename(
-                task_name,
-                pred_dir,
-                split_name,
-                strict_glue_format),
-            write_type=str)
-    else:
-        _write_preds_with_pd(
-            preds_df,
-            _get_pred_filename(
-                task_name,
-                pred_dir,
-                split_name,
-                strict_glue_format),
-            write_type=int)
+        rows = (dict(row, prediction=' '.join(row['prediction']))
+                if isinstance(row['prediction'], list) else row for row in rows)
+    _write_preds_tsv(rows, _get_pred_filename(task_name, pred_dir, split_name,
+                                              strict_glue_format))
 
     log.info("Wrote predictions for task: %s", task_name)
 
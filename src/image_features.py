@@ -0,0 +1,131 @@
+""" Memory-mapped store of precomputed image features.
+
+Image features for grounded tasks come as one JSON file per image,
+<feat_dir>/<img_id>.json, holding {name: [[feature vector]]}. Reading these
+per example is slow, so the first ImageFeatureStore for a directory converts
+them into <feat_dir>.store/:
+    feats.npy  [num_images, d] matrix of features (float32 or float16)
+    ids.npy    sorted image ids; row i of feats.npy is image ids[i]
+    meta.json  dtype, and the signature of the JSON directory it was built from
+which is then memory-mapped. The store is rebuilt if the JSON directory
+changes, or if a different dtype is requested.
+"""
+import os
+import json
+import shutil
+import logging as log
+
+import numpy as np
+import torch
+
+STORE_SUFFIX = ".store"
+FEAT_DTYPES = ["float32", "float16"]
+
+
+def _list_feature_files(feat_dir):
+    return [name for name in os.listdir(feat_dir) if name.endswith(".json")]
+
+
+def _source_signature(feat_dir, names):
+    return {'n_files': len(names), 'mtime_ns': os.stat(feat_dir).st_mtime_ns}
+
+
+def _load_json_feature(path):
+    with open(path) as fd:
+        feat_dict = json.load(fd)
+    feat = np.asarray(feat_dict[list(feat_dict.keys())[0]], dtype=np.float32)  # has one key
+    return feat[0]
+
+
+def _store_is_current(store_dir, feat_dir, dtype):
+    try:
+        with open(os.path.join(store_dir, "meta.json")) as fd:
+            meta = json.load(fd)
+    except (IOError, ValueError):
+        return False
+    if meta['dtype'] != dtype:
+        return False
+    if not os.path.isdir(feat_dir):
+        # Features were converted, and the JSON files since removed.
+        return True
+    return meta['source'] == _source_signature(feat_dir, _list_feature_files(feat_dir))
+
+
+def build_store(feat_dir, store_dir, dtype="float32"):
+    ''' Convert a directory of per-image JSON features into a store. '''
+    names = _list_feature_files(feat_dir)
+    assert names, "No image features found in %s" % feat_dir
+    source = _source_signature(feat_dir, names)
+    ids = np.array([int(os.path.splitext(name)[0]) for name in names], dtype=np.int64)
+    order = np.argsort(ids, kind='mergesort')
+    ids = ids[order]
+    assert len(np.unique(ids)) == len(ids), "Duplicate image ids in %s" % feat_dir
+    log.info("Converting %d image features in %s to %s (%s)", len(names), feat_dir,
+             store_dir, dtype)
+
+    # Build under a temporary name, so that concurrent builders (e.g. several
+    # ranks) and crashes never leave a partial store.
+    tmp_dir = "%s.tmp.%d" % (store_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    feats = None
+    for row, i in enumerate(order):
+        feat = _load_json_feature(os.path.join(feat_dir, names[i]))
+        if feats is None:
+            feats = np.lib.format.open_memmap(os.path.join(tmp_dir, "feats.npy"), mode='w+',
+                                              dtype=np.dtype(dtype),
+                                              shape=(len(names), feat.shape[0]))
+        feats[row] = feat
+        if (row + 1) % 10000 == 0:
+            log.info("\tConverted %d/%d image features", row + 1, len(names))
+    feats.flush()
+    del feats
+    np.save(os.path.join(tmp_dir, "ids.npy"), ids)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as fd:
+        json.dump({'dtype': dtype, 'source': source}, fd)
+
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        # Another process finished first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ImageFeatureStore(object):
+    ''' Image features by image id, from a memory-mapped matrix.
+
+    Args:
+        feat_dir: directory of per-image JSON feature files
+        dtype: storage precision, one of FEAT_DTYPES. Features are always
+            returned as float32.
+    '''
+
+    def __init__(self, feat_dir, dtype="float32"):
+        assert dtype in FEAT_DTYPES, "Unknown image feature dtype: %s" % dtype
+        store_dir = feat_dir.rstrip("/") + STORE_SUFFIX
+        if not _store_is_current(store_dir, feat_dir, dtype):
+            build_store(feat_dir, store_dir, dtype)
+        self._feats = np.load(os.path.join(store_dir, "feats.npy"), mmap_mode='r')
+        self._ids = np.load(os.path.join(store_dir, "ids.npy"))
+        log.info("Loaded %d image features of dimension %d from %s", self._feats.shape[0],
+                 self._feats.shape[1], store_dir)
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def dim(self):
+        return self._feats.shape[1]
+
+    def lookup(self, img_ids):
+        ''' Features for img_ids, as a [len(img_ids), dim] FloatTensor, read with a
+        single gather. '''
+        img_ids = np.asarray(img_ids, dtype=np.int64).reshape(-1)
+        rows = np.searchsorted(self._ids, img_ids)
+        found = (rows < len(self._ids)) & (self._ids[np.minimum(rows, len(self._ids) - 1)] ==
+                                          img_ids)
+        if not found.all():
+            raise KeyError("No image features for ids: %s" % str(img_ids[~found].tolist()))
+        feats = np.asarray(self._feats[rows], dtype=np.float32)
+        return torch.from_numpy(feats)
@@ -0,0 +1,72 @@
+""" Deferred imports for heavy, rarely-needed libraries.
+
+Importing jiant's modules pulls in a lot (AllenNLP, NLTK, scikit-learn,
+SciPy, torchvision, h5py, pandas...), and much of it is only used by a few
+tasks or code paths. Importing those with lazy_import() keeps startup fast
+for the runs that don't need them:
+
+    h5py = lazy_import("h5py")  # nothing imported yet
+    ...
+    with h5py.File(path) as fin:  # h5py imported here, on first use
+
+A library that isn't installed only raises ImportError when first used.
+See benchmarks/import_benchmark.py for startup timings.
+"""
+import importlib
+import types
+
+
+class _LazyModule(types.ModuleType):
+    ''' Stands in for a module until one of its attributes is used. '''
+
+    def __init__(self, name):
+        super(_LazyModule, self).__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self.__dict__['_module']
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found normally, i.e. the module's contents.
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    ''' A proxy for module name, which is imported the first time one of its
+    attributes is accessed. '''
+    return _LazyModule(name)
+
+
+class _LazyObject(object):
+    ''' Stands in for the result of factory() until it's used. '''
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_obj', None)
+
+    def _load(self):
+        if self._obj is None:
+            object.__setattr__(self, '_obj', self._factory())
+        return self._obj
+
+    @property
+    def __class__(self):
+        # So that isinstance() and type names see the real object.
+        return self._load().__class__
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+
+def lazy_object(factory):
+    ''' A proxy for factory(), which is called the first time the object is used,
+    e.g. for module-level instances of classes from heavy libraries. '''
+    return _LazyObject(factory)
@@ -0,0 +1,119 @@
+""" Fast, cached line counts for large text files.
+
+Tasks that stream their data (language modeling, Reddit, MT...) count their
+examples by counting the lines in each split's file, and those files can be
+several GB. count_lines scans a file in large chunks through mmap, and caches
+the count keyed by the file's size and modification time, so that a file is
+only scanned again if it changes. With set_cache_file, the cache is also kept
+on disk, across runs. count_lines_by_split scans a task's files in parallel,
+in worker processes, since scanning holds the GIL.
+
+Line counts can differ from the number of examples load_data yields, since
+it skips some lines. The exact number of examples is recorded when a split is
+indexed (see serialize.read_record_count), and replaces these counts.
+"""
+import os
+import json
+import mmap
+import logging as log
+from concurrent.futures import ProcessPoolExecutor
+
+_CHUNK_SIZE = 1 << 24  # bytes scanned at a time
+# Only start worker processes if there's at least this much to scan.
+_MIN_PARALLEL_BYTES = 1 << 26
+
+_cache = {}  # absolute path -> (size, mtime_ns, line count)
+_cache_file = None
+_cache_changed = False
+
+
+def _scan_lines(path):
+    ''' Number of lines in path, as from sum(1 for line in open(path)): the number
+    of newlines, plus one if the last line doesn't end with one. '''
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return 0  # can't mmap an empty file
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            count = sum(mm[start:start + _CHUNK_SIZE].count(b'\n')
+                        for start in range(0, size, _CHUNK_SIZE))
+            if mm[size - 1:size] != b'\n':
+                count += 1
+    return count
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _cached_count(path, key):
+    cached = _cache.get(path)
+    if cached is not None and tuple(cached[:2]) == key:
+        return cached[2]
+    return None
+
+
+def _save_cache():
+    ''' Write the cache to _cache_file, if set and if anything was counted. '''
+    global _cache_changed
+    if _cache_file is None or not _cache_changed:
+        return
+    _cache_changed = False
+    tmp_file = "%s.tmp.%d" % (_cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as fd:
+            json.dump(_cache, fd)
+        os.replace(tmp_file, _cache_file)
+    except OSError as e:
+        log.warning("Couldn't save line counts to %s: %s", _cache_file, e)
+
+
+def set_cache_file(path):
+    ''' Keep cached line counts in path (JSON), and load any already there. '''
+    global _cache_file
+    _cache_file = path
+    if not os.path.isfile(path):
+        return
+    try:
+        with open(path) as fd:
+            cached = json.load(fd)
+    except ValueError:
+        log.warning("Ignoring unreadable line count cache %s", path)
+        return
+    for file_path, entry in cached.items():
+        _cache.setdefault(file_path, tuple(entry))
+
+
+def count_lines(path):
+    ''' Number of lines in the file at path, counted once per version of the file. '''
+    return count_lines_by_split({None: path})[None]
+
+
+def count_lines_by_split(files_by_split, max_workers=None):
+    ''' Count lines in each split's file. Files that aren't cached are scanned in
+    parallel, if there's enough to scan to be worth starting worker processes.
+
+    Args:
+        files_by_split: dict of split name -> file path
+        max_workers: most files to scan at once; defaults to the number of CPUs
+
+    Returns:
+        dict of split name -> number of lines
+    '''
+    global _cache_changed
+    paths = {split: os.path.abspath(path) for split, path in files_by_split.items()}
+    keys = {path: _file_key(path) for path in set(paths.values())}
+    to_scan = sorted(path for path, key in keys.items()
+                     if _cached_count(path, key) is None)
+    max_workers = min(max_workers or os.cpu_count() or 1, len(to_scan))
+    if max_workers > 1 and sum(keys[path][0] for path in to_scan) >= _MIN_PARALLEL_BYTES:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            counts = list(pool.map(_scan_lines, to_scan))
+    else:
+        counts = [_scan_lines(path) for path in to_scan]
+    for path, count in zip(to_scan, counts):
+        _cache[path] = keys[path] + (count,)
+        _cache_changed = True
+    _save_cache()
+    return {split: _cache[path][2] for split, path in paths.items()}
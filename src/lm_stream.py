@@ -0,0 +1,203 @@
+""" Packed token streams for language modeling.
+
+Normally, each line of an LM corpus is a separate example, padded to the
+longest sentence in its batch. With lm_packed_stream, a split is instead
+indexed once into one contiguous stream of token ids (<SOS> sent1 <EOS>
+<SOS> sent2 <EOS> ...), stored as raw int32 in
+<exp_dir>/preproc/<task>__<split>_stream.bin and memory-mapped. Batches are
+fixed-length windows of the stream, so there is no padding, and windows
+run across sentence boundaries. Forward and backward targets are the
+window shifted by one token either way.
+
+The ids are into the stream's own list of distinct tokens, saved next to it
+(<stream>.types.json), not into the word vocabulary. Every input indexer
+(words, ELMo characters, trained characters) is applied to each distinct
+token once, so that batches are built by table lookups. As for indexed
+instances, tokens outside the word vocabulary are <unk> for the words
+input and the targets, but keep their own spelling for character inputs.
+
+Usage:
+    write_token_stream(task.load_data(path, max_seq_len=sys.maxsize), stream_path)
+    stream = TokenStream(stream_path, seq_len, vocab, indexers)
+    for batch in stream.batches(batch_size, num_epochs=1):
+        model.forward(task, batch)
+"""
+import os
+import json
+import logging as log
+
+import numpy as np
+import torch
+
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+from allennlp.data.tokenizers import Token
+
+# Tokens to buffer before writing to the stream file.
+_WRITE_BUFFER_TOKENS = 2**20
+# Key of the word ids (for targets) in the tables from build_input_tables.
+TARGETS_TABLE = "_targets"
+
+
+def _types_path(path):
+    # Next to the stream itself, which may be a symlink to a shared cache.
+    return os.path.realpath(path) + ".types.json"
+
+
+def is_complete(path):
+    ''' Whether path is a stream, with its list of token types, as written by
+    write_token_stream. (Streams written before the type lists are indexed
+    into the word vocabulary, and need to be rewritten.) '''
+    return os.path.isfile(path) and os.path.isfile(_types_path(path))
+
+
+def write_token_stream(sentences, path):
+    ''' Write sentences (lists of tokens), in order, as one stream of int32 ids
+    into a list of the distinct tokens in them, which is saved next to the
+    stream. Returns the number of tokens written. '''
+    tmp_path = "%s.tmp.%d" % (path, os.getpid())
+    type_ids = {}
+    n_tokens, n_sents = 0, 0
+    buffer = []
+    with open(tmp_path, 'wb') as fd:
+        for sent in sentences:
+            buffer.extend(type_ids.setdefault(tok, len(type_ids)) for tok in sent)
+            n_sents += 1
+            if len(buffer) >= _WRITE_BUFFER_TOKENS:
+                np.asarray(buffer, dtype=np.int32).tofile(fd)
+                n_tokens += len(buffer)
+                buffer = []
+        np.asarray(buffer, dtype=np.int32).tofile(fd)
+        n_tokens += len(buffer)
+    # Write under temporary names, so that a crash never leaves a partial stream.
+    # The types go first: a stream is only complete once both are in place.
+    types_path = _types_path(path)
+    tmp_types_path = "%s.tmp.%d" % (types_path, os.getpid())
+    with open(tmp_types_path, 'w') as fd:
+        json.dump(sorted(type_ids, key=type_ids.get), fd)
+    os.replace(tmp_types_path, types_path)
+    os.replace(tmp_path, path)
+    log.info("Wrote %d sentences (%d tokens, %d distinct) to %s", n_sents, n_tokens,
+             len(type_ids), path)
+    return n_tokens
+
+
+def build_input_tables(types, vocab, indexers, namespace="tokens"):
+    ''' Index each of types (a list of token strings) with each of indexers.
+
+    Returns a dict of indexer name -> table, where row i of the table is the
+    indices of types[i], or (for single-id indexers) entry i is its index. Also
+    returns the word ids of types, for targets, under TARGETS_TABLE. '''
+    tables = {TARGETS_TABLE: np.array([vocab.get_token_index(tok, namespace) for tok in types],
+                                      dtype=np.int64)}
+    for name, indexer in indexers.items():
+        rows = [indexer.token_to_indices(Token(tok), vocab) for tok in types]
+        if isinstance(indexer, SingleIdTokenIndexer):
+            tables[name] = np.array(rows, dtype=np.int64).reshape(len(rows))
+            continue
+        # Characters: int32 is plenty, and halves the size of tables over large corpora.
+        table = np.zeros((len(rows), max([len(row) for row in rows] or [1])), dtype=np.int32)
+        for i, row in enumerate(rows):
+            table[i, :len(row)] = row
+        tables[name] = table
+    return tables
+
+
+class TokenStream(object):
+    ''' A memory-mapped stream of token ids, served as [batch_size, seq_len] windows.
+
+    The stream is split into consecutive windows of seq_len tokens. Each window
+    also needs the token before it and the token after it (for the backward and
+    forward targets), so the first and last tokens of the stream are never
+    inputs. len() is the number of windows.
+
+    Args:
+        path: stream file, from write_token_stream
+        seq_len: window length, in tokens
+        vocab: Vocabulary, for the words input and the targets
+        indexers: dict of input indexers, as for indexing instances
+    '''
+
+    def __init__(self, path, seq_len, vocab, indexers):
+        assert seq_len > 0, "Window length should be positive!"
+        assert is_complete(path), "Token stream %s is incomplete or outdated!" % path
+        self._path = path
+        self._seq_len = seq_len
+        with open(_types_path(path)) as fd:
+            types = json.load(fd)
+        self._input_tables = build_input_tables(types, vocab, indexers)
+        self._targets_table = self._input_tables.pop(TARGETS_TABLE)
+        if os.path.getsize(path) > 0:
+            self._tokens = np.memmap(path, dtype=np.int32, mode='r')
+        else:
+            self._tokens = np.zeros(0, dtype=np.int32)
+        self._n_windows = max(len(self._tokens) - 2, 0) // seq_len
+        log.info("Loaded %d tokens (%d windows of %d) from %s", len(self._tokens),
+                 self._n_windows, seq_len, path)
+
+    def __len__(self):
+        return self._n_windows
+
+    def __deepcopy__(self, memo):
+        # Read-only, so copies of a task can share it (rather than copy the map).
+        return self
+
+    @property
+    def n_tokens(self):
+        return len(self._tokens)
+
+    def _make_batch(self, windows, cuda_device):
+        # One gather of each window with a token of context on either side.
+        starts = 1 + windows * self._seq_len
+        offsets = np.arange(-1, self._seq_len + 1)
+        context = np.asarray(self._tokens[starts[:, None] + offsets], dtype=np.int64)
+        ids = context[:, 1:-1]
+
+        inputs = {}
+        for name, table in self._input_tables.items():
+            if table.ndim == 1:
+                inputs[name] = table[ids]
+                continue
+            rows = table[ids]
+            # Pad only to the longest row in the batch, as the indexers would.
+            used = np.flatnonzero(rows.any(axis=(0, 1)))
+            inputs[name] = rows[:, :, :used[-1] + 1 if len(used) else 1].astype(np.int64)
+        word_ids = self._targets_table[context]
+        batch = {'input': inputs,
+                 'targs': {'words': word_ids[:, 2:]},  # next token
+                 'targs_b': {'words': word_ids[:, :-2]}}  # previous token
+
+        def _to_tensor(array):
+            tensor = torch.from_numpy(np.ascontiguousarray(array))
+            return tensor.cuda(cuda_device) if cuda_device >= 0 else tensor
+        return {field: {name: _to_tensor(array) for name, array in arrays.items()}
+                for field, arrays in batch.items()}
+
+    def batches(self, batch_size, num_epochs=None, shuffle=False, cuda_device=-1,
+                max_windows=None, shard=None, seed=None):
+        ''' Yield batches of windows, as dicts of tensors in the same format as
+        the batches of indexed LM instances.
+
+        Args:
+            batch_size: windows per batch. The last batch of an epoch may be smaller.
+            num_epochs: passes over the windows, or None to repeat forever
+            shuffle: if set, visit windows in a new random order each epoch
+            cuda_device: GPU to put batches on, or -1 for CPU
+            max_windows: use only the first max_windows windows
+            shard: if set to (index, num_shards), use only every num_shards-th
+                window, starting from index
+            seed: if set (with shuffle), seed for the order of windows, which
+                is then the same every time
+        '''
+        windows = np.arange(self._n_windows if max_windows is None
+                            else min(max_windows, self._n_windows))
+        if shard is not None:
+            windows = windows[shard[0]::shard[1]]
+        rng = np.random.RandomState(seed) if seed is not None else np.random
+        epoch = 0
+        while num_epochs is None or epoch < num_epochs:
+            order = rng.permutation(windows) if shuffle else windows
+            for start in range(0, len(order), batch_size):
+                yield self._make_batch(order[start:start + batch_size], cuda_device)
+            epoch += 1
+            if not len(windows):
+                return
@@ -11,12 +11,11 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 from torch.autograd import Variable
-from sklearn.metrics import mean_squared_error
 
 from allennlp.common import Params
 from allennlp.modules import Elmo, Seq2SeqEncoder, SimilarityFunction, TimeDistributed
 from allennlp.nn import util
-from allennlp.modules.token_embedders import Embedding, TokenCharactersEncoder
+from allennlp.modules.token_embedders import Embedding
 from allennlp.modules.seq2vec_encoders import CnnEncoder
 from allennlp.modules.seq2seq_encoders import Seq2SeqEncoder as s2s_e
 from allennlp.modules.seq2seq_encoders import StackedSelfAttentionEncoder
@@ -25,6 +24,7 @@ from allennlp.training.metrics import Average
 from .allennlp_mods.elmo_text_field_embedder import ElmoTextFieldEmbedder, ElmoTokenEmbedderWrapper
 from .utils import get_batch_utilization, get_elmo_mixing_weights
 from . import config
+from .lazy import lazy_import
 from . import edge_probing
 
 from .tasks import CCGTaggingTask, ClassificationTask, CoLATask, EdgeProbingTask, GroundedSWTask, \
@@ -37,12 +37,14 @@ from .modules import SentenceEncoder, BoWSentEncoder, \
     AttnPairEncoder, MaskedStackedSelfAttentionEncoder, \
     BiLMEncoder, ElmoCharacterEncoder, Classifier, Pooler, \
     SingleClassifier, PairClassifier, CNNEncoder, \
-    NullPhraseLayer
+    NullPhraseLayer, DedupTokenCharactersEncoder
 
 from .utils import assert_for_log, get_batch_utilization, get_batch_size
 from .preprocess import parse_task_list_arg, get_tasks
 from .seq2seq_decoder import Seq2SeqDecoder
 
+sklearn_metrics = lazy_import("sklearn.metrics")
+
 
 # Elmo stuff
 # Look in $ELMO_SRC_DIR (e.g. /usr/share/jsalt/elmo) or download from web
@@ -253,8 +255,8 @@ def build_embeddings(args, vocab, tasks, pretrained_embs=None):
         char_encoder = CnnEncoder(d_char, num_filters=args.n_char_filters,
                                   ngram_filter_sizes=filter_sizes,
                                   output_dim=d_char)
-        char_embedder = TokenCharactersEncoder(char_embeddings, char_encoder,
-                                               dropout=args.dropout_embs)
+        char_embedder = DedupTokenCharactersEncoder(char_embeddings, char_encoder,
+                                                    dropout=args.dropout_embs)
         d_emb += d_char
         token_embedders["chars"] = char_embedder
     else:
@@ -305,6 +307,11 @@ def build_embeddings(args, vocab, tasks, pretrained_embs=None):
             elmo_embedder = ElmoCharacterEncoder(options_file=ELMO_OPT_PATH,
                                                  weight_file=ELMO_WEIGHTS_PATH,
                                                  requires_grad=False)
+            if args.elmo_chars_table:
+                # The char CNN is frozen, so embed the whole vocabulary once.
+                words = [vocab.get_token_from_index(i, 'tokens') for i in range(n_token_vocab)]
+                elmo_embedder.load_token_table(words, os.path.join(args.exp_dir,
+                                                                   "elmo_char_table"))
             d_emb += 512
         else:
             log.info("\tUsing full ELMo! (separate scalars/task)")
@@ -390,7 +397,8 @@ def build_module(task, model, d_sent, d_emb, vocab, embedder, args):
         setattr(model, '%s_hid2voc' % task.name, hid2voc)
 
     elif isinstance(task, (GroundedTask, GroundedSWTask)):
-        task.img_encoder = CNNEncoder(model_name='resnet', path=task.path)
+        task.img_encoder = CNNEncoder(model_name='resnet', path=task.path,
+                                      feat_dtype=task_params['img_feat_dtype'])
         pooler = build_image_sent_module(task, d_sent, task_params)
         setattr(model, '%s_mdl' % task.name, pooler)
     elif isinstance(task, RankingTask):
@@ -417,6 +425,8 @@ def get_task_specific_params(args, task_name):
     params['cls_type'] = _get_task_attr("classifier")
     params['d_hid'] = _get_task_attr("classifier_hid_dim")
     params['d_proj'] = _get_task_attr("d_proj")
+    # Used for grounded tasks. Other tasks can safely ignore.
+    params['img_feat_dtype'] = _get_task_attr("img_feat_dtype")
     params['shared_pair_attn'] = args.shared_pair_attn
     if args.shared_pair_attn:
         params['attn'] = args.pair_attn
@@ -734,7 +744,7 @@ class MultiTaskModel(nn.Module):
                 out['loss'] = F.mse_loss(logits, labels)
                 logits_np = logits.data.cpu().numpy()
                 labels_np = labels.data.cpu().numpy()
-                task.scorer1(mean_squared_error(logits_np, labels_np))
+                task.scorer1(sklearn_metrics.mean_squared_error(logits_np, labels_np))
                 task.scorer2(logits_np, labels_np)
             elif isinstance(task, STSBTask):
                 logits = logits.squeeze(-1) if len(logits.size()) > 1 else logits
@@ -902,7 +912,10 @@ class MultiTaskModel(nn.Module):
         return out
 
     def _grounded_forward(self, batch, task, predict):
-        out, img_seq = {}, []
+        ''' Contrastive (InfoNCE) loss: each sentence should score its own image above
+            randomly sampled other images from the batch.
+        '''
+        out = {}
         sent_emb, sent_mask = self.sent_encoder(batch['input1'], task)
         batch_size = get_batch_size(batch)
         out['n_exs'] = batch_size
@@ -910,45 +923,27 @@ class MultiTaskModel(nn.Module):
 
         sent_rep = sent_pooler(sent_emb, sent_mask)
 
-        ids = batch['ids'].cpu().squeeze(-1).data.numpy().tolist()
-
-        for img_idx in ids:
-            img_rep = task.img_encoder.forward(int(img_idx))[0]
-            img_seq.append(torch.tensor(img_rep, dtype=torch.float32).cuda())
-
-        loss = torch.autograd.Variable(torch.Tensor(1), requires_grad=True) + 0
-        softmax = nn.Softmax(dim=0)
-        cos = nn.CosineSimilarity(dim=1, eps=1e-6)
-        acc = []
-
-        loss_fn = nn.L1Loss()
-        # contrastive against n samples (n = {2, 3}), temperature
-        samples, temp = batch_size - 1, 0.001
-        for sent_idx in range(batch_size):
-            sent = sent_rep[sent_idx].reshape(1, -1).cuda()
-            img = img_seq[sent_idx].reshape(1, -1).cuda()
-            labels = [1] + [0] * (samples - 1)
-            labels = torch.tensor(labels, dtype=torch.float32)
-            mat = [cos(sent, img).cpu().data.numpy()[0]]
-            for _ in range(len(mat), samples):
-                r = sent_idx
-                while (r == sent_idx):
-                    r = np.random.randint(batch_size, size=(1, 1))[0][0]
-                img = img_seq[r].reshape(1, -1).cuda()
-                mat.append(cos(sent, img).cpu().data.numpy()[0])
-
-            mat = torch.tensor(mat, dtype=torch.float32)
-            dist = softmax(Variable(torch.tensor(mat, dtype=torch.float32)))
-
-            max_idx = np.argmax(dist.data.numpy())
-            loss.add(loss_fn(mat, labels))
-
-            preds = [0] * samples
-            preds[max_idx] = 1
-            acc.append(1 if max_idx == 0 else 0)
-
-        out['loss'] = loss
-        task.scorer1(np.mean(acc))
+        ids = batch['ids'].cpu().squeeze(-1).data.numpy()
+        img_seq = task.img_encoder.get_features(ids).to(sent_rep.device)  # [batch_size, d]
+
+        # Cosine similarity of every sentence with every image: [batch_size, batch_size]
+        sim = torch.mm(F.normalize(sent_rep, 2, 1), F.normalize(img_seq, 2, 1).t())
+
+        # contrastive against n samples (n = batch_size - 2), temperature
+        n_negatives = batch_size - 2 if batch_size > 2 else batch_size - 1
+        temp = 0.07
+        rows = torch.arange(batch_size, dtype=torch.long, device=sim.device)
+        # Offsets in [1, batch_size) never pick the sentence's own image.
+        offsets = torch.randint(1, max(batch_size, 2), (batch_size, n_negatives),
+                                dtype=torch.long, device=sim.device)
+        candidates = torch.cat([rows.unsqueeze(1), (rows.unsqueeze(1) + offsets) % batch_size],
+                               dim=1)  # positive image first
+        logits = sim.gather(1, candidates) / temp
+
+        targets = torch.zeros(batch_size, dtype=torch.long, device=sim.device)
+        out['loss'] = F.cross_entropy(logits, targets)
+        acc = (logits.argmax(dim=1) == targets).float().mean()
+        task.scorer1(acc.item())
         return out
 
     def _grounded_ranking_bce_forward(self, batch, task, predict):
@@ -963,14 +958,8 @@ class MultiTaskModel(nn.Module):
         sent_pooler = self._get_classifier(task)
         sent_rep = sent_pooler(sent_emb, sent_mask)
         loss_fn = nn.L1Loss()
-        ids = batch['ids'].cpu().squeeze(-1).data.numpy().tolist()
-        img_seq = []
-
-        for img_idx in ids:
-            img_rep = task.img_encoder.forward(int(img_idx))[0]
-            img_seq.append(torch.tensor(img_rep, dtype=torch.float32).cuda())
-
-        img_emb = torch.stack(img_seq, dim=0)
+        ids = batch['ids'].cpu().squeeze(-1).data.numpy()
+        img_emb = task.img_encoder.get_features(ids).to(sent_rep.device)  # [batch_size, d]
         sent1_rep = sent_rep
         sent2_rep = img_emb
 
@@ -981,10 +970,10 @@ class MultiTaskModel(nn.Module):
 
         scale = 1 / (len(mat_mul) - 1) if len(mat_mul) > 1 else 1
         weights = scale * torch.ones(mat_mul.shape) - (scale - 1) * torch.eye(len(mat_mul))
-        weights = weights.view(-1).cuda()
+        weights = weights.view(-1).to(mat_mul.device)
 
         mat_mul = mat_mul.view(-1)
-        labels = labels.view(-1).cuda()
+        labels = labels.view(-1).to(mat_mul.device)
         pred = torch.sigmoid(mat_mul).round()
 
         out['loss'] = loss_fn(mat_mul, labels)
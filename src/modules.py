@@ -4,20 +4,17 @@ The main component of interest is SentenceEncoder, which all the models use. '''
 import os
 import sys
 import json
+import shutil
+import hashlib
 import logging as log
-import h5py
 
 import numpy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from scipy.stats import pearsonr, spearmanr
-from sklearn.metrics import matthews_corrcoef
 
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.datasets as datasets
-import torchvision.transforms as transforms
 
 from allennlp.common import Params
 from allennlp.common.file_utils import cached_path
@@ -28,7 +25,8 @@ from allennlp.modules.matrix_attention import DotProductMatrixAttention
 from allennlp.modules import Seq2SeqEncoder, SimilarityFunction, TimeDistributed
 from allennlp.nn import util, InitializerApplicator
 from allennlp.nn.util import add_sentence_boundary_token_ids
-from allennlp.modules.token_embedders import Embedding
+
+from allennlp.modules.token_embedders import Embedding, TokenCharactersEncoder
 from allennlp.modules.elmo_lstm import ElmoLstm
 from allennlp.data.token_indexers.elmo_indexer import ELMoCharacterMapper, ELMoTokenCharactersIndexer
 from allennlp.modules.seq2vec_encoders import CnnEncoder
@@ -41,6 +39,13 @@ from allennlp.nn.util import add_positional_features
 
 from .utils import MaskedMultiHeadSelfAttention, assert_for_log
 from . import utils
+from .image_features import ImageFeatureStore
+from .lazy import lazy_import
+
+# Only needed for ELMo weight files and image tasks, respectively.
+h5py = lazy_import("h5py")
+datasets = lazy_import("torchvision.datasets")
+transforms = lazy_import("torchvision.transforms")
 
 from .cnns.alexnet import alexnet
 from .cnns.resnet import resnet101
@@ -574,6 +579,26 @@ class MaskedStackedSelfAttentionEncoder(Seq2SeqEncoder):
                    dropout_prob=dropout_prob)
 
 
+class DedupTokenCharactersEncoder(TokenCharactersEncoder):
+    ''' A TokenCharactersEncoder that encodes each distinct token in a batch only once, and
+    copies the results to every position the token occurs in (padding included, so outputs
+    are the same as TokenCharactersEncoder's). Gradients from all occurrences of a token
+    are summed by the copy's backward pass. Dropout is still applied per position. '''
+
+    def forward(self, token_characters):  # pylint: disable=arguments-differ
+        n_chars = token_characters.size(-1)
+        char_ids = token_characters.data.view(-1, n_chars).cpu().numpy()
+        unique_ids, inverse = numpy.unique(char_ids, axis=0, return_inverse=True)
+        unique_chars = torch.from_numpy(unique_ids).to(token_characters.device).unsqueeze(0)
+        mask = (unique_chars != 0).long()
+        # (1, n_unique_tokens, encoding_dim)
+        encoded = self._encoder(self._embedding(unique_chars), mask)
+        inverse = torch.from_numpy(inverse.reshape(-1)).to(token_characters.device)
+        encoded = encoded.squeeze(0).index_select(0, inverse)
+        encoded = encoded.view(*(list(token_characters.size()[:-1]) + [-1]))
+        return self._dropout(encoded)
+
+
 class ElmoCharacterEncoder(torch.nn.Module):
     """Just the ELMo character encoder that we ripped so we could use alone.
 
@@ -637,9 +662,110 @@ class ElmoCharacterEncoder(torch.nn.Module):
             numpy.array(ELMoCharacterMapper.end_of_sentence_characters) + 1
         )
 
+        # Precomputed token embeddings; see load_token_table().
+        self._table = None
+
     def get_output_dim(self):
         return self.output_dim
 
+    def load_token_table(self, words, cache_dir, batch_size=4096):
+        '''
+        Precompute the embeddings of words, so that forward() just looks them up.
+        Tokens not in the table are still encoded on the fly. The table is cached in
+        cache_dir, and rebuilt if the words or the weight file change. Only for a
+        frozen encoder, since its outputs are then context independent and fixed.
+        '''
+        assert not self.requires_grad, "Can't precompute embeddings of a trainable char CNN."
+        max_chars_per_token = self._options['char_cnn']['max_characters_per_token']
+        # Rows of character ids, as from ELMoTokenCharactersIndexer, plus padding tokens.
+        char_ids = numpy.array([ELMoCharacterMapper.convert_word_to_char_ids(word) for word in words] +
+                               [[0] * max_chars_per_token], dtype=numpy.int64)
+        # Sort by hash key, for lookup with searchsorted. Rows whose keys collide with an
+        # earlier row (or are duplicates, e.g. after truncation) are left to the fallback.
+        char_ids = numpy.unique(char_ids, axis=0)
+        hash_weights = numpy.random.RandomState(0).randint(1, 2 ** 40, size=max_chars_per_token,
+                                                           dtype=numpy.int64)
+        keys = char_ids.dot(hash_weights)
+        order = numpy.argsort(keys, kind='mergesort')
+        char_ids, keys = char_ids[order], keys[order]
+        unique_keys = numpy.concatenate([[True], keys[1:] != keys[:-1]])
+        char_ids, keys = char_ids[unique_keys], keys[unique_keys]
+
+        signature = hashlib.sha1(char_ids.tobytes() + str(self._weight_file).encode('utf-8')).hexdigest()
+        embs_file = os.path.join(cache_dir, "embeddings.npy")
+        try:
+            with open(os.path.join(cache_dir, "meta.json")) as fd:
+                cached = json.load(fd)['signature'] == signature
+        except (IOError, ValueError, KeyError):
+            cached = False
+        if cached:
+            embs = numpy.load(embs_file)
+            log.info("Loaded ELMo char CNN embeddings of %d tokens from %s", len(embs), cache_dir)
+        else:
+            log.info("Precomputing ELMo char CNN embeddings of %d tokens", len(char_ids))
+            device = self._char_embedding_weights.device
+            with torch.no_grad():
+                embs = numpy.concatenate([
+                    self._embed_char_ids(torch.from_numpy(char_ids[i:i + batch_size]).to(device))
+                    .cpu().numpy() for i in range(0, len(char_ids), batch_size)])
+            # Write under a temporary name, so concurrent runs never see a partial table.
+            tmp_dir = "%s.tmp.%d" % (cache_dir.rstrip("/"), os.getpid())
+            os.makedirs(tmp_dir, exist_ok=True)
+            numpy.save(os.path.join(tmp_dir, "embeddings.npy"), embs)
+            with open(os.path.join(tmp_dir, "meta.json"), 'w') as fd:
+                json.dump({'signature': signature, 'weight_file': str(self._weight_file),
+                           'n_tokens': len(char_ids)}, fd)
+            if os.path.isdir(cache_dir):
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            try:
+                os.rename(tmp_dir, cache_dir)
+            except OSError:  # another process finished first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            log.info("Saved ELMo char CNN embeddings to %s", cache_dir)
+
+        with torch.no_grad():
+            boundary_ids = torch.stack([self._end_of_sentence_characters]).to(
+                self._char_embedding_weights.device)
+            eos_embedding = self._embed_char_ids(boundary_ids)[0].cpu()
+        self._table = {'keys': keys, 'char_ids': char_ids, 'hash_weights': hash_weights,
+                       'embeddings': torch.from_numpy(embs), 'eos': eos_embedding}
+
+    def _get_table_embeddings(self, device):
+        # Kept out of the state dict (so out of checkpoints); moved to the input's device on demand.
+        if self._table['embeddings'].device != device:
+            self._table['embeddings'] = self._table['embeddings'].to(device)
+            self._table['eos'] = self._table['eos'].to(device)
+        return self._table['embeddings']
+
+    def _forward_from_table(self, inputs):
+        ''' Same as forward(), but looking up precomputed embeddings. '''
+        table = self._table
+        batch_size, sequence_length, max_chars_per_token = inputs.size()
+        char_ids = inputs.data.view(-1, max_chars_per_token).cpu().numpy().astype(numpy.int64)
+        keys = char_ids.dot(table['hash_weights'])
+        rows = numpy.minimum(numpy.searchsorted(table['keys'], keys), len(table['keys']) - 1)
+        found = (table['keys'][rows] == keys) & (table['char_ids'][rows] == char_ids).all(axis=1)
+
+        embeddings = self._get_table_embeddings(inputs.device)
+        token_embedding = embeddings.index_select(0, torch.from_numpy(rows).to(inputs.device))
+        if not found.all():
+            # Encode each distinct out-of-table token once.
+            oov_ids, inverse = numpy.unique(char_ids[~found], axis=0, return_inverse=True)
+            oov_embedding = self._embed_char_ids(torch.from_numpy(oov_ids).to(inputs.device))
+            token_embedding = token_embedding.index_copy(
+                0, torch.from_numpy(numpy.nonzero(~found)[0]).to(inputs.device),
+                oov_embedding.index_select(0, torch.from_numpy(inverse.reshape(-1)).to(inputs.device)))
+
+        # As in forward(), the position right after each sequence gets the </S> embedding.
+        lengths = ((inputs > 0).long().sum(dim=-1) > 0).long().sum(dim=-1)
+        short = (lengths < sequence_length).nonzero().view(-1)
+        if short.numel() > 0:
+            eos_positions = short * sequence_length + lengths.index_select(0, short)
+            token_embedding = token_embedding.index_copy(
+                0, eos_positions, table['eos'].unsqueeze(0).expand(short.numel(), -1))
+
+        return token_embedding.view(batch_size, sequence_length, -1)
+
     def forward(self, inputs):  # pylint: disable=arguments-differ
         """
         Compute context insensitive token embeddings for ELMo representations.
@@ -659,6 +785,9 @@ class ElmoCharacterEncoder(torch.nn.Module):
         ``'mask'``:  ``torch.Tensor``
             Shape ``(batch_size, sequence_length + 2)`` long tensor with sequence mask.
         """
+        if self._table is not None:
+            return self._forward_from_table(inputs)
+
         # Add BOS/EOS
         mask = ((inputs > 0).long().sum(dim=-1) > 0).long()
         character_ids_with_bos_eos, mask_with_bos_eos = add_sentence_boundary_token_ids(
@@ -668,11 +797,24 @@ class ElmoCharacterEncoder(torch.nn.Module):
             self._end_of_sentence_characters
         )
 
-        # the character id embedding
         max_chars_per_token = self._options['char_cnn']['max_characters_per_token']
-        # (batch_size * sequence_length, max_chars_per_token, embed_dim)
+        token_embedding = self._embed_char_ids(
+            character_ids_with_bos_eos.view(-1, max_chars_per_token))
+
+        # reshape to (batch_size, sequence_length, embedding_dim)
+        batch_size, sequence_length, _ = character_ids_with_bos_eos.size()
+
+        return token_embedding.view(batch_size, sequence_length, -1)[:, 1:-1, :]
+
+    def _embed_char_ids(self, char_ids):
+        '''
+        Run the char CNN, highway layers and projection on char_ids, a
+        (n_tokens, max_chars_per_token) tensor, and return (n_tokens, embedding_dim).
+        '''
+        # the character id embedding
+        # (n_tokens, max_chars_per_token, embed_dim)
         character_embedding = torch.nn.functional.embedding(
-            character_ids_with_bos_eos.view(-1, max_chars_per_token),
+            char_ids,
             self._char_embedding_weights
         )
 
@@ -703,12 +845,7 @@ class ElmoCharacterEncoder(torch.nn.Module):
         token_embedding = self._highways(token_embedding)
 
         # final projection  (batch_size * sequence_length, embedding_dim)
-        token_embedding = self._projection(token_embedding)
-
-        # reshape to (batch_size, sequence_length, embedding_dim)
-        batch_size, sequence_length, _ = character_ids_with_bos_eos.size()
-
-        return token_embedding.view(batch_size, sequence_length, -1)[:, 1:-1, :]
+        return self._projection(token_embedding)
 
     def _load_weights(self):
         self._load_char_embedding()
@@ -810,13 +947,15 @@ class ElmoCharacterEncoder(torch.nn.Module):
 class CNNEncoder(Model):
     ''' Given an image, get image features from last layer of specified CNN
         e.g., Resnet101, AlexNet, InceptionV3
-        New! Preprocessed and indexed image features, so just load from json!'''
+        New! Preprocessed and indexed image features, so just load them! The per-image
+        json files are converted once to a memory-mapped ImageFeatureStore.'''
 
-    def __init__(self, model_name, path, model=None):
+    def __init__(self, model_name, path, model=None, feat_dtype="float32"):
         super(CNNEncoder, self).__init__(model_name)
         self.model_name = model_name
         self.model = self._load_model(model_name)
         self.feat_path = path + '/all_feats/'
+        self.feat_store = ImageFeatureStore(self.feat_path, dtype=feat_dtype)
 
     def _load_model(self, model_name):
         if model_name == 'alexnet':
@@ -858,11 +997,16 @@ class CNNEncoder(Model):
             feat_dict[rev_class[i]] = x.data
         return feat_dict
 
+    def get_features(self, img_ids):
+        '''
+        Args: img_ids that map image -> sentence pairs in respective datasets.
+        Returns: [len(img_ids), d] FloatTensor of image features.
+        '''
+        return self.feat_store.lookup(img_ids)
+
     def forward(self, img_id):
         '''
         Args: img_id that maps image -> sentence pairs in respective datasets.
+        Returns: [1, d] array of image features.
         '''
-
-        with open(self.feat_path + str(img_id) + '.json') as fd:
-            feat_dict = json.load(fd)
-        return feat_dict[list(feat_dict.keys())[0]]  # has one key
+        return self.get_features([img_id]).numpy()
@@ -0,0 +1,153 @@
+""" Train the task-specific models for several eval tasks at once, in worker processes.
+
+Normally, train_for_eval trains each eval task's model in turn, on top of the
+shared (frozen) sentence encoder. With train_for_eval_parallel = N, up to N
+tasks are trained at the same time, each in its own process:
+
+1) The parent writes the model's current state (the encoder to train on
+   top of) once, in the indexed checkpoint format, to
+   <run_dir>/eval_workers/model_state_init.th.
+2) Each worker reloads the run's config (params.conf), tasks and vocabulary
+   (all preprocessed already), builds the model, and reads its weights from
+   that checkpoint. It then trains its task's model exactly as the
+   sequential path does, writing checkpoints to <run_dir>/eval_workers/<task>.
+3) The parent loads each task's best parameters from its worker's
+   checkpoint and writes them all to <run_dir>/model_state_eval_best.th.
+   Only the workers' logs are kept.
+
+Workers are spawned rather than forked, so this also works on GPU. All
+workers use the same device; each holds its own copy of the model. On CPU,
+the cores are split between the workers.
+"""
+import os
+import glob
+import random
+import logging as log
+
+import torch
+import torch.multiprocessing as mp
+
+from . import checkpoint
+from . import config
+from .models import build_model
+from .preprocess import build_tasks
+from .trainer import build_trainer, build_trainer_params
+from .utils import assert_for_log, load_model_state, maybe_make_dir
+
+WORKERS_DIR = "eval_workers"
+
+
+def get_elmo_scalars(model):
+    ''' The ELMo scalar mix parameters trained in train_for_eval. Might be empty if there's
+    no ELMo. scalar_mix_0 should always be the pretraining scalars, which aren't trained. '''
+    return [(n, p) for n, p in model.named_parameters() if
+            "scalar_mix" in n and "scalar_mix_0" not in n]
+
+
+def get_task_elmo_scalars(model, task, elmo_scalars):
+    ''' Select the ELMo scalar mix parameters used by task's classifier. '''
+    if not elmo_scalars:
+        return []
+    mix_id = model.sent_encoder._text_field_embedder.task_map[task._classifier_name]
+    return [(n, p) for n, p in elmo_scalars if "scalar_mix_%d." % mix_id in n]
+
+
+def _get_task_prefixes(model, task):
+    ''' Prefixes of the names of the parameters trained for task. '''
+    return ["%s_mdl." % task.name] + \
+        [n for n, _ in get_task_elmo_scalars(model, task, get_elmo_scalars(model))]
+
+
+def _train_task(run_dir, task_name, cuda_device, n_threads, seed):
+    ''' Worker: train task_name's model on top of the initial state, as in the sequential
+    train_for_eval. Returns the path of the task's best checkpoint. '''
+    worker_dir = os.path.join(run_dir, WORKERS_DIR, task_name)
+    maybe_make_dir(worker_dir)
+    log.basicConfig(format='%(asctime)s: %(message)s',
+                    datefmt='%m/%d %I:%M:%S %p', level=log.INFO)
+    log.getLogger().addHandler(log.FileHandler(os.path.join(worker_dir, "log.log")))
+    torch.set_num_threads(n_threads)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    args = config.params_from_file([os.path.join(run_dir, "params.conf")])
+    # Preprocessing was done by the parent; only load its results.
+    args.reload_tasks, args.reload_vocab, args.reload_indexing = 0, 0, 0
+    args.cuda = cuda_device
+    if cuda_device >= 0:
+        torch.cuda.set_device(cuda_device)
+        torch.cuda.manual_seed_all(seed)
+    train_tasks, eval_tasks, vocab, word_embs = build_tasks(args)
+    tasks = sorted(set(train_tasks + eval_tasks), key=lambda x: x.name)
+    model = build_model(args, vocab, word_embs, tasks)
+    load_model_state(model, os.path.join(run_dir, WORKERS_DIR, "model_state_init.th"),
+                     cuda_device, strict=False)
+
+    task = [task for task in eval_tasks if task.name == task_name][0]
+    pred_module = getattr(model, "%s_mdl" % task.name)
+    to_train = get_task_elmo_scalars(model, task, get_elmo_scalars(model)) + \
+        [(n, p) for n, p in pred_module.named_parameters() if p.requires_grad]
+    # Look for <task_name>_<param_name>, then eval_<param_name>
+    params = build_trainer_params(args, task_names=[task.name, 'eval'])
+    trainer, _, opt_params, schd_params = build_trainer(params, model, worker_dir,
+                                                        task.val_metric_decreases)
+    trainer.train([task], task.val_metric, args.batch_size, 1,
+                  args.weighting_method, args.scaling_method,
+                  to_train, opt_params, schd_params,
+                  args.shared_optimizer, load_model=False, phase="eval")
+    return checkpoint.get_path(worker_dir, "model_state", "eval_best.th")
+
+
+def train_eval_tasks_in_parallel(args, model, tasks, n_workers):
+    ''' Train the task-specific models for tasks in up to n_workers processes at once, and
+    load each task's best parameters into model. Also writes them, with the rest of the
+    model's trainable parameters, to <run_dir>/model_state_eval_best.th. '''
+    assert_for_log(not args.distributed,
+                   "train_for_eval_parallel isn't supported with distributed training.")
+    workers_dir = os.path.join(args.run_dir, WORKERS_DIR)
+    maybe_make_dir(workers_dir)
+    prefixes = {task.name: _get_task_prefixes(model, task) for task in tasks}
+    all_prefixes = [p for task in tasks for p in prefixes[task.name]]
+    assert_for_log(len(all_prefixes) == len(set(all_prefixes)),
+                   "Eval tasks share parameters, so can't be trained in parallel. "
+                   "Set train_for_eval_parallel = 0.")
+
+    trainable = [name for name, param in model.named_parameters() if param.requires_grad]
+    model_state = {name: value for name, value in model.state_dict().items()
+                   if name in set(trainable)}
+    checkpoint.save_indexed(checkpoint.snapshot_to_cpu(model_state),
+                            os.path.join(workers_dir, "model_state_init.th"))
+    del model_state
+
+    n_workers = min(n_workers, len(tasks))
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers) if args.cuda < 0 else 1
+    seed = random.randint(1, 10000)
+    log.info("Training %d eval tasks in %d worker processes; logs are in %s/<task>",
+             len(tasks), n_workers, workers_dir)
+    # A fresh process for each task, so that each starts from the same state.
+    pool = mp.get_context('spawn').Pool(n_workers, maxtasksperchild=1)
+    try:
+        results = {task.name: pool.apply_async(_train_task, (args.run_dir, task.name, args.cuda,
+                                                             n_threads, seed))
+                   for task in tasks}
+        best_paths = {task_name: result.get() for task_name, result in results.items()}
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for task in tasks:
+        log.info("Loading best parameters for task %s from %s", task.name, best_paths[task.name])
+        load_model_state(model, best_paths[task.name], args.cuda, strict=False,
+                         prefixes=prefixes[task.name])
+    model_state = {name: value for name, value in model.state_dict().items()
+                   if name in set(trainable)}
+    indexed_prefixes = ["model_state"] if args.checkpoint_format == "indexed" else []
+    checkpoint.write_checkpoint(args.run_dir, "eval_best.th",
+                                [("model_state", checkpoint.snapshot_to_cpu(model_state))],
+                                indexed_prefixes=indexed_prefixes)
+
+    # Everything needed is now in the run's own checkpoint; keep only the workers' logs.
+    os.remove(os.path.join(workers_dir, "model_state_init.th"))
+    for task in tasks:
+        for path in glob.glob(os.path.join(workers_dir, task.name, "*_state_eval_best.th")):
+            os.remove(path)
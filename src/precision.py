@@ -0,0 +1,88 @@
+""" Mixed-precision training support.
+
+Wraps torch.autocast and gradient scaling, which only exist in newer versions
+of PyTorch; on older versions, training falls back to fp32 with a warning.
+Parameters and checkpoints always stay in fp32: autocast only changes the
+precision that eligible ops (matmuls, convolutions, RNNs) run in.
+
+Usage:
+    amp = MixedPrecision("bf16", cuda_device=-1)
+    with amp.autocast():
+        loss = model.forward(task, batch)['loss']
+    amp.backward(loss)
+    amp.unscale_(optimizer)  # before anything that reads gradients
+    amp.step(optimizer)
+"""
+import contextlib
+import logging as log
+
+import torch
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+class MixedPrecision(object):
+    ''' Autocast and (for fp16) dynamic loss scaling for one device.
+
+    Args:
+        precision: one of PRECISIONS. fp16 is only used on GPU; on CPU it falls
+            back to bf16.
+        cuda_device: GPU id, or -1 for CPU
+    '''
+
+    def __init__(self, precision="fp32", cuda_device=-1):
+        assert precision in PRECISIONS, "Unknown precision: %s" % precision
+        self._device_type = "cuda" if cuda_device >= 0 else "cpu"
+        if precision == "fp16" and self._device_type == "cpu":
+            log.warning("fp16 autocast isn't supported on CPU; using bf16.")
+            precision = "bf16"
+        if precision != "fp32" and not hasattr(torch, "autocast"):
+            log.warning("This version of PyTorch (%s) doesn't support autocast; "
+                        "training in fp32.", torch.__version__)
+            precision = "fp32"
+        if precision == "bf16" and self._device_type == "cuda" and \
+                not torch.cuda.is_bf16_supported():
+            log.warning("GPU doesn't support bf16; using fp16.")
+            precision = "fp16"
+        self.precision = precision
+        self._dtype = {"bf16": getattr(torch, "bfloat16", None),
+                       "fp16": torch.float16}.get(precision)
+
+        # bf16 has the same exponent range as fp32, so only fp16 needs loss scaling.
+        self._scaler = None
+        if precision == "fp16":
+            self._scaler = torch.cuda.amp.GradScaler()
+        log.info("Training precision: %s", precision)
+
+    @property
+    def enabled(self):
+        return self.precision != "fp32"
+
+    def autocast(self):
+        if not self.enabled:
+            return _null_context()
+        return torch.autocast(device_type=self._device_type, dtype=self._dtype)
+
+    def backward(self, loss):
+        if self._scaler is not None:
+            loss = self._scaler.scale(loss)
+        loss.backward()
+
+    def unscale_(self, optimizer):
+        ''' Undo loss scaling on optimizer's gradients, in place. Call before
+        clipping or communicating gradients. '''
+        if self._scaler is not None:
+            self._scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        ''' Step optimizer, unless (with loss scaling) gradients overflowed. '''
+        if self._scaler is not None:
+            self._scaler.step(optimizer)
+            self._scaler.update()
+        else:
+            optimizer.step()
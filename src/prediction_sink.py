@@ -0,0 +1,253 @@
+""" Streaming storage for model predictions.
+
+evaluate() appends the prediction columns of each batch to a PredictionSink,
+and the prediction writers in evaluate.py read them back one row at a time.
+Numeric columns are kept in growable NumPy buffers; anything else (strings,
+token lists, per-target arrays for edge probing) in lists. Once more than
+max_rows_in_memory rows are buffered, they are spilled to a temporary file,
+so large test sets don't have to fit in memory.
+
+Rows are read back in 'idx' order. Usually batches already arrive in that
+order, and rows are just read in order; otherwise each spilled run is sorted
+when it's written, and the runs are merged when read (an external merge
+sort).
+"""
+import os
+import heapq
+import pickle
+import shutil
+import tempfile
+import weakref
+import itertools
+import logging as log
+
+import numpy as np
+
+from typing import Dict, Iterator, List, Sequence
+
+from .lazy import lazy_import
+
+pd = lazy_import("pandas")  # only for to_dataframe
+
+# Rows to buffer before spilling to disk.
+MAX_ROWS_IN_MEMORY = 100000
+# Rows per pickled block in a spilled run. A merge holds one block per run.
+_BLOCK_ROWS = 4096
+# Hidden column recording insertion order, to break ties when sorting.
+_ROW_COL = '_row'
+
+
+def _numeric_dtype(values: Sequence):
+    ''' np.int64 or np.float64 if values are all ints or floats (not bools),
+    else None. '''
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))
+           for v in values):
+        return np.dtype(np.int64)
+    if all(isinstance(v, (int, float, np.integer, np.floating)) and
+           not isinstance(v, (bool, np.bool_)) for v in values):
+        return np.dtype(np.float64)
+    return None
+
+
+class _ColumnBuffer(object):
+    ''' An append-only column. Numbers go in a NumPy array whose capacity
+    doubles as needed; if anything else is appended, the column switches to a
+    list. '''
+
+    def __init__(self):
+        self._array = None
+        self._list = None
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def extend(self, values: Sequence):
+        if not len(values):
+            return
+        if self._list is None:
+            dtype = _numeric_dtype(values)
+            if dtype is not None and self._array is not None and dtype != self._array.dtype:
+                dtype = np.dtype(np.float64)  # mixed ints and floats
+            if dtype is None:
+                self._list = [] if self._array is None else self._array[:self._len].tolist()
+                self._array = None
+            else:
+                self._extend_array(values, dtype)
+                return
+        self._list.extend(values)
+        self._len += len(values)
+
+    def _extend_array(self, values, dtype):
+        new_len = self._len + len(values)
+        if self._array is None:
+            self._array = np.empty(max(new_len, 1024), dtype=dtype)
+        elif new_len > len(self._array) or dtype != self._array.dtype:
+            new_array = np.empty(max(new_len, 2 * len(self._array)), dtype=dtype)
+            new_array[:self._len] = self._array[:self._len]
+            self._array = new_array
+        self._array[self._len:new_len] = values
+        self._len = new_len
+
+    def values(self):
+        ''' The column, as an array or a list. '''
+        if self._list is not None:
+            return self._list
+        return self._array[:self._len] if self._array is not None else []
+
+
+def _argsort(values) -> List[int]:
+    ''' Stable argsort of an array or a list. '''
+    if isinstance(values, np.ndarray):
+        return np.argsort(values, kind='mergesort').tolist()
+    return sorted(range(len(values)), key=values.__getitem__)
+
+
+def _take(values, order):
+    if isinstance(values, np.ndarray):
+        return values[order]
+    return [values[i] for i in order]
+
+
+def _iter_chunk_rows(chunk: Dict) -> Iterator[Dict]:
+    names = list(chunk)
+    # Python scalars rather than NumPy ones, e.g. for JSON serialization.
+    columns = [chunk[name].tolist() if isinstance(chunk[name], np.ndarray) else chunk[name]
+               for name in names]
+    n_rows = len(columns[0]) if columns else 0
+    for i in range(n_rows):
+        yield {name: column[i] for name, column in zip(names, columns)}
+
+
+def _read_run(path: str) -> Iterator[Dict]:
+    ''' Rows of a spilled run, a sequence of pickled blocks. '''
+    with open(path, 'rb') as fd:
+        while True:
+            try:
+                block = pickle.load(fd)
+            except EOFError:
+                return
+            yield from _iter_chunk_rows(block)
+
+
+class PredictionSink(object):
+    ''' Accumulates predictions for one task, batch by batch.
+
+    Usage:
+        sink = PredictionSink()
+        for batch in ...:
+            sink.append({'idx': [...], 'preds': [...]})
+        for row in sink.rows():  # {'idx': ..., 'preds': ...}, by idx
+            ...
+
+    Rows missing a column (because it wasn't in their batch) have None.
+    '''
+
+    def __init__(self, max_rows_in_memory: int = None, spill_dir: str = None):
+        self._max_rows_in_memory = max_rows_in_memory or MAX_ROWS_IN_MEMORY
+        self._spill_dir = spill_dir
+        self._tmp_dir = None
+        self._runs = []  # paths of spilled runs, in insertion order
+        self._columns = []  # column names, in the order first seen
+        self._buffers = {}
+        self._n_buffered = 0
+        self._n_rows = 0
+        self._in_order = True  # whether 'idx' has been non-decreasing so far
+        self._last_idx = None
+
+    def __len__(self):
+        return self._n_rows
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    def append(self, cols: Dict[str, Sequence]):
+        ''' Add a batch of rows, given as a dict of column name -> values. '''
+        lengths = set(len(values) for values in cols.values())
+        assert len(lengths) == 1, "Prediction columns have different lengths!"
+        n_new = lengths.pop()
+        if n_new == 0:
+            return
+        for name in cols:
+            if name not in self._buffers:
+                self._columns.append(name)
+                self._buffers[name] = _ColumnBuffer()
+                self._buffers[name].extend([None] * self._n_buffered)
+        for name, buffer in self._buffers.items():
+            buffer.extend(list(cols[name]) if name in cols else [None] * n_new)
+        self._n_buffered += n_new
+        self._n_rows += n_new
+
+        if self._in_order and 'idx' in cols:
+            for idx in cols['idx']:
+                if self._last_idx is not None and idx < self._last_idx:
+                    self._in_order = False
+                    break
+                self._last_idx = idx
+
+        if self._n_buffered >= self._max_rows_in_memory:
+            self._spill()
+
+    def _buffered_chunk(self, sort_by_idx: bool) -> Dict:
+        ''' The buffered rows as a dict of column name -> values, including the
+        row number, and sorted by idx if requested and needed. '''
+        first_row = self._n_rows - self._n_buffered
+        chunk = {name: self._buffers[name].values() for name in self._columns}
+        chunk[_ROW_COL] = np.arange(first_row, self._n_rows)
+        if sort_by_idx and not self._in_order and 'idx' in chunk:
+            order = _argsort(chunk['idx'])
+            chunk = {name: _take(values, order) for name, values in chunk.items()}
+        return chunk
+
+    def _spill(self):
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix="preds_", dir=self._spill_dir)
+            # Clean up with the sink.
+            weakref.finalize(self, shutil.rmtree, self._tmp_dir, True)
+        chunk = self._buffered_chunk(sort_by_idx=True)
+        path = os.path.join(self._tmp_dir, "run_%d.pkl" % len(self._runs))
+        with open(path, 'wb') as fd:
+            for start in range(0, self._n_buffered, _BLOCK_ROWS):
+                pickle.dump({name: values[start:start + _BLOCK_ROWS]
+                             for name, values in chunk.items()},
+                            fd, protocol=pickle.HIGHEST_PROTOCOL)
+        log.info("Spilled %d predictions to %s", self._n_buffered, path)
+        self._runs.append(path)
+        self._buffers = {name: _ColumnBuffer() for name in self._columns}
+        self._n_buffered = 0
+
+    def _sorted_runs(self) -> List[Iterator[Dict]]:
+        runs = [_read_run(path) for path in self._runs]
+        runs.append(_iter_chunk_rows(self._buffered_chunk(sort_by_idx=True)))
+        return runs
+
+    def rows(self, sort_by_idx: bool = True) -> Iterator[Dict]:
+        ''' Iterate over rows, as dicts of column name -> value.
+
+        Args:
+            sort_by_idx: if set (and there's an 'idx' column), yield rows in
+                order of idx, with ties in insertion order. Otherwise, yield
+                rows in insertion order.
+        '''
+        if self._in_order or 'idx' not in self._buffers:
+            rows = itertools.chain.from_iterable(self._sorted_runs())
+        elif sort_by_idx:
+            log.info("Sorting %d predictions by 'idx' (%d runs)", self._n_rows,
+                     len(self._runs) + 1)
+            rows = heapq.merge(*self._sorted_runs(),
+                               key=lambda row: (row['idx'], row[_ROW_COL]))
+        else:
+            # Runs are stored sorted by idx, but each covers a contiguous
+            # range of rows, so they can be restored one at a time.
+            rows = itertools.chain.from_iterable(
+                sorted(run, key=lambda row: row[_ROW_COL]) for run in self._sorted_runs())
+        for row in rows:
+            del row[_ROW_COL]
+            if len(row) < len(self._columns):  # spilled before a column appeared
+                row = {name: row.get(name) for name in self._columns}
+            yield row
+
+    def to_dataframe(self, sort_by_idx: bool = True):
+        ''' All rows as a pandas DataFrame. Loads everything into memory. '''
+        return pd.DataFrame.from_records(list(self.rows(sort_by_idx)), columns=self._columns)
@@ -24,19 +24,20 @@ from allennlp.data.token_indexers import \
     SingleIdTokenIndexer, ELMoTokenCharactersIndexer, \
     TokenCharactersIndexer
 
-try:
-    import fastText
-except BaseException:
-    log.info("fastText library not found!")
-
 import _pickle as pkl  # :(
 
 from . import config
+from . import distributed
+from . import line_counts
+from . import lm_stream
 from . import serialize
 from . import utils
+from .lazy import lazy_import
 from . import tasks as tasks_module
 from .tasks import MTTask
 
+fastText = lazy_import("fastText")  # optional; only needed with fastText = 1
+
 ALL_GLUE_TASKS = ['sst', 'cola', 'mrpc', 'qqp', 'sts-b',
                   'mnli', 'qnli', 'rte', 'wnli', 'mnli-diagnostic']
 
@@ -70,7 +71,17 @@ def _get_serialized_record_path(task_name, split, preproc_dir):
     return serialized_record_path
 
 
-def _get_instance_generator(task_name, split, preproc_dir, fraction=None):
+def _get_token_stream_path(task_name, split, preproc_dir):
+    """Get the canonical path for a packed token stream (see lm_stream.py)."""
+    return os.path.join(preproc_dir, "{:s}__{:s}_stream.bin".format(task_name, split))
+
+
+def _use_token_stream(args, task):
+    """Whether to serve task's data as a packed token stream, rather than as Instances."""
+    return bool(args.lm_packed_stream) and isinstance(task, tasks_module.LanguageModelingTask)
+
+
+def _get_instance_generator(task_name, split, preproc_dir, fraction=None, shard=None):
     """Get a lazy generator for the given task and split.
 
     Args:
@@ -80,13 +91,14 @@ def _get_instance_generator(task_name, split, preproc_dir, fraction=None):
         fraction: if set to a float between 0 and 1, load only the specified percentage
           of examples. Hashing is used to ensure that the same examples are loaded each
           epoch.
+        shard: if set to (index, num_shards), load only that shard of the examples.
 
     Returns:
         serialize.RepeatableIterator yielding Instance objects
     """
     filename = _get_serialized_record_path(task_name, split, preproc_dir)
     assert os.path.isfile(filename), ("Record file '%s' not found!" % filename)
-    return serialize.read_records(filename, repeatable=True, fraction=fraction)
+    return serialize.read_records(filename, repeatable=True, fraction=fraction, shard=shard)
 
 
 def _indexed_instance_generator(instance_iter, vocab):
@@ -146,21 +158,25 @@ def _index_split(task, split, indexers, vocab, record_file):
         # TODO: remove this case and stream everything.
         instance_iter = utils.copy_iter(instance_iter)
 
-    # Counter for lazy-loaded data, so we can log the # of elements.
-    _instance_counter = 0
-
-    def _counter_iter(elems):
-        nonlocal _instance_counter
-        for elem in elems:
-            _instance_counter += 1
-            yield elem
-    instance_iter = _counter_iter(instance_iter)
-
-    # Actually call generators and stream to disk.
-    serialize.write_records(
+    # Actually call generators and stream to disk. The number of examples
+    # written is recorded with the records, for exact example counts.
+    n_instances = serialize.write_records(
         _indexed_instance_generator(instance_iter, vocab), record_file)
     log.info("%s: saved %d instances to %s",
-             log_prefix, _instance_counter, record_file)
+             log_prefix, n_instances, record_file)
+
+
+def _index_token_stream(task, split, stream_file):
+    """Index a language modeling split into a packed token stream, with whole
+    (untruncated) sentences.
+    Args:
+        task: LanguageModelingTask instance
+        split: (string), 'train', 'val', or 'test'
+        stream_file: (string) file to write the stream to
+    """
+    log.info("\tTask '%s', split '%s': packing into a token stream", task.name, split)
+    sentences = task.load_data(task.files_by_split[split], max_seq_len=sys.maxsize)
+    lm_stream.write_token_stream(sentences, stream_file)
 
 
 def _find_cached_file(exp_dir: str, global_exp_cache_dir: str,
@@ -231,6 +247,18 @@ def _build_vocab(args, tasks, vocab_path: str):
     #  del word2freq, char2freq, target2freq
 
 
+def build_indexers(args):
+    ''' Token indexers for model inputs, by name. '''
+    indexers = {}
+    if not args.word_embs == 'none':
+        indexers["words"] = SingleIdTokenIndexer()
+    if args.elmo:
+        indexers["elmo"] = ELMoTokenCharactersIndexer("elmo")
+    if args.char_embs:
+        indexers["chars"] = TokenCharactersIndexer("chars")
+    return indexers
+
+
 def build_tasks(args):
     '''Main logic for preparing tasks, doing so by
     1) creating / loading the tasks
@@ -254,13 +282,7 @@ def build_tasks(args):
 
     # 2) build / load vocab and indexers
     vocab_path = os.path.join(args.exp_dir, 'vocab')
-    indexers = {}
-    if not args.word_embs == 'none':
-        indexers["words"] = SingleIdTokenIndexer()
-    if args.elmo:
-        indexers["elmo"] = ELMoTokenCharactersIndexer("elmo")
-    if args.char_embs:
-        indexers["chars"] = TokenCharactersIndexer("chars")
+    indexers = build_indexers(args)
 
     if args.reload_vocab or not os.path.exists(vocab_path):
         _build_vocab(args, tasks, vocab_path)
@@ -295,19 +317,27 @@ def build_tasks(args):
         "Flag reload_indexing was set, but no tasks are set to reindex (use -o \"args.reindex_tasks = \"task1,task2,...\"\")")
     for task in tasks:
         force_reindex = (args.reload_indexing and task.name in reindex_tasks)
+        use_stream = _use_token_stream(args, task)
         for split in ALL_SPLITS:
             log_prefix = "\tTask '%s', split '%s'" % (task.name, split)
-            relative_path = _get_serialized_record_path(task.name, split, "preproc")
+            get_path = _get_token_stream_path if use_stream else _get_serialized_record_path
+            relative_path = get_path(task.name, split, "preproc")
             cache_found = _find_cached_file(args.exp_dir, args.global_ro_exp_dir,
                                             relative_path, log_prefix=log_prefix)
+            if use_stream and cache_found and \
+                    not lm_stream.is_complete(get_path(task.name, split, preproc_dir)):
+                log.info("%s: token stream is from an older version; reindexing", log_prefix)
+                cache_found = False
             if force_reindex or not cache_found:
                 # Re-index from scratch.
-                record_file = _get_serialized_record_path(task.name, split,
-                                                          preproc_dir)
+                record_file = get_path(task.name, split, preproc_dir)
                 if os.path.exists(record_file) and os.path.islink(record_file):
                     os.remove(record_file)
 
-                _index_split(task, split, indexers, vocab, record_file)
+                if use_stream:
+                    _index_token_stream(task, split, record_file)
+                else:
+                    _index_split(task, split, indexers, vocab, record_file)
 
         # Delete in-memory data - we'll lazy-load from disk later.
         # TODO: delete task.{split}_data_text as well?
@@ -323,7 +353,38 @@ def build_tasks(args):
         "training_data_fraction and eval_data_fraction could not be used at a same time (could not be < 1 together)"
     train_tasks = []
     eval_tasks = []
+    # In distributed training, each rank trains on its own shard of the training data.
+    train_shard = distributed.get_shard()
     for task in tasks:
+        if _use_token_stream(args, task):
+            # Token streams are sharded and batched by the trainer; see lm_stream.py.
+            if args.training_data_fraction < 1 or args.eval_data_fraction < 1:
+                log.warning("Task '%s': data fractions aren't supported with lm_packed_stream; "
+                            "using all of the data.", task.name)
+            for split in ALL_SPLITS:
+                stream = lm_stream.TokenStream(
+                    _get_token_stream_path(task.name, split, preproc_dir),
+                    args.max_seq_len, vocab, indexers)
+                setattr(task, "%s_data" % split, stream)
+                task.example_counts[split] = len(stream)
+            if task.name in train_task_names:
+                train_tasks.append(task)
+            if task.name in eval_task_names:
+                eval_tasks.append(task)
+            log.info("\tServing data for task='%s' as packed token streams from %s",
+                     task.name, preproc_dir)
+            continue
+
+        # Use the number of examples actually indexed, rather than estimates
+        # from the raw data (e.g. line counts), where it was recorded.
+        for split in ALL_SPLITS:
+            n_examples = serialize.read_record_count(
+                _get_serialized_record_path(task.name, split, preproc_dir))
+            if n_examples is not None:
+                task.example_counts[split] = n_examples
+        log.info("\tTask '%s': indexed %s", task.name,
+                 " ".join("%s=%d" % kv for kv in task.example_counts.items()))
+
         # Replace lists of instances with lazy generators from disk.
         task.val_data = _get_instance_generator(task.name, "val", preproc_dir)
         task.test_data = _get_instance_generator(task.name, "test", preproc_dir)
@@ -332,7 +393,8 @@ def build_tasks(args):
         if args.training_data_fraction < 1 and task.name in train_task_names:
             log.info("Creating trimmed pretraining-only version of " + task.name + " train.")
             task.train_data = _get_instance_generator(task.name, "train", preproc_dir,
-                                                      fraction=args.training_data_fraction)
+                                                      fraction=args.training_data_fraction,
+                                                      shard=train_shard)
             train_tasks.append(task)
             if task.name in eval_task_names:
                 # Rebuild the iterator so we see the full dataset in the eval training
@@ -343,7 +405,7 @@ def build_tasks(args):
                          "it creates a deepcopy of task object which is inefficient.")
                 task = copy.deepcopy(task)
                 task.train_data = _get_instance_generator(
-                    task.name, "train", preproc_dir, fraction=1.0)
+                    task.name, "train", preproc_dir, fraction=1.0, shard=train_shard)
                 eval_tasks.append(task)
 
         # When using eval_data_fraction, we need modified iterators
@@ -351,7 +413,8 @@ def build_tasks(args):
         elif args.eval_data_fraction < 1 and task.name in eval_task_names:
             log.info("Creating trimmed train-for-eval-only version of " + task.name + " train.")
             task.train_data = _get_instance_generator(task.name, "train", preproc_dir,
-                                                      fraction=args.eval_data_fraction)
+                                                      fraction=args.eval_data_fraction,
+                                                      shard=train_shard)
             eval_tasks.append(task)
             if task.name in train_task_names:
                 # Rebuild the iterator so we see the full dataset in the pretraining
@@ -362,13 +425,13 @@ def build_tasks(args):
                          "it creates a deepcopy of task object which is inefficient.")
                 task = copy.deepcopy(task)
                 task.train_data = _get_instance_generator(
-                    task.name, "train", preproc_dir, fraction=1.0)
+                    task.name, "train", preproc_dir, fraction=1.0, shard=train_shard)
                 train_tasks.append(task)
         # When neither eval_data_fraction nor training_data_fraction is specified
         # we use unmodified iterators.
         else:
             task.train_data = _get_instance_generator(task.name, "train", preproc_dir,
-                                                      fraction=1.0)
+                                                      fraction=1.0, shard=train_shard)
             if task.name in train_task_names:
                 train_tasks.append(task)
             if task.name in eval_task_names:
@@ -408,6 +471,8 @@ def get_tasks(train_task_names, eval_task_names, max_seq_len, path=None,
     assert path is not None
     scratch_path = (scratch_path or path)
     log.info("Writing pre-preprocessed tasks to %s", scratch_path)
+    utils.maybe_make_dir(scratch_path)
+    line_counts.set_cache_file(os.path.join(scratch_path, "line_counts.json"))
 
     tasks = []
     for name in task_names:
@@ -0,0 +1,190 @@
+""" Lightweight timing and throughput instrumentation for the trainer.
+
+Usage:
+    profiler = TrainingProfiler(cuda_device=-1)
+    for batch in profiler.timed_iter(task.name, generator):
+        with profiler.timer(task.name, 'forward'):
+            out = model.forward(task, batch)
+        profiler.add_counts(task.name, n_exs=out['n_exs'],
+                            n_tokens=get_batch_num_tokens(batch))
+    log.info(profiler.format_window(task.name, profiler.pop_window(task.name)))
+"""
+import json
+import time
+import resource
+import contextlib
+import collections
+import logging as log
+
+import torch
+
+# Timed sections, in the order they're reported.
+SECTIONS = ['data_wait', 'forward', 'backward', 'step', 'validate']
+
+
+def get_batch_num_tokens(batch):
+    ''' Count non-padding tokens over the text fields of a batch.
+
+    Returns a tensor (to avoid forcing a device sync), or 0 if there are no
+    recognized text fields. '''
+    n_tokens = 0
+    for field_name in ['input1', 'input2', 'input', 'inputs']:
+        if field_name not in batch or not isinstance(batch[field_name], dict):
+            continue
+        idxs = list(batch[field_name].values())[0]
+        if idxs.dim() == 3:  # character ids: [batch, seq_len, n_chars]
+            n_tokens = n_tokens + idxs.ne(0).sum(-1).gt(0).sum()
+        else:
+            n_tokens = n_tokens + idxs.ne(0).sum()
+    return n_tokens
+
+
+def _to_float(value):
+    return float(value.item()) if torch.is_tensor(value) else float(value)
+
+
+class TrainingProfiler(object):
+    ''' Accumulates per-task section timings and example/token counts.
+
+    Totals are kept for the whole run; a separate window is reset each time
+    pop_window() is called, for periodic logging.
+
+    CUDA kernels run asynchronously, so without sync_cuda the time for GPU
+    work is attributed to whichever section next blocks on it (usually the
+    loss read-back after backward).
+    '''
+
+    def __init__(self, cuda_device=-1, sync_cuda=False):
+        self._cuda_device = cuda_device
+        self._sync_cuda = sync_cuda and cuda_device >= 0
+        self._totals = collections.defaultdict(collections.Counter)
+        self._window = collections.defaultdict(collections.Counter)
+        self._window_start = {}
+        self._start_time = time.time()
+
+    def _sync(self):
+        if self._sync_cuda:
+            torch.cuda.synchronize(self._cuda_device)
+
+    def add_time(self, task_name, section, seconds):
+        self._window_start.setdefault(task_name, time.time() - seconds)
+        self._totals[task_name][section] += seconds
+        self._window[task_name][section] += seconds
+
+    def add_counts(self, task_name, n_batches=1, n_exs=0, n_tokens=0):
+        self._window_start.setdefault(task_name, time.time())
+        for counts in (self._totals[task_name], self._window[task_name]):
+            counts['batches'] += n_batches
+            counts['examples'] += n_exs
+            counts['tokens'] += n_tokens
+
+    @contextlib.contextmanager
+    def timer(self, task_name, section):
+        self._sync()
+        start = time.time()
+        yield
+        self._sync()
+        self.add_time(task_name, section, time.time() - start)
+
+    def timed_iter(self, task_name, iterable):
+        ''' Wrap an iterator, timing each call to next() as data_wait. '''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(task_name, 'data_wait', time.time() - start)
+            yield item
+
+    def mean_step_time(self, task_name):
+        ''' Mean seconds per training batch for task_name so far, or 0 if none. '''
+        counts = self._totals[task_name]
+        if not counts['batches']:
+            return 0.0
+        busy_time = sum(counts[s] for s in SECTIONS if s != 'validate')
+        return busy_time / counts['batches']
+
+    def peak_memory_mb(self):
+        ''' Peak memory: allocated CUDA memory if on GPU, else process max RSS. '''
+        if self._cuda_device >= 0:
+            return torch.cuda.max_memory_allocated(self._cuda_device) / 2**20
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def _summarize(self, counts, elapsed):
+        stats = collections.OrderedDict()
+        for section in SECTIONS:
+            stats['time_%s' % section] = counts[section]
+        stats['batches'] = int(counts['batches'])
+        stats['examples'] = _to_float(counts['examples'])
+        stats['tokens'] = _to_float(counts['tokens'])
+        stats['elapsed'] = elapsed
+        stats['ex_per_s'] = stats['examples'] / elapsed if elapsed > 0 else 0.0
+        stats['tok_per_s'] = stats['tokens'] / elapsed if elapsed > 0 else 0.0
+        stats['peak_mem_mb'] = self.peak_memory_mb()
+        return stats
+
+    def pop_window(self, task_name):
+        ''' Return stats for task_name since the last call, and reset. '''
+        now = time.time()
+        elapsed = now - self._window_start.get(task_name, now)
+        stats = self._summarize(self._window[task_name], elapsed)
+        self._window[task_name] = collections.Counter()
+        self._window_start[task_name] = now
+        return stats
+
+    def format_window(self, task_name, stats):
+        times = ", ".join("%s %.2fs" % (s, stats['time_%s' % s])
+                          for s in SECTIONS if stats['time_%s' % s] > 0)
+        return ("%s: %.1f ex/s, %.1f tok/s, peak mem %.0f MB (%s)" %
+                (task_name, stats['ex_per_s'], stats['tok_per_s'],
+                 stats['peak_mem_mb'], times))
+
+    def summary(self):
+        ''' Return stats for the whole run, by task. Rates are computed over
+        the time spent in the task's own sections. '''
+        summary = {}
+        for task_name, counts in self._totals.items():
+            busy_time = sum(counts[s] for s in SECTIONS if s != 'validate')
+            summary[task_name] = self._summarize(counts, busy_time)
+        summary['_wall_time'] = time.time() - self._start_time
+        return summary
+
+    def write_summary(self, path):
+        with open(path, 'w') as fd:
+            json.dump(self.summary(), fd, indent=2)
+        log.info("Wrote training profile to %s", path)
+
+
+class TraceWindow(object):
+    ''' Run torch.autograd.profiler over a window of training steps, and
+    write a Chrome trace (viewable at chrome://tracing) when it closes. '''
+
+    def __init__(self, start_step, num_steps, trace_path, use_cuda=False):
+        self._start_step = start_step
+        self._end_step = start_step + num_steps
+        self._trace_path = trace_path
+        self._use_cuda = use_cuda
+        self._prof = None
+        self._done = start_step < 0
+
+    def step(self, n_pass):
+        ''' Call once per training step with the current step count. '''
+        if self._done:
+            return
+        if self._prof is None and n_pass >= self._start_step:
+            log.info("Starting profiler trace at step %d", n_pass)
+            self._prof = torch.autograd.profiler.profile(use_cuda=self._use_cuda)
+            self._prof.__enter__()
+        elif self._prof is not None and n_pass >= self._end_step:
+            self.close()
+
+    def close(self):
+        if self._prof is None or self._done:
+            return
+        self._prof.__exit__(None, None, None)
+        self._prof.export_chrome_trace(self._trace_path)
+        log.info("Wrote profiler trace to %s", self._trace_path)
+        self._done = True
@@ -0,0 +1,54 @@
+""" Dynamic int8 quantization for CPU inference.
+
+With eval_quantize, the model is quantized after its checkpoint is loaded:
+the weights of every Linear and LSTM layer (in the sentence encoder and in
+the task heads) are stored as int8, and activations are quantized on the fly
+at each matmul. Embeddings, convolutions and everything else stay in fp32.
+
+The quantized model is only used for test predictions if its validation
+metrics match the fp32 model's; see compare_metrics.
+
+Usage:
+    qmodel = quantize_model(model)
+    if qmodel is not None:
+        q_metrics, _ = evaluate.evaluate(qmodel, tasks, batch_size, -1, "val")
+        mismatches = compare_metrics(metrics, q_metrics, tasks, tolerance=0.01)
+"""
+import logging as log
+
+import torch
+import torch.nn as nn
+
+
+def quantize_model(model):
+    ''' A copy of model with dynamically quantized Linear and LSTM layers, or None
+    if this version of PyTorch doesn't support dynamic quantization. model must
+    be on CPU. '''
+    quantization = getattr(torch, 'quantization', None)
+    if quantization is None or not hasattr(quantization, 'quantize_dynamic'):
+        log.warning("This version of PyTorch (%s) doesn't support dynamic quantization; "
+                    "evaluating in fp32.", torch.__version__)
+        return None
+    n_linear = sum(isinstance(m, nn.Linear) for m in model.modules())
+    n_lstm = sum(isinstance(m, nn.LSTM) for m in model.modules())
+    qmodel = quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+    qmodel.eval()
+    log.info("Quantized %d Linear and %d LSTM layers to int8", n_linear, n_lstm)
+    return qmodel
+
+
+def compare_metrics(metrics, quantized_metrics, tasks, tolerance):
+    ''' Compare each task's validation metric between two evaluate() results.
+
+    Returns a list of (metric name, fp32 value, int8 value) for metrics that
+    differ by more than tolerance (absolute). '''
+    mismatches = []
+    for task in tasks:
+        name = task.val_metric
+        if name not in metrics or name not in quantized_metrics:
+            continue
+        value, quantized_value = metrics[name], quantized_metrics[name]
+        log.info("%s: fp32 %.4f, int8 %.4f", name, value, quantized_value)
+        if not abs(value - quantized_value) <= tolerance:  # also catches NaNs
+            mismatches.append((name, value, quantized_value))
+    return mismatches
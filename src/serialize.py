@@ -3,18 +3,28 @@
 # per line as a base64-encoded pickle.
 
 import _pickle as pkl
+import array
 import base64
+import itertools
+import json
+import os
 from zlib import crc32
 
+# Suffix of the file written next to each record file, with its number of records.
+COUNT_SUFFIX = ".count.json"
+
 
 def _serialize(examples, fd, flush_every):
+    n_examples = 0
     for i, example in enumerate(examples):
         blob = pkl.dumps(example)
         encoded = base64.b64encode(blob)
         fd.write(encoded)
         fd.write(b"\n")
+        n_examples += 1
         if (i + 1) % flush_every == 0 and hasattr(fd, 'flush'):
             fd.flush()
+    return n_examples
 
 
 def write_records(examples, filename, flush_every=10000):
@@ -24,9 +34,55 @@ def write_records(examples, filename, flush_every=10000):
       examples: iterable(object), iterable of examples to write
       filename: path to file to write
       flush_every: (int), flush to disk after this many examples consumed
+
+    Returns:
+      int, the number of examples written. This is also recorded next to the
+      file, for read_record_count.
     """
     with open(filename, 'wb') as fd:
-        _serialize(examples, fd, flush_every)
+        n_examples = _serialize(examples, fd, flush_every)
+    _write_count(filename, n_examples)
+    return n_examples
+
+
+def _count_file(filename):
+    """Path to the count file for filename.
+
+    Record files may be symlinks to a shared cache; the count is kept next to
+    the file itself, one count file per record file.
+    """
+    return os.path.realpath(filename) + COUNT_SUFFIX
+
+
+def _write_count(filename, n_examples):
+    count_file = _count_file(filename)
+    st = os.stat(filename)
+    tmp_file = "%s.tmp.%d" % (count_file, os.getpid())
+    with open(tmp_file, 'w') as fd:
+        json.dump({'n_examples': n_examples, 'size': st.st_size,
+                   'mtime_ns': st.st_mtime_ns}, fd)
+    os.replace(tmp_file, count_file)
+
+
+def read_record_count(filename):
+    """Number of records in a file written by write_records.
+
+    Returns:
+      int, or None if the count wasn't recorded (e.g. for files written before
+      counts were kept) or the file has changed since.
+    """
+    count_file = _count_file(filename)
+    if not os.path.isfile(filename) or not os.path.isfile(count_file):
+        return None
+    try:
+        with open(count_file) as fd:
+            entry = json.load(fd)
+    except ValueError:
+        return None
+    st = os.stat(filename)
+    if (st.st_size, st.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+        return None
+    return entry['n_examples']
 
 
 class RepeatableIterator(object):
@@ -49,6 +105,14 @@ class RepeatableIterator(object):
         return self._iter_fn().__iter__()
 
 
+class RecordIterator(RepeatableIterator):
+    """Repeatable iterator over all the records in a file, from read_records."""
+
+    def __init__(self, filename, iter_fn):
+        super(RecordIterator, self).__init__(iter_fn)
+        self.filename = filename
+
+
 def bytes_to_float(b):
     """ Maps a byte string to a float in [0, 1].
 
@@ -57,7 +121,7 @@ def bytes_to_float(b):
     return float(crc32(b) & 0xffffffff) / 2**32
 
 
-def read_records(filename, repeatable=False, fraction=None):
+def read_records(filename, repeatable=False, fraction=None, shard=None):
     """Streaming read records from file.
 
     Args:
@@ -67,13 +131,19 @@ def read_records(filename, repeatable=False, fraction=None):
       fraction: if set to a float between 0 and 1, load only the specified percentage
         of examples. Hashing is used to ensure that the same examples are loaded each
         epoch.
+      shard: if set to (index, num_shards), load only every num_shards-th record,
+        starting from index. Other records are skipped without being decoded.
 
     Returns:
-      iterable, possible repeatable, yielding deserialized Python objects
+      iterable, possible repeatable, yielding deserialized Python objects. If
+      repeatable and reading the whole file, a RecordIterator.
     """
     def _iter_fn():
         with open(filename, 'rb') as fd:
-            for line in fd:
+            lines = fd
+            if shard is not None:
+                lines = itertools.islice(fd, shard[0], None, shard[1])
+            for line in lines:
                 blob = base64.b64decode(line)
                 if fraction and fraction < 1:
                     hash_float = bytes_to_float(blob)
@@ -81,4 +151,47 @@ def read_records(filename, repeatable=False, fraction=None):
                         continue
                 example = pkl.loads(blob)
                 yield example
+    if not repeatable:
+        return _iter_fn()
+    if fraction is None and shard is None:
+        return RecordIterator(filename, _iter_fn)
+    return RepeatableIterator(_iter_fn)
+
+
+def record_offsets(filename, limit=None):
+    """Byte offsets of the records in a file.
+
+    Args:
+      filename: path to file of b64-encoded pickles, one per line
+      limit: if set, only the offsets of the first limit records
+
+    Returns:
+      array.array of int, one offset per record. Records aren't decoded.
+    """
+    offsets = array.array('q')
+    with open(filename, 'rb') as fd:
+        offset = 0
+        for line in itertools.islice(fd, limit):
+            offsets.append(offset)
+            offset += len(line)
+    return offsets
+
+
+def read_records_at(filename, offsets, repeatable=False):
+    """Streaming read the records at the given byte offsets, in that order.
+
+    Args:
+      filename: path to file of b64-encoded pickles, one per line
+      offsets: sequence of byte offsets, as from record_offsets
+      repeatable: if true, returns a RepeatableIterator that can read the
+        records multiple times.
+
+    Returns:
+      iterable, possible repeatable, yielding deserialized Python objects
+    """
+    def _iter_fn():
+        with open(filename, 'rb') as fd:
+            for offset in offsets:
+                fd.seek(offset)
+                yield pkl.loads(base64.b64decode(fd.readline()))
     return RepeatableIterator(_iter_fn) if repeatable else _iter_fn()
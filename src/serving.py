@@ -0,0 +1,278 @@
+""" Online predictions from a trained model, over HTTP.
+
+serve.py loads a trained model and serves it with make_server. Clients POST
+raw sentences (or sentence pairs) to /predict. Each example becomes a
+request to a MicroBatcher, which groups concurrent requests for the same
+task into one batch. A batch runs once it's full, or once its oldest
+request has waited max_latency seconds, whichever comes first. This bounds
+how long a request waits for others to arrive.
+
+Request:  POST /predict  {"task": "mrpc", "examples": [{"sentence1": "...", "sentence2": "..."}]}
+          (or a single example: {"task": "sst", "sentence1": "..."})
+Response: {"predictions": [...]}, in the same order as the examples
+GET /stats returns request counts, mean batch size and latency percentiles.
+"""
+import json
+import time
+import queue
+import threading
+import collections
+import socketserver
+import logging as log
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+from allennlp.data.iterators import BasicIterator
+
+from . import preprocess
+from .evaluate import _coerce_list
+from .tasks import SingleClassificationTask, PairClassificationTask, \
+    PairRegressionTask, PairOrdinalRegressionTask
+from .utils import process_sentence
+
+# Tasks whose examples are one sentence or a pair, processed by process_single_pair_task_split.
+SERVABLE_TASK_TYPES = (SingleClassificationTask, PairClassificationTask,
+                       PairRegressionTask, PairOrdinalRegressionTask)
+# Number of recent requests to compute latency percentiles over.
+_N_LATENCIES = 10000
+
+
+def is_servable(task):
+    ''' Whether Predictor can serve task. Subclasses of SERVABLE_TASK_TYPES that override
+    process_split (e.g. RedditPairClassificationTask, DisSentTask) read their splits in
+    another format, so only those that keep the base class's process_split qualify. '''
+    return any(type(task).process_split is task_type.process_split
+               for task_type in SERVABLE_TASK_TYPES)
+
+
+class Predictor(object):
+    ''' Runs a model on raw examples for single-sentence and sentence-pair tasks.
+
+    Args:
+        model: MultiTaskModel, with trained weights loaded
+        tasks: tasks to serve
+        vocab: Vocabulary the model was trained with
+        indexers: token indexers, from preprocess.build_indexers
+        max_seq_len: sentences are truncated to this many tokens, as in preprocessing
+        cuda_device: GPU id, or -1 for CPU
+    '''
+
+    def __init__(self, model, tasks, vocab, indexers, max_seq_len, cuda_device=-1):
+        self._model = model
+        self._model.eval()
+        self._tasks = {}
+        for task in tasks:
+            if is_servable(task):
+                self._tasks[task.name] = task
+            else:
+                log.warning("Can't serve task %s (%s); skipping.", task.name, type(task).__name__)
+        self._vocab = vocab
+        self._indexers = indexers
+        self._max_seq_len = max_seq_len
+        self._cuda_device = cuda_device
+
+    @property
+    def task_names(self):
+        return sorted(self._tasks)
+
+    def check_example(self, task_name, sent1, sent2):
+        ''' Raise ValueError if the example can't be predicted on, so that a bad
+        request fails on its own rather than with the batch it would be in. '''
+        if task_name not in self._tasks:
+            raise ValueError("Unknown task '%s'; serving: %s" % (task_name,
+                                                                 ", ".join(self.task_names)))
+        if not isinstance(sent1, str) or not sent1.strip():
+            raise ValueError("Missing sentence1")
+        is_pair = not isinstance(self._tasks[task_name], SingleClassificationTask)
+        if is_pair and (not isinstance(sent2, str) or not sent2.strip()):
+            raise ValueError("Task '%s' needs sentence2" % task_name)
+
+    def predict(self, task_name, examples):
+        ''' Predictions for a list of (sentence1, sentence2) pairs of raw strings,
+        with sentence2 None for single-sentence tasks. '''
+        task = self._tasks[task_name]
+        n_examples = len(examples)
+        sent1s = [process_sentence(sent1, self._max_seq_len) for sent1, _ in examples]
+        sent2s = [process_sentence(sent2, self._max_seq_len) if sent2 is not None else None
+                  for _, sent2 in examples]
+        # Labels are placeholders, as for unlabeled test data.
+        split = (sent1s, sent2s, [0] * n_examples, list(range(n_examples)))
+        instances = list(preprocess._indexed_instance_generator(
+            task.process_split(split, self._indexers), self._vocab))
+        batch = next(iter(BasicIterator(n_examples)(instances, num_epochs=1, shuffle=False,
+                                                    cuda_device=self._cuda_device)))
+        with torch.no_grad():
+            out = self._model.forward(task, batch, predict=True)
+        preds = _coerce_list(out['preds'])
+        assert len(preds) == n_examples, "Expected one prediction per example!"
+        return preds
+
+
+class MicroBatcher(object):
+    ''' Groups concurrent requests into batches, run one at a time in a worker thread.
+
+    Args:
+        predict_fn: function (task_name, list of examples) -> list of predictions
+        max_batch_size: most requests in a batch
+        max_latency: seconds the oldest request in a batch waits for more requests
+    '''
+
+    def __init__(self, predict_fn, max_batch_size=32, max_latency=0.01):
+        self._predict_fn = predict_fn
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency
+        self._requests = queue.Queue()
+        self._waiting = collections.OrderedDict()  # task name -> requests not yet batched
+        self._lock = threading.Lock()
+        self._n_requests = 0
+        self._n_batches = 0
+        self._latencies = collections.deque(maxlen=_N_LATENCIES)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, task_name, example):
+        ''' Queue example for task_name. Returns a Future for its prediction. '''
+        future = Future()
+        self._requests.put((task_name, example, future, time.time()))
+        return future
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            stats = {'n_requests': self._n_requests, 'n_batches': self._n_batches,
+                     'mean_batch_size': self._n_requests / max(self._n_batches, 1)}
+        if len(latencies):
+            for q in [50, 90, 99]:
+                stats['p%d_latency_ms' % q] = float(np.percentile(latencies, q))
+        return stats
+
+    def _next_batch(self):
+        ''' Wait until some task has a full batch, or a request that has waited
+        max_latency. Returns (task name, requests), or None once closed. '''
+        while True:
+            # Take everything queued first, so that requests that arrived while the
+            # last batch ran are batched together.
+            while True:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    return None
+                self._waiting.setdefault(request[0], []).append(request)
+            now = time.time()
+            ready = [(requests[0][3], task_name) for task_name, requests in self._waiting.items()
+                     if len(requests) >= self._max_batch_size or
+                     now >= requests[0][3] + self._max_latency]
+            if ready:
+                _, task_name = min(ready)  # the task with the oldest request goes first
+                requests = self._waiting[task_name]
+                batch = requests[:self._max_batch_size]
+                del requests[:self._max_batch_size]
+                if not requests:
+                    del self._waiting[task_name]
+                return task_name, batch
+            timeout = None
+            if self._waiting:
+                oldest = min(requests[0][3] for requests in self._waiting.values())
+                timeout = max(oldest + self._max_latency - now, 0)
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if request is None:
+                return None
+            self._waiting.setdefault(request[0], []).append(request)
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            task_name, requests = batch
+            try:
+                preds = self._predict_fn(task_name, [example for _, example, _, _ in requests])
+            except Exception as e:  # pylint: disable=broad-except
+                log.exception("Batch of %d for task %s failed", len(requests), task_name)
+                for _, _, future, _ in requests:
+                    future.set_exception(e)
+                continue
+            now = time.time()
+            for (_, _, future, start_time), pred in zip(requests, preds):
+                future.set_result(pred)
+            with self._lock:
+                self._n_requests += len(requests)
+                self._n_batches += 1
+                self._latencies.extend(now - start_time for _, _, _, start_time in requests)
+
+
+def _make_handler(predictor, batcher, timeout):
+    class _Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path == '/stats':
+                self._reply(200, batcher.stats())
+            elif self.path == '/tasks':
+                self._reply(200, {'tasks': predictor.task_names})
+            else:
+                self._reply(404, {'error': "Unknown path %s" % self.path})
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            if self.path != '/predict':
+                self._reply(404, {'error': "Unknown path %s" % self.path})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                task_name = request.get('task')
+                examples = request.get('examples', [request])
+                examples = [(ex.get('sentence1'), ex.get('sentence2')) for ex in examples]
+                for sent1, sent2 in examples:
+                    predictor.check_example(task_name, sent1, sent2)
+            except (ValueError, AttributeError, TypeError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+            futures = [batcher.submit(task_name, example) for example in examples]
+            try:
+                preds = [future.result(timeout=timeout) for future in futures]
+            except Exception as e:  # pylint: disable=broad-except
+                self._reply(500, {'error': "%s: %s" % (type(e).__name__, str(e))})
+                return
+            self._reply(200, {'predictions': preds})
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            # The default uses the client address, which Unix sockets don't have.
+            log.debug("%s", format % args)
+    return _Handler
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(predictor, batcher, host="127.0.0.1", port=8000, unix_socket=None,
+                timeout=60.0):
+    ''' An HTTP server for predictor, on a TCP port or (if unix_socket is set) a
+    Unix socket. Each connection is handled in its own thread; predictions go
+    through batcher. Call serve_forever() to run it. '''
+    handler = _make_handler(predictor, batcher, timeout)
+    if unix_socket:
+        return _ThreadingUnixHTTPServer(unix_socket, handler)
+    return _ThreadingHTTPServer((host, port), handler)
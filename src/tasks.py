@@ -31,6 +31,7 @@ from allennlp.data.fields import TextField, LabelField, \
 from .allennlp_mods.numeric_field import NumericField
 from .allennlp_mods.multilabel_field import MultiLabelField
 
+from . import line_counts
 from . import serialize
 from . import utils
 from .utils import load_tsv, process_sentence, truncate, load_diagnostic_tsv
@@ -665,10 +666,7 @@ class LanguageModelingTask(SequenceGenerationTask):
         """Computes number of samples
         Assuming every line is one example.
         """
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
-        self.example_counts = example_counts
+        self.example_counts = line_counts.count_lines_by_split(self.files_by_split)
 
     def get_metrics(self, reset=False):
         """Get metrics specific to the task
@@ -678,17 +676,20 @@ class LanguageModelingTask(SequenceGenerationTask):
         nll = self.scorer1.get_metric(reset)
         return {'perplexity': math.exp(nll)}
 
-    def load_data(self, path):
+    def load_data(self, path, max_seq_len=None):
         """Loading data file and tokenizing the text
         Args:
             path: (str) data file path
+            max_seq_len: (int) truncate sentences to this length, instead of
+                self.max_seq_len (e.g. when packing sentences into a token stream)
         """
+        max_seq_len = max_seq_len or self.max_seq_len
         with open(path) as txt_fh:
             for row in txt_fh:
                 toks = row.strip()
                 if not toks:
                     continue
-                yield process_sentence(toks, self.max_seq_len)
+                yield process_sentence(toks, max_seq_len)
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
         """Process a language modeling split by indexing and creating fields.
@@ -736,8 +737,9 @@ class WikiTextLMTask(LanguageModelingTask):
     def __init__(self, path, max_seq_len, name="wiki"):
         super().__init__(path, max_seq_len, name)
 
-    def load_data(self, path):
+    def load_data(self, path, max_seq_len=None):
         ''' Rather than return a whole list of examples, stream them '''
+        max_seq_len = max_seq_len or self.max_seq_len
         nonatomics_toks = [UNK_TOK_ALLENNLP, '<unk>']
         with open(path) as txt_fh:
             for row in txt_fh:
@@ -747,7 +749,7 @@ class WikiTextLMTask(LanguageModelingTask):
                 # WikiText103 preprocesses unknowns as '<unk>'
                 # which gets tokenized as '@', '@', 'UNKNOWN', ...
                 # We replace to avoid that
-                sent = _atomic_tokenize(toks, UNK_TOK_ATOMIC, nonatomics_toks, self.max_seq_len)
+                sent = _atomic_tokenize(toks, UNK_TOK_ATOMIC, nonatomics_toks, max_seq_len)
                 # we also filtering out headers (artifact of the data)
                 # which are processed to have multiple = signs
                 if sent.count("=") >= 2 or len(toks) < self.min_seq_len + 2:
@@ -854,10 +856,7 @@ class RedditTask(RankingTask):
 
     def count_examples(self):
         ''' Compute here b/c we're streaming the sentences. '''
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
-        self.example_counts = example_counts
+        self.example_counts = line_counts.count_lines_by_split(self.files_by_split)
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
         ''' Process split text into a list of AllenNLP Instances. '''
@@ -928,10 +927,7 @@ class RedditPairClassificationTask(PairClassificationTask):
 
     def count_examples(self):
         ''' Compute here b/c we're streaming the sentences. '''
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
-        self.example_counts = example_counts
+        self.example_counts = line_counts.count_lines_by_split(self.files_by_split)
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
         ''' Process split text into a list of AllenNLP Instances. '''
@@ -981,12 +977,7 @@ class MTDataPairClassificationTask(RedditPairClassificationTask):
 
     def count_examples(self):
         ''' Compute here b/c we're streaming the sentences. '''
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(
-                1 for line in codecs.open(
-                    split_path, 'r', 'utf-8', errors='ignore'))
-        self.example_counts = example_counts
+        self.example_counts = line_counts.count_lines_by_split(self.files_by_split)
 
 
 @register_task('cola', rel_path='CoLA/')
@@ -1834,12 +1825,7 @@ class MTTask(SequenceGenerationTask):
 
     def count_examples(self):
         ''' Compute here b/c we're streaming the sentences. '''
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(
-                1 for line in codecs.open(
-                    split_path, 'r', 'utf-8', errors='ignore'))
-        self.example_counts = example_counts
+        self.example_counts = line_counts.count_lines_by_split(self.files_by_split)
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
         ''' Process split text into a list of AllenNLP Instances. '''
@@ -1994,11 +1980,9 @@ class Wiki103Classification(PairClassificationTask):
 
     def count_examples(self):
         ''' Compute here b/c we're streaming the sentences. '''
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            # pair sentence # = sent # - 1
-            example_counts[split] = sum(1 for line in open(split_path)) - 1
-        self.example_counts = example_counts
+        example_counts = line_counts.count_lines_by_split(self.files_by_split)
+        # pair sentence # = sent # - 1
+        self.example_counts = {split: count - 1 for split, count in example_counts.items()}
 
 
 @register_task('wiki103_s2s', rel_path='WikiText103/', max_targ_v_size=0)
@@ -2108,10 +2092,7 @@ class DisSentTask(PairClassificationTask):
 
     def count_examples(self):
         ''' Compute the counts here b/c we're streaming the sentences. '''
-        example_counts = {}
-        for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
-        self.example_counts = example_counts
+        self.example_counts = line_counts.count_lines_by_split(self.files_by_split)
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
         ''' Process split text into a list of AllenNLP Instances. '''
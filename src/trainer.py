@@ -13,7 +13,6 @@ import numpy as np
 import torch
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.nn.utils.clip_grad import clip_grad_norm_
-from tensorboardX import SummaryWriter  # pylint: disable=import-error
 
 from allennlp.common import Params  # pylint: disable=import-error
 from allennlp.common.checks import ConfigurationError  # pylint: disable=import-error
@@ -23,7 +22,19 @@ from allennlp.training.optimizers import Optimizer  # pylint: disable=import-err
 
 from .utils import device_mapping, assert_for_log  # pylint: disable=import-error
 from .evaluate import evaluate
+from .profiling import TrainingProfiler, TraceWindow, get_batch_num_tokens
+from .checkpoint import CheckpointWriter
+from .precision import MixedPrecision
+from .validation_worker import ValidationWorker
+from .serialize import RepeatableIterator
+from .lm_stream import TokenStream
+from . import checkpoint
 from . import config
+from . import distributed
+from . import serialize
+from .lazy import lazy_import
+
+tensorboardX = lazy_import("tensorboardX")  # only needed for training
 
 
 def build_trainer_params(args, task_names):
@@ -39,7 +50,11 @@ def build_trainer_params(args, task_names):
     extra_opts = ['sent_enc', 'd_hid', 'warmup',
                   'max_grad_norm', 'min_lr', 'batch_size',
                   'cuda', 'keep_all_checkpoints',
-                  'val_data_limit', 'training_data_fraction']
+                  'val_data_limit', 'training_data_fraction',
+                  'profile_sync_cuda', 'profile_trace_start', 'profile_trace_steps',
+                  'async_checkpoint', 'checkpoint_format', 'accumulation_steps',
+                  'precision', 'async_validation_threads', 'val_early_exit',
+                  'val_early_exit_ci', 'val_early_exit_min_examples']
     for attr in train_opts:
         params[attr] = _get_task_attr(attr)
     for attr in extra_opts:
@@ -100,18 +115,76 @@ def build_trainer(params, model, run_dir, metric_should_decrease=True):
                            'keep_all_checkpoints': params['keep_all_checkpoints'],
                            'val_data_limit': params['val_data_limit'],
                            'dec_val_scale': params['dec_val_scale'],
-                           'training_data_fraction': params['training_data_fraction']})
+                           'training_data_fraction': params['training_data_fraction'],
+                           'profile_sync_cuda': params['profile_sync_cuda'],
+                           'profile_trace_start': params['profile_trace_start'],
+                           'profile_trace_steps': params['profile_trace_steps'],
+                           'async_checkpoint': params['async_checkpoint'],
+                           'checkpoint_format': params['checkpoint_format'],
+                           'accumulation_steps': params['accumulation_steps'],
+                           'precision': params['precision'],
+                           'async_validation_threads': params['async_validation_threads'],
+                           'val_early_exit': params['val_early_exit'],
+                           'val_early_exit_ci': params['val_early_exit_ci'],
+                           'val_early_exit_min_examples': params['val_early_exit_min_examples']})
     trainer = SamplingMultiTaskTrainer.from_params(model, run_dir,
                                                    copy.deepcopy(train_params))
     return trainer, train_params, opt_params, schd_params
 
 
+class ValMetricEstimate(object):
+    ''' Running estimate of a validation metric over a stream of batches, with a confidence
+    interval.
+
+    Each batch's value is recovered from the cumulative metric by differencing, which is exact
+    for metrics that are averages over examples (accuracy, MSE) and an approximation for the rest
+    (F1, MCC, correlations, perplexity). The interval treats batches as a random sample from the
+    population_size examples being validated, so examples should come in random order. It
+    shrinks to zero once all of them have been seen.
+    '''
+
+    def __init__(self, population_size, z=1.96):
+        self._population_size = population_size
+        self._z = z
+        self._batch_values = []
+        self._prev_total = 0.0
+        self.n_examples = 0
+        self.value = None
+
+    def update(self, cumulative_value, n_examples):
+        ''' Add a batch of n_examples, after which the metric over all batches so far is
+        cumulative_value. '''
+        total = cumulative_value * (self.n_examples + n_examples)
+        self._batch_values.append((total - self._prev_total) / max(n_examples, 1))
+        self._prev_total = total
+        self.n_examples += n_examples
+        self.value = cumulative_value
+
+    def half_width(self):
+        n_batches = len(self._batch_values)
+        if n_batches < 2:
+            return float('inf')
+        std_err = np.std(self._batch_values, ddof=1) / math.sqrt(n_batches)
+        # Finite population correction: we're sampling without replacement.
+        fpc = max(0.0, 1.0 - self.n_examples / max(self._population_size, 1))
+        return self._z * std_err * math.sqrt(fpc)
+
+    def interval(self):
+        half_width = self.half_width()
+        return self.value - half_width, self.value + half_width
+
+
 class SamplingMultiTaskTrainer:
     def __init__(self, model, patience=2, val_interval=100, max_vals=50,
                  serialization_dir=None, cuda_device=-1,
                  grad_norm=None, grad_clipping=None, lr_decay=None, min_lr=None,
                  keep_all_checkpoints=False, val_data_limit=5000,
-                 dec_val_scale=100, training_data_fraction=1.0):
+                 dec_val_scale=100, training_data_fraction=1.0,
+                 profile_sync_cuda=False, profile_trace_start=-1,
+                 profile_trace_steps=20, async_checkpoint=True,
+                 checkpoint_format="indexed", accumulation_steps=1, precision="fp32",
+                 async_validation_threads=0, val_early_exit=False, val_early_exit_ci=0.005,
+                 val_early_exit_min_examples=500):
         """
         The training coordinator. Unusually complicated to handle MTL with tasks of
         diverse sizes.
@@ -148,6 +221,29 @@ class SamplingMultiTaskTrainer:
             Set to -1 to use all.
         training_data_fraction: If set to a float between 0 and 1, load only the specified percentage
             of examples. Hashing is used to ensure that the same examples are loaded each epoch.
+        profile_sync_cuda: If set, synchronize CUDA around each timed section so that step timings
+            (data wait, forward, backward, step, validate) are exact. Slows down training.
+        profile_trace_start: If >= 0, record a torch.autograd.profiler trace starting at this step.
+        profile_trace_steps: Number of steps to record in the profiler trace.
+        async_checkpoint: If set, write checkpoints on a background thread, so that training
+            continues while they're written. Checkpoints are always written atomically.
+        checkpoint_format: Format for model_state files: "indexed" (see checkpoint.save_indexed),
+            which supports partial loading and partial updates, or "torch" (torch.save).
+        accumulation_steps: Number of batches to accumulate gradients over before each optimizer
+            step. Each step (and so val_interval) then covers accumulation_steps batches.
+        precision: "fp32", or "bf16"/"fp16" to run the forward pass under autocast (see
+            precision.MixedPrecision). Parameters and checkpoints stay in fp32.
+        async_validation_threads: If > 0, validate in a background process with this many
+            threads, on a snapshot of the weights, while training continues (see
+            validation_worker.ValidationWorker). CPU only.
+        val_early_exit: If set, validate each task on its validation examples in a fixed random
+            order, and stop as soon as the 95% confidence interval of its val_metric is narrower
+            than +/- val_early_exit_ci. In single-task runs, also stop once it lies entirely on one
+            side of the best value so far (so more examples can't change whether this is a new
+            best, which is all patience and checkpointing depend on). In multi-task runs those
+            are decided by the macro average, so only the width counts. See ValMetricEstimate.
+        val_early_exit_min_examples: With val_early_exit, always validate on at least this many
+            examples per task.
         """
         self._model = model
 
@@ -164,8 +260,34 @@ class SamplingMultiTaskTrainer:
         self._val_data_limit = val_data_limit
         self._dec_val_scale = dec_val_scale
         self._training_data_fraction = training_data_fraction
+        self._profile_sync_cuda = profile_sync_cuda
+        self._profile_trace_start = profile_trace_start
+        self._profile_trace_steps = profile_trace_steps
+        assert_for_log(checkpoint_format in ["indexed", "torch"],
+                       "Unknown checkpoint_format: %s" % checkpoint_format)
+        self._checkpoint_writer = CheckpointWriter(
+            async_write=async_checkpoint,
+            indexed_prefixes=["model_state"] if checkpoint_format == "indexed" else [])
+        self._checkpoint_format = checkpoint_format
+        assert_for_log(accumulation_steps >= 1, "accumulation_steps must be at least 1.")
+        self._accumulation_steps = accumulation_steps
+        self._amp = MixedPrecision(precision, self._cuda_device)
+        if async_validation_threads > 0:
+            assert_for_log(cuda_device < 0, "async_validation_threads is only supported on CPU.")
+            assert_for_log(not distributed.is_distributed(),
+                           "async_validation_threads isn't supported with distributed training.")
+        self._async_validation_threads = async_validation_threads
+        if val_early_exit:
+            # Ranks would stop at different points, and their results couldn't be combined.
+            assert_for_log(not distributed.is_distributed(),
+                           "val_early_exit isn't supported with distributed training.")
+        self._val_early_exit = val_early_exit
+        self._val_early_exit_ci = val_early_exit_ci
+        self._val_early_exit_min_examples = val_early_exit_min_examples
+        self._train_param_names = None
 
         self._task_infos = None
+        self._profiler = None
         self._metric_infos = None
 
         self._log_interval = 10  # seconds
@@ -173,11 +295,11 @@ class SamplingMultiTaskTrainer:
             self._model = self._model.cuda(self._cuda_device)
 
         self._TB_dir = None
-        if self._serialization_dir is not None:
+        if self._serialization_dir is not None and distributed.is_main_process():
             self._TB_dir = os.path.join(self._serialization_dir, "tensorboard")
-            self._TB_train_log = SummaryWriter(
+            self._TB_train_log = tensorboardX.SummaryWriter(
                 os.path.join(self._TB_dir, "train"))
-            self._TB_validation_log = SummaryWriter(
+            self._TB_validation_log = tensorboardX.SummaryWriter(
                 os.path.join(self._TB_dir, "val"))
 
     def _check_history(self, metric_history, cur_score, should_decrease=False):
@@ -238,18 +360,26 @@ class SamplingMultiTaskTrainer:
         for task in tasks:
             task_info = task_infos[task.name]
 
-            # Adding task-specific smart iterator to speed up training
-            instance = [i for i in itertools.islice(task.train_data, 1)][0]
-            pad_dict = instance.get_padding_lengths()
-            sorting_keys = []
-            for field in pad_dict:
-                for pad_field in pad_dict[field]:
-                    sorting_keys.append((field, pad_field))
-            iterator = BucketIterator(sorting_keys=sorting_keys,
-                                      max_instances_in_memory=10000,
-                                      batch_size=batch_size,
-                                      biggest_batch_first=True)
-            tr_generator = iterator(task.train_data, num_epochs=None, cuda_device=self._cuda_device)
+            if isinstance(task.train_data, TokenStream):
+                # Packed LM data comes in fixed-length windows, so there's nothing to bucket.
+                iterator = None
+                tr_generator = task.train_data.batches(batch_size, num_epochs=None, shuffle=True,
+                                                       cuda_device=self._cuda_device,
+                                                       shard=distributed.get_shard())
+            else:
+                # Adding task-specific smart iterator to speed up training
+                instance = [i for i in itertools.islice(task.train_data, 1)][0]
+                pad_dict = instance.get_padding_lengths()
+                sorting_keys = []
+                for field in pad_dict:
+                    for pad_field in pad_dict[field]:
+                        sorting_keys.append((field, pad_field))
+                iterator = BucketIterator(sorting_keys=sorting_keys,
+                                          max_instances_in_memory=10000,
+                                          batch_size=batch_size,
+                                          biggest_batch_first=True)
+                tr_generator = iterator(task.train_data, num_epochs=None,
+                                        cuda_device=self._cuda_device)
 
             task_info['iterator'] = iterator
 
@@ -258,9 +388,11 @@ class SamplingMultiTaskTrainer:
                 # or excluded independently using a hashing function. Fortunately, it
                 # doesn't need to be.
                 task_info['n_tr_batches'] = math.ceil(
-                    task.n_train_examples * self._training_data_fraction / batch_size)
+                    distributed.shard_size(task.n_train_examples) *
+                    self._training_data_fraction / batch_size)
             else:
-                task_info['n_tr_batches'] = math.ceil(task.n_train_examples / batch_size)
+                task_info['n_tr_batches'] = math.ceil(
+                    distributed.shard_size(task.n_train_examples) / batch_size)
 
             task_info['tr_generator'] = tr_generator
             task_info['loss'] = 0.0
@@ -295,7 +427,9 @@ class SamplingMultiTaskTrainer:
         stop_metric: The metric to use for early stopping.
         batch_size: The batch size to use for the tasks
         n_batches_per_pass: How many training steps per task per pass.
-        weighting_method: How to sample which task to use.
+        weighting_method: How to sample which task to use. With a "time_" prefix, e.g.
+            "time_uniform" or "time_proportional", the weights give each task's share of compute
+            time rather than of steps, using per-step costs measured during training.
         scaling_method: How to scale gradients.
         train_params: Trainer config object.
         optimizer_params: Optimizer config object.
@@ -309,8 +443,15 @@ class SamplingMultiTaskTrainer:
         Validation results
         """
         validation_interval = self._val_interval
+        self._train_param_names = set(name for name, _ in train_params)
         task_infos, metric_infos = self._setup_training(tasks, batch_size, train_params,
                                                         optimizer_params, scheduler_params, phase)
+        profiler = TrainingProfiler(self._cuda_device, sync_cuda=self._profile_sync_cuda)
+        self._profiler = profiler
+        trace_path = os.path.join(self._serialization_dir or ".",
+                                  "profile_trace_{}.json".format(phase))
+        trace_window = TraceWindow(self._profile_trace_start, self._profile_trace_steps,
+                                   trace_path, use_cuda=(self._cuda_device >= 0))
 
         if shared_optimizer:  # if shared_optimizer, ignore task_specific optimizers
             g_optimizer = Optimizer.from_params(train_params, copy.deepcopy(optimizer_params))
@@ -337,6 +478,9 @@ class SamplingMultiTaskTrainer:
                                "If you don't want them, delete them or change your experiment name." %
                                self._serialization_dir)
 
+        # Start all ranks from the same parameters.
+        distributed.broadcast_parameters(self._model)
+
         if self._grad_clipping is not None:  # pylint: disable=invalid-unary-operand-type
             def clip_function(grad): return grad.clamp(-self._grad_clipping, self._grad_clipping)
             for parameter in self._model.parameters():
@@ -351,6 +495,11 @@ class SamplingMultiTaskTrainer:
         task_n_train_batches = np.array([task_infos[task.name]['n_tr_batches'] for task in tasks])
         log.info("Training examples per task: " + str(dict(zip(task_names, task_n_train_examples))))
 
+        time_based = weighting_method.startswith('time_')
+        if time_based:
+            weighting_method = weighting_method[len('time_'):]
+            log.info("Weighting tasks by compute time, using measured step costs.")
+
         if weighting_method == 'uniform':
             sample_weights = [1.0] * len(tasks)
             log.info("Sampling tasks uniformly.")
@@ -385,8 +534,35 @@ class SamplingMultiTaskTrainer:
         log.info("Using weighting method: %s, with normalized sample weights %s ",
                  weighting_method, np.array_str(normalized_sample_weights, precision=4))
 
+        # All ranks must train on the same task at each step, so in distributed training
+        # sample from a generator seeded the same way on every rank.
+        if distributed.is_distributed():
+            sample_rng = random.Random(distributed.broadcast_int(random.randrange(2**31)))
+        else:
+            sample_rng = random
+
+        def _draw_samples():
+            weights = np.array(sample_weights, dtype=float)
+            if time_based:
+                # To give each task its share of time, divide by its cost per step. Tasks
+                # without measurements yet are assumed to cost the mean.
+                costs = np.array([profiler.mean_step_time(task.name) for task in tasks])
+                costs = np.array(distributed.all_reduce_sum(costs)) / distributed.get_world_size()
+                known = costs > 0
+                if known.any():
+                    costs[~known] = costs[known].mean()
+                    weights = weights / costs
+            # Don't waste steps on stopped tasks.
+            active = np.array([not task_infos[task.name]['stopped'] for task in tasks])
+            if active.any():
+                weights = weights * active
+            if time_based:
+                log.info("Sampling weights from compute time: %s",
+                         np.array_str(weights / weights.sum(), precision=4))
+            return sample_rng.choices(tasks, weights=weights, k=validation_interval)
+
         # Sample the tasks to train on. Do it all at once (val_interval) for MAX EFFICIENCY.
-        samples = random.choices(tasks, weights=sample_weights, k=validation_interval)
+        samples = _draw_samples()
 
         if scaling_method == 'uniform':
             scaling_weights = [1.0] * len(tasks)
@@ -418,6 +594,51 @@ class SamplingMultiTaskTrainer:
             scaling_method,
             str(scaling_weights))
 
+        def _after_validation(epoch, val_n_pass, val_tasks, tr_metrics, all_val_metrics,
+                              model_state=None, task_states=None):
+            ''' Act on the validation results for epoch, taken after val_n_pass steps. With
+            background validation, model_state and task_states are the model and training state
+            that was validated. Returns whether to stop training. '''
+            should_save, new_best_macro = self._update_metric_infos(
+                epoch, val_tasks, all_val_metrics, periodic_save=(phase != "eval"))
+
+            # Check stopping conditions
+            should_stop = self._check_stop(epoch, stop_metric, tasks)
+
+            # Log results to logger and tensorboard
+            if validator is not None:
+                log.info("Validation results for epoch %d (from pass %d; now at pass %d):",
+                         epoch, val_n_pass, n_pass)
+            for name, value in all_val_metrics.items():
+                log.info("Statistic: %s", name)
+                if name in tr_metrics:
+                    log.info("\ttraining: %3f", tr_metrics[name])
+                log.info("\tvalidation: %3f", value)
+            if self._TB_dir is not None:
+                self._metrics_to_tensorboard_val(val_n_pass, all_val_metrics)
+            lrs = self._get_lr()  # log LR
+            for name, value in lrs.items():
+                log.info("%s: %.6f", name, value)
+            elmo_params = self._model.get_elmo_mixing_weights(tasks)
+            if elmo_params:  # log ELMo mixing weights
+                for task_name, task_params in elmo_params.items():
+                    log.info("ELMo mixing weights for {}:".format(task_name))
+                    log.info("\t" + ", ".join(["{}: {:.6f}".format(layer, float(param))
+                                               for layer, param in task_params.items()]))
+
+            if should_save:
+                if task_states is not None:
+                    self._apply_val_decisions(task_states)
+                self._save_checkpoint(
+                    {"pass": val_n_pass, "epoch": epoch, "should_stop": should_stop},
+                    phase=phase, new_best_macro=new_best_macro, model_state=model_state,
+                    task_states=task_states)
+            return should_stop
+
+        validator = None
+        if self._async_validation_threads > 0:
+            validator = ValidationWorker(self, tasks, batch_size, self._async_validation_threads)
+
         log.info("Beginning training. Stopping metric: %s", stop_metric)
         all_tr_metrics = {}
         log.info("Beginning training. Stopping metric: %s", stop_metric)
@@ -426,33 +647,56 @@ class SamplingMultiTaskTrainer:
             task = samples[n_pass % validation_interval]  # randomly select a task
             task_info = task_infos[task.name]
             if task_info['stopped']:
-                continue
+                # Stopped tasks aren't sampled (see _draw_samples) unless every task has stopped.
+                # Count the step without training, rather than spinning here without advancing
+                # n_pass, so that validation and the stopping checks are still reached.
+                n_batches_this_pass = 0
+                n_pass += 1
+            else:
+                n_batches_this_pass = n_batches_per_pass
             tr_generator = task_info['tr_generator']
             optimizer = g_optimizer if shared_optimizer else task_info['optimizer']
             scheduler = g_scheduler if shared_optimizer else task_info['scheduler']
             total_batches_trained = task_info['total_batches_trained']
             n_batches_since_val = task_info['n_batches_since_val']
             tr_loss = task_info['loss']
-            for batch in itertools.islice(tr_generator, n_batches_per_pass):
+            accumulation_steps = self._accumulation_steps
+            batches = itertools.islice(tr_generator, n_batches_this_pass * accumulation_steps)
+            for batch_idx, batch in enumerate(profiler.timed_iter(task.name, batches)):
+                trace_window.step(n_pass)
                 n_batches_since_val += 1
                 total_batches_trained += 1
-                optimizer.zero_grad()
-                output_dict = self._forward(batch, task=task, for_training=True)
+                with profiler.timer(task.name, 'forward'):
+                    if batch_idx % accumulation_steps == 0:
+                        optimizer.zero_grad()
+                    with self._amp.autocast():
+                        output_dict = self._forward(batch, task=task, for_training=True)
                 assert_for_log("loss" in output_dict,
                                "Model must return a dict containing a 'loss' key")
                 loss = output_dict["loss"]  # optionally scale loss
 
                 loss *= scaling_weights[task.name]
 
-                loss.backward()
-                assert_for_log(not torch.isnan(loss).any(), "NaNs in loss.")
-                tr_loss += loss.data.cpu().numpy()
+                with profiler.timer(task.name, 'backward'):
+                    # Average over the accumulated batches, so that the update doesn't depend
+                    # on accumulation_steps.
+                    self._amp.backward(loss / accumulation_steps)
+                    assert_for_log(not torch.isnan(loss).any(), "NaNs in loss.")
+                    tr_loss += loss.data.cpu().numpy()
+                profiler.add_counts(task.name, n_exs=output_dict.get("n_exs", 0),
+                                    n_tokens=get_batch_num_tokens(batch))
+                if (batch_idx + 1) % accumulation_steps != 0:
+                    continue
 
                 # Gradient regularization and application
-                if self._grad_norm:
-                    clip_grad_norm_(self._model.parameters(), self._grad_norm)
-                optimizer.step()
-                n_pass += 1  # update per batch
+                with profiler.timer(task.name, 'step'):
+                    self._amp.unscale_(optimizer)
+                    distributed.average_gradients(
+                        [p for group in optimizer.param_groups for p in group['params']])
+                    if self._grad_norm:
+                        clip_grad_norm_(self._model.parameters(), self._grad_norm)
+                    self._amp.step(optimizer)
+                n_pass += 1  # update per optimizer step
 
                 # step scheduler if it's not ReduceLROnPlateau
                 if not isinstance(scheduler.lr_scheduler, ReduceLROnPlateau):
@@ -464,20 +708,25 @@ class SamplingMultiTaskTrainer:
             task_info['loss'] = tr_loss
 
             # Intermediate log to logger and tensorboard
-            if time.time() - task_info['last_log'] > self._log_interval:
+            if n_batches_this_pass > 0 and \
+                    time.time() - task_info['last_log'] > self._log_interval:
                 task_metrics = task.get_metrics()
+                perf_stats = profiler.pop_window(task.name)
 
                 # log to tensorboard
                 if self._TB_dir is not None:
                     task_metrics_to_TB = task_metrics.copy()
                     task_metrics_to_TB["loss"] = \
                         float(task_info['loss'] / n_batches_since_val)
+                    for name, value in perf_stats.items():
+                        task_metrics_to_TB["perf_%s" % name] = value
                     self._metrics_to_tensorboard_tr(n_pass, task_metrics_to_TB, task.name)
 
                 task_metrics["%s_loss" % task.name] = tr_loss / n_batches_since_val
                 description = self._description_from_metrics(task_metrics)
                 log.info("Update %d: task %s, batch %d (%d): %s", n_pass,
                          task.name, n_batches_since_val, total_batches_trained, description)
+                log.info("Throughput: %s", profiler.format_window(task.name, perf_stats))
 
                 task_info['last_log'] = time.time()
 
@@ -511,43 +760,51 @@ class SamplingMultiTaskTrainer:
 
                 # Validate
                 log.info("Validating...")
-                all_val_metrics, should_save, new_best_macro = self._validate(
-                    epoch, tasks, batch_size, periodic_save=(phase != "eval"))
-
-                # Check stopping conditions
-                should_stop = self._check_stop(epoch, stop_metric, tasks)
-
-                # Log results to logger and tensorboard
-                for name, value in all_val_metrics.items():
-                    log.info("Statistic: %s", name)
-                    if name in all_tr_metrics:
-                        log.info("\ttraining: %3f", all_tr_metrics[name])
-                    log.info("\tvalidation: %3f", value)
-                if self._TB_dir is not None:
-                    self._metrics_to_tensorboard_val(n_pass, all_val_metrics)
-                lrs = self._get_lr()  # log LR
-                for name, value in lrs.items():
-                    log.info("%s: %.6f", name, value)
-                elmo_params = self._model.get_elmo_mixing_weights(tasks)
-                if elmo_params:  # log ELMo mixing weights
-                    for task_name, task_params in elmo_params.items():
-                        log.info("ELMo mixing weights for {}:".format(task_name))
-                        log.info("\t" + ", ".join(["{}: {:.6f}".format(layer, float(param))
-                                                   for layer, param in task_params.items()]))
-
-                # Reset training preogress
+                if validator is not None:
+                    # Bound the lag to one validation: wait for the previous results first.
+                    for result in validator.poll(wait=True):
+                        should_stop = _after_validation(*result) or should_stop
+                    # All earlier results are applied, so the bests passed along are current.
+                    val_bests = self._get_val_bests(tasks) if self._val_early_exit else None
+                    # The result may be saved as a checkpoint, so keep the optimizer and task
+                    # state from this step with the weights. (Eval checkpoints only have weights.)
+                    task_states = checkpoint.snapshot_to_cpu(self._get_task_states()) \
+                        if phase != "eval" else None
+                    validator.submit(epoch, n_pass, tasks, all_tr_metrics,
+                                     checkpoint.snapshot_to_cpu(self._get_trainable_state()),
+                                     val_bests=val_bests, task_states=task_states)
+                    self._reset_training_progress(tasks)
+                else:
+                    all_val_metrics = self._compute_val_metrics(tasks, batch_size)
+                    self._reset_training_progress(tasks)
+                    should_stop = _after_validation(epoch, n_pass, tasks, all_tr_metrics,
+                                                    all_val_metrics)
                 all_tr_metrics = {}
-                samples = random.choices(
-                    tasks,
-                    weights=sample_weights,
-                    k=validation_interval)  # pylint: disable=no-member
+                # With background validation, this uses results up to the previous validation.
+                samples = _draw_samples()
+
+            # Apply background validation results as they arrive.
+            if validator is not None:
+                for result in validator.poll():
+                    should_stop = _after_validation(*result) or should_stop
 
-                if should_save:
-                    self._save_checkpoint(
-                        {"pass": n_pass, "epoch": epoch, "should_stop": should_stop},
-                        phase=phase, new_best_macro=new_best_macro)
+        if validator is not None:
+            # Apply any outstanding results, e.g. a later best epoch, but don't train further.
+            for result in validator.poll(wait=True):
+                _after_validation(*result)
+            validator.close()
 
         log.info('Stopped training after %d validation checks', n_pass / validation_interval)
+        trace_window.close()
+        # Make sure checkpoints are on disk before anyone tries to load them.
+        self._checkpoint_writer.wait()
+        distributed.barrier()
+        if self._serialization_dir is not None and distributed.is_main_process():
+            if phase == "eval":
+                profile_name = "profile_eval_{}.json".format("-".join(task_names))
+            else:
+                profile_name = "profile_{}.json".format(phase)
+            profiler.write_summary(os.path.join(self._serialization_dir, profile_name))
         return self._aggregate_results(tasks, task_infos, metric_infos)  # , validation_interval)
 
     def _aggregate_results(self, tasks, task_infos, metric_infos):
@@ -571,27 +828,66 @@ class SamplingMultiTaskTrainer:
 
     def _validate(self, epoch, tasks, batch_size, periodic_save=True):
         ''' Validate on all tasks and return the results and whether to save this epoch or not '''
-        task_infos, metric_infos = self._task_infos, self._metric_infos
-        g_scheduler = self._g_scheduler
+        all_val_metrics = self._compute_val_metrics(tasks, batch_size)
+        self._reset_training_progress(tasks)
+        should_save, new_best_macro = self._update_metric_infos(epoch, tasks, all_val_metrics,
+                                                                periodic_save)
+        return all_val_metrics, should_save, new_best_macro
+
+    def _reset_training_progress(self, tasks):
+        for task in tasks:
+            self._task_infos[task.name]['n_batches_since_val'] = 0
+            self._task_infos[task.name]['loss'] = 0
+
+    def _compute_val_metrics(self, tasks, batch_size, val_bests=None):
+        ''' Run validation on tasks with the current model, and return the metrics.
+
+        val_bests is used for early exit (see _get_val_bests). It defaults to the current bests,
+        but a background validation process must be given them: its copy of the metric history
+        is from when it was forked. '''
+        task_infos = self._task_infos
         self._model.eval()
         all_val_metrics = {("%s_loss" % task.name): 0.0 for task in tasks}
         all_val_metrics["macro_avg"] = 0.0
         all_val_metrics["micro_avg"] = 0.0
         n_examples_overall = 0.0
+        if self._val_early_exit and val_bests is None:
+            val_bests = self._get_val_bests(tasks)
 
         # Get validation numbers for each task
         for task in tasks:
             n_examples, batch_num = 0, 0
             task_info = task_infos[task.name]
+            val_start_time = time.time()
 
             # to speed up training, we evaluate on a subset of validation data
             if self._val_data_limit >= 0:
                 max_data_points = min(task.n_val_examples, self._val_data_limit)
             else:
                 max_data_points = task.n_val_examples
-            val_generator = BasicIterator(batch_size, instances_per_epoch=max_data_points)(
-                task.val_data, num_epochs=1, shuffle=False,
-                cuda_device=self._cuda_device)
+            val_data = task.val_data
+            estimate = None
+            if self._val_early_exit:
+                if not isinstance(task.val_data, TokenStream):
+                    val_data = self._get_shuffled_val_data(task, max_data_points)
+                estimate = ValMetricEstimate(max_data_points)
+                metric_name = task.val_metric[len(task.name) + 1:]
+            if isinstance(task.val_data, TokenStream):
+                # Shuffled the same way at every validation, as for _get_shuffled_val_data.
+                val_generator = task.val_data.batches(
+                    batch_size, num_epochs=1, shuffle=estimate is not None,
+                    cuda_device=self._cuda_device, max_windows=max_data_points,
+                    shard=distributed.get_shard(), seed=0)
+                max_data_points = distributed.shard_size(max_data_points)
+            else:
+                if distributed.is_distributed():
+                    # Each rank validates on its own share, and the results are combined below.
+                    val_data = RepeatableIterator(
+                        lambda: distributed.shard_iterable(task.val_data, max_data_points))
+                    max_data_points = distributed.shard_size(max_data_points)
+                val_generator = BasicIterator(batch_size, instances_per_epoch=max_data_points)(
+                    val_data, num_epochs=1, shuffle=False,
+                    cuda_device=self._cuda_device)
             n_val_batches = math.ceil(max_data_points / batch_size)
             all_val_metrics["%s_loss" % task.name] = 0.0
 
@@ -602,6 +898,21 @@ class SamplingMultiTaskTrainer:
                 all_val_metrics["%s_loss" % task.name] += loss.data.cpu().numpy()
                 n_examples += out["n_exs"]
 
+                if estimate is not None:
+                    task_metrics = task.get_metrics()
+                    if metric_name not in task_metrics:
+                        log.warning("Can't find %s in %s metrics; validating on all examples.",
+                                    metric_name, task.name)
+                        estimate = None
+                    else:
+                        estimate.update(task_metrics[metric_name], out["n_exs"])
+                        if self._can_stop_validation(task, estimate, val_bests[task.name]):
+                            lower, upper = estimate.interval()
+                            log.info("%s: stopping validation after %d/%d examples: %s = %.4f, "
+                                     "95%% CI [%.4f, %.4f]", task.name, estimate.n_examples,
+                                     max_data_points, metric_name, estimate.value, lower, upper)
+                            break
+
                 # log
                 if time.time() - task_info['last_log'] > self._log_interval:
                     task_metrics = task.get_metrics()
@@ -610,10 +921,20 @@ class SamplingMultiTaskTrainer:
                     description = self._description_from_metrics(task_metrics)
                     log.info("Batch %d/%d: %s", batch_num, n_val_batches, description)
                     task_info['last_log'] = time.time()
-            assert batch_num == n_val_batches
+            assert batch_num == n_val_batches or estimate is not None
 
             # Get task validation metrics and store in all_val_metrics
             task_metrics = task.get_metrics(reset=True)
+            if distributed.is_distributed():
+                # Average metrics across ranks, weighted by number of examples. This is exact
+                # for accuracy-like metrics, and an approximation for F1, correlations, etc.
+                names = sorted(task_metrics)
+                totals = distributed.all_reduce_sum(
+                    [task_metrics[name] * n_examples for name in names] +
+                    [all_val_metrics["%s_loss" % task.name], batch_num, n_examples])
+                task_metrics = {name: total / max(totals[-1], 1)
+                                for name, total in zip(names, totals)}
+                all_val_metrics["%s_loss" % task.name], batch_num, n_examples = totals[-3:]
             for name, value in task_metrics.items():
                 all_val_metrics["%s_%s" % (task.name, name)] = value
             all_val_metrics["%s_loss" % task.name] /= batch_num  # n_val_batches
@@ -629,12 +950,70 @@ class SamplingMultiTaskTrainer:
                 all_val_metrics["macro_avg"] += all_val_metrics[task.val_metric]
             n_examples_overall += n_examples
 
-            # Reset training progress
-            task_info['n_batches_since_val'] = 0
-            task_info['loss'] = 0
+            if self._profiler is not None:
+                self._profiler.add_time(task.name, 'validate', time.time() - val_start_time)
 
         all_val_metrics['micro_avg'] /= n_examples_overall
         all_val_metrics['macro_avg'] /= len(tasks)
+        return all_val_metrics
+
+    def _get_shuffled_val_data(self, task, max_data_points):
+        ''' The first max_data_points validation examples of task, in a random order that's the
+        same at every validation (and across runs), so that early-exit validation sees a random
+        sample, and successive validations are compared on the same examples. Only the order
+        (the records' byte offsets) is kept between validations; the examples are re-read. '''
+        assert_for_log(isinstance(task.val_data, serialize.RecordIterator),
+                       "val_early_exit needs %s's validation data in a record file." % task.name)
+        task_info = self._task_infos[task.name]
+        if task_info.get('val_offsets') is None:
+            offsets = serialize.record_offsets(task.val_data.filename, max_data_points)
+            random.Random(task.name).shuffle(offsets)
+            task_info['val_offsets'] = offsets
+        return serialize.read_records_at(task.val_data.filename, task_info['val_offsets'],
+                                         repeatable=True)
+
+    def _get_val_bests(self, tasks):
+        ''' The best value so far of each task's val_metric, by task name, for
+        _can_stop_validation. None if there's none yet, or if it doesn't decide anything. '''
+        # Only in single-task runs is a task's metric what patience, stopping and the best
+        # checkpoint depend on (the macro average is the same). In multi-task runs, they depend
+        # on the macro average, which a task's result can change however it compares to that
+        # task's own best.
+        single_task = len(self._task_infos) == 1
+        val_bests = {}
+        for task in tasks:
+            metric_info = self._metric_infos[task.val_metric]
+            if not single_task or metric_info['stopped'] or not metric_info['hist']:
+                val_bests[task.name] = None
+            elif task.val_metric_decreases:
+                val_bests[task.name] = min(metric_info['hist'])
+            else:
+                val_bests[task.name] = max(metric_info['hist'])
+        return val_bests
+
+    def _can_stop_validation(self, task, estimate, best):
+        ''' Check whether validating task on more examples could still change its results.
+        best is the best value of its val_metric so far, from _get_val_bests. '''
+        if estimate.n_examples < self._val_early_exit_min_examples:
+            return False
+        if estimate.half_width() <= self._val_early_exit_ci:
+            return True
+        if best is None:
+            return False
+        # Whether this is a new best is the only thing _check_history needs from this value.
+        # If the whole interval is on one side of the best so far, that's decided.
+        lower, upper = estimate.interval()
+        if task.val_metric_decreases:
+            return upper < best or lower >= best
+        else:
+            return lower > best or upper <= best
+
+    def _update_metric_infos(self, epoch, tasks, all_val_metrics, periodic_save=True):
+        ''' Record validation results for epoch: track the best epoch and patience for each
+        metric, and advance ReduceLROnPlateau schedulers. Returns whether to save a checkpoint,
+        and whether this epoch is a new best for the macro average. '''
+        task_infos, metric_infos = self._task_infos, self._metric_infos
+        g_scheduler = self._g_scheduler
 
         # Track per task patience
         should_save = periodic_save  # whether to save this epoch or not.
@@ -683,7 +1062,7 @@ class SamplingMultiTaskTrainer:
                 log.info("\tBest %s: %.3f", metric, scheduler.lr_scheduler.best)
                 log.info("\t# bad epochs: %d", scheduler.lr_scheduler.num_bad_epochs)
 
-        return all_val_metrics, should_save, new_best_macro
+        return should_save, new_best_macro
 
     def _get_lr(self):
         ''' Get learning rate from the optimizer we're using '''
@@ -758,7 +1137,16 @@ class SamplingMultiTaskTrainer:
             if ".best_macro" not in file and "_{}.".format(epoch) not in file:
                 os.remove(file)
 
-    def _save_checkpoint(self, training_state, phase="main", new_best_macro=False, keep_all=False):
+    def _get_trainable_state(self):
+        ''' The model's state dict, without non-trainable params like the main ELMo params. '''
+        model_state = self._model.state_dict()
+        for name, param in self._model.named_parameters():
+            if not param.requires_grad:
+                del model_state[name]
+        return model_state
+
+    def _save_checkpoint(self, training_state, phase="main", new_best_macro=False, keep_all=False,
+                         model_state=None, task_states=None):
         """
         Parameters
         ----------
@@ -766,63 +1154,47 @@ class SamplingMultiTaskTrainer:
         phase: Usually 'main' or 'eval'.
         new_best_macro: If true, the saved checkpoint will be marked with .best_macro, and
             potentially used later when switching from main to eval training.
+        model_state: Model parameters to save, if not the current ones (as from
+            _get_trainable_state).
+        task_states: Per-task training state to save, if not the current one (as from
+            _get_task_states).
         """
         if not self._serialization_dir:
             raise ConfigurationError("serialization_dir not specified - cannot "
                                      "restore a model without a directory path.")
+        # All ranks have the same state, so only one needs to save it.
+        if not distributed.is_main_process():
+            return
 
         epoch = training_state["epoch"]
         if phase == "eval":
-            model_path = os.path.join(
-                self._serialization_dir,
-                "model_state_eval_best.th")
+            suffix = "eval_best.th"
         else:
             if new_best_macro:
                 best_str = ".best_macro"
             else:
                 best_str = ""
-
-            model_path = os.path.join(
-                self._serialization_dir,
-                "model_state_{}_epoch_{}{}.th".format(
-                    phase, epoch, best_str))
-
-        model_state = self._model.state_dict()
-
-        # Skip non-trainable params, like the main ELMo params.
-        for name, param in self._model.named_parameters():
-            if not param.requires_grad:
-                del model_state[name]
-        torch.save(model_state, model_path)
+            suffix = "{}_epoch_{}{}.th".format(phase, epoch, best_str)
+
+        if model_state is None:
+            model_state = self._get_trainable_state()
+
+        # In the eval phase only the task-specific params being trained change, so if the
+        # best eval checkpoint already exists, just rewrite those.
+        update = (phase == "eval" and self._checkpoint_format == "indexed" and
+                  checkpoint.is_indexed(checkpoint.get_path(self._serialization_dir,
+                                                            "model_state", suffix)))
+        if update:
+            task_prefixes = tuple("%s_mdl." % task_name for task_name in self._task_infos)
+            model_state = {name: value for name, value in model_state.items()
+                           if name in self._train_param_names or name.startswith(task_prefixes)}
+        files = [("model_state", model_state)]
 
         if phase != "eval":
-            torch.save(
-                training_state,
-                os.path.join(
-                    self._serialization_dir,
-                    "training_state_{}_epoch_{}{}.th".format(
-                        phase, epoch, best_str)))
-
-            task_states = {}
-            for task_name, task_info in self._task_infos.items():
-                task_states[task_name] = {}
-                task_states[task_name]['total_batches_trained'] = task_info['total_batches_trained']
-                task_states[task_name]['stopped'] = task_info['stopped']
-                if self._g_optimizer is None:
-                    task_states[task_name]['optimizer'] = task_info['optimizer'].state_dict()
-                    sched_params = {}
-                    task_states[task_name]['scheduler'] = sched_params
-            task_states['global'] = {}
-            task_states['global']['optimizer'] = self._g_optimizer.state_dict() if \
-                self._g_optimizer is not None else None
-            if self._g_scheduler is not None:
-                sched_params = {}
-                task_states['global']['scheduler'] = sched_params
-            else:
-                task_states['global']['scheduler'] = None
-            torch.save(task_states, os.path.join(self._serialization_dir,
-                                                 "task_state_{}_epoch_{}{}.th".format(
-                                                     phase, epoch, best_str)))
+            files.append(("training_state", training_state))
+            if task_states is None:
+                task_states = self._get_task_states()
+            files.append(("task_state", task_states))
 
             metric_states = {}
             for metric_name, metric_info in self._metric_infos.items():
@@ -830,19 +1202,57 @@ class SamplingMultiTaskTrainer:
                 metric_states[metric_name]['hist'] = metric_info['hist']
                 metric_states[metric_name]['stopped'] = metric_info['stopped']
                 metric_states[metric_name]['best'] = metric_info['best']
-            torch.save(
-                metric_states,
-                os.path.join(
-                    self._serialization_dir,
-                    "metric_state_{}_epoch_{}{}.th".format(
-                        phase, epoch, best_str)))
-        log.info("Saved files to %s", self._serialization_dir)
-
-        if phase != "eval" and new_best_macro:
-            self._unmark_previous_best(phase, epoch)
-
-        if not self._keep_all_checkpoints:
-            self._delete_old_checkpoints(phase, epoch)
+            files.append(("metric_state", metric_states))
+
+        def _after_write():
+            # Only touch older checkpoints once the new one is complete.
+            if phase != "eval" and new_best_macro:
+                self._unmark_previous_best(phase, epoch)
+
+            if not self._keep_all_checkpoints:
+                self._delete_old_checkpoints(phase, epoch)
+
+        # State is copied to CPU here; the write itself may happen in the background.
+        self._checkpoint_writer.save(self._serialization_dir, suffix, files,
+                                     callback=_after_write, update=update)
+        log.info("Saving checkpoint %s to %s", suffix, self._serialization_dir)
+
+    def _get_task_states(self):
+        ''' Per-task training progress and optimizer state, as saved in checkpoints. '''
+        task_states = {}
+        for task_name, task_info in self._task_infos.items():
+            task_states[task_name] = {}
+            task_states[task_name]['total_batches_trained'] = task_info['total_batches_trained']
+            task_states[task_name]['stopped'] = task_info['stopped']
+            if self._g_optimizer is None:
+                task_states[task_name]['optimizer'] = task_info['optimizer'].state_dict()
+                sched_params = {}
+                task_states[task_name]['scheduler'] = sched_params
+        task_states['global'] = {}
+        task_states['global']['optimizer'] = self._g_optimizer.state_dict() if \
+            self._g_optimizer is not None else None
+        if self._g_scheduler is not None:
+            sched_params = {}
+            task_states['global']['scheduler'] = sched_params
+        else:
+            task_states['global']['scheduler'] = None
+        return task_states
+
+    def _apply_val_decisions(self, task_states):
+        ''' Update task_states, taken when a background validation was submitted, with the
+        learning rates and stopped tasks that resulted from that validation, as a synchronous
+        validation would have saved them. Nothing else has been applied since the submission,
+        since the results of one validation are applied before the next is submitted. '''
+        def _copy_lrs(optimizer, optimizer_state):
+            for group, group_state in zip(optimizer.param_groups, optimizer_state['param_groups']):
+                group_state['lr'] = group['lr']
+
+        for task_name, task_info in self._task_infos.items():
+            task_states[task_name]['stopped'] = task_info['stopped']
+            if 'optimizer' in task_states[task_name]:
+                _copy_lrs(task_info['optimizer'], task_states[task_name]['optimizer'])
+        if task_states['global']['optimizer'] is not None:
+            _copy_lrs(self._g_optimizer, task_states['global']['optimizer'])
 
     def _find_last_checkpoint_suffix(self, search_phases_in_priority_order=['main']):
         """
@@ -861,13 +1271,25 @@ class SamplingMultiTaskTrainer:
                 os.path.join(
                     self._serialization_dir,
                     "model_state_{}_*".format(current_search_phase)))
-            for x in candidate_files:
-                epoch = int(x.split("model_state_{}_epoch_".format(
+            suffixes = [x.split("model_state_")[-1] for x in candidate_files]
+            # Only consider complete checkpoints. Runs from before checkpoints had
+            # manifests have none at all; fall back to trusting every file for those.
+            if any(checkpoint.has_manifest(self._serialization_dir, x) for x in suffixes):
+                complete = [x for x in suffixes
+                            if checkpoint.is_complete(self._serialization_dir, x)]
+                for x in set(suffixes) - set(complete):
+                    log.warning("Ignoring incomplete checkpoint %s", x)
+                suffixes = complete
+            elif suffixes:
+                log.warning("No checkpoint manifests found in %s; can't verify that "
+                            "checkpoints are complete.", self._serialization_dir)
+            for x in suffixes:
+                epoch = int(x.split("{}_epoch_".format(
                     current_search_phase))[-1].split(".")[0])
                 if epoch >= max_epoch:
                     max_epoch = epoch
                     to_return = x
-            return to_return.split("model_state_")[-1]
+            return to_return
 
     def _restore_checkpoint(self, search_phases_in_priority_order=['main']):
         """
@@ -898,7 +1320,7 @@ class SamplingMultiTaskTrainer:
         metric_state_path = os.path.join(self._serialization_dir,
                                          "metric_state_{}".format(suffix_to_load))
 
-        model_state = torch.load(model_path, map_location=device_mapping(self._cuda_device))
+        model_state = checkpoint.load_state_dict(model_path, self._cuda_device)
 
         for name, param in self._model.named_parameters():
             if param.requires_grad and name not in model_state:
@@ -975,6 +1397,17 @@ class SamplingMultiTaskTrainer:
         val_data_limit = params.pop("val_data_limit", 5000)
         dec_val_scale = params.pop("dec_val_scale", 100)
         training_data_fraction = params.pop("training_data_fraction", 1.0)
+        profile_sync_cuda = params.pop("profile_sync_cuda", False)
+        profile_trace_start = params.pop("profile_trace_start", -1)
+        profile_trace_steps = params.pop("profile_trace_steps", 20)
+        async_checkpoint = params.pop("async_checkpoint", True)
+        checkpoint_format = params.pop("checkpoint_format", "indexed")
+        accumulation_steps = params.pop("accumulation_steps", 1)
+        precision = params.pop("precision", "fp32")
+        async_validation_threads = params.pop("async_validation_threads", 0)
+        val_early_exit = params.pop("val_early_exit", False)
+        val_early_exit_ci = params.pop("val_early_exit_ci", 0.005)
+        val_early_exit_min_examples = params.pop("val_early_exit_min_examples", 500)
 
         params.assert_empty(cls.__name__)
         return SamplingMultiTaskTrainer(model, patience=patience,
@@ -986,4 +1419,15 @@ class SamplingMultiTaskTrainer:
                                         keep_all_checkpoints=keep_all_checkpoints,
                                         val_data_limit=val_data_limit,
                                         dec_val_scale=dec_val_scale,
-                                        training_data_fraction=training_data_fraction)
+                                        training_data_fraction=training_data_fraction,
+                                        profile_sync_cuda=profile_sync_cuda,
+                                        profile_trace_start=profile_trace_start,
+                                        profile_trace_steps=profile_trace_steps,
+                                        async_checkpoint=async_checkpoint,
+                                        checkpoint_format=checkpoint_format,
+                                        accumulation_steps=accumulation_steps,
+                                        precision=precision,
+                                        async_validation_threads=async_validation_threads,
+                                        val_early_exit=val_early_exit,
+                                        val_early_exit_ci=val_early_exit_ci,
+                                        val_early_exit_min_examples=val_early_exit_min_examples)
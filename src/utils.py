@@ -11,7 +11,6 @@ import logging
 import codecs
 import time
 
-from nltk.tokenize.moses import MosesTokenizer, MosesDetokenizer
 
 import numpy as np
 import torch
@@ -25,16 +24,21 @@ from allennlp.nn.util import last_dim_softmax
 from allennlp.modules.seq2seq_encoders.seq2seq_encoder import Seq2SeqEncoder
 from allennlp.common.params import Params
 
+from . import checkpoint
+from .lazy import lazy_import, lazy_object
+
+_moses = lazy_import("nltk.tokenize.moses")  # NLTK is slow to import
+
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-TOKENIZER = MosesTokenizer()
+TOKENIZER = lazy_object(lambda: _moses.MosesTokenizer())
 SOS_TOK, EOS_TOK = "<SOS>", "<EOS>"
 
 # Note: using the full 'detokenize()' method is not recommended, since it does
 # a poor job of adding correct whitespace. Use unescape_xml() only.
-_MOSES_DETOKENIZER = MosesDetokenizer()
+_MOSES_DETOKENIZER = lazy_object(lambda: _moses.MosesDetokenizer())
 
 
 def copy_iter(elems):
@@ -52,7 +56,8 @@ def wrap_singleton_string(item: Union[Sequence, str]):
     return item
 
 
-def load_model_state(model, state_path, gpu_id, skip_task_models=[], strict=True):
+def load_model_state(model, state_path, gpu_id, skip_task_models=[], strict=True,
+                     prefixes=None):
     ''' Helper function to load a model state
 
     Parameters
@@ -65,17 +70,33 @@ def load_model_state(model, state_path, gpu_id, skip_task_models=[], strict=True
         doubt that this matters.
     strict: Whether we should fail if any parameters aren't found in the checkpoint. If false,
         there is a risk of leaving some parameters in their randomly initialized state.
+    prefixes: If set, only load parameters whose names start with one of these prefixes,
+        e.g. ["sts-b_mdl."]. For indexed checkpoints, nothing else is read from disk.
     '''
-    model_state = torch.load(state_path, map_location=device_mapping(gpu_id))
-
     assert_for_log(
         not (
             skip_task_models and strict),
         "Can't skip task models while also strictly loading task models. Something is wrong.")
 
+    def _selected(name):
+        return prefixes is None or any(name.startswith(prefix) for prefix in prefixes)
+
+    skip_patterns = ["%s_mdl" % task for task in skip_task_models]
+
+    def _keep(name):
+        return _selected(name) and not any(pattern in name for pattern in skip_patterns)
+
+    for task, pattern in zip(skip_task_models, skip_patterns):
+        if any(pattern in name and _selected(name) for name in model.state_dict()):
+            logging.info("Skipping task-specific parameters for task: %s" % task)
+        else:
+            logging.info("Found no task-specific parameters to skip for task: %s" % task)
+
+    model_state = checkpoint.load_state_dict(state_path, gpu_id, keep=_keep)
+
     for name, param in model.named_parameters():
         # Make sure no trainable params are missing.
-        if param.requires_grad:
+        if param.requires_grad and _selected(name):
             if strict:
                 assert_for_log(name in model_state,
                                "In strict mode and failed to find at least one parameter: " + name)
@@ -84,18 +105,6 @@ def load_model_state(model, state_path, gpu_id, skip_task_models=[], strict=True
                 logging.error("Parameter missing from checkpoint: " + name)
                 logging.error("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
 
-    if skip_task_models:
-        keys_to_skip = []
-        for task in skip_task_models:
-            new_keys_to_skip = [key for key in model_state if "%s_mdl" % task in key]
-            if new_keys_to_skip:
-                logging.info("Skipping task-specific parameters for task: %s" % task)
-                keys_to_skip += new_keys_to_skip
-            else:
-                logging.info("Found no task-specific parameters to skip for task: %s" % task)
-        for key in keys_to_skip:
-            del model_state[key]
-
     model.load_state_dict(model_state, strict=False)
     logging.info("Loaded model state from %s", state_path)
 
@@ -965,6 +974,9 @@ class MaskedMultiHeadSelfAttention(Seq2SeqEncoder):
     attention_dropout_prob : ``float``, optional (default = 0.1).
         The dropout probability applied to the normalised attention
         distributions.
+    chunk_size : ``int``, optional (default = 512).
+        Attend from at most this many positions at once, bounding the memory
+        used for attention scores on long sequences. 0 for no limit.
     """
 
     def __init__(self,
@@ -973,7 +985,8 @@ class MaskedMultiHeadSelfAttention(Seq2SeqEncoder):
                  attention_dim: int,
                  values_dim: int,
                  output_projection_dim: int = None,
-                 attention_dropout_prob: float = 0.1) -> None:
+                 attention_dropout_prob: float = 0.1,
+                 chunk_size: int = 512) -> None:
         super(MaskedMultiHeadSelfAttention, self).__init__()
 
         self._num_heads = num_heads
@@ -990,11 +1003,14 @@ class MaskedMultiHeadSelfAttention(Seq2SeqEncoder):
         self._output_projection = Linear(num_heads * values_dim,
                                          self._output_dim)
         self._attention_dropout = Dropout(attention_dropout_prob)
+        self._chunk_size = chunk_size
+        # device -> causal mask; see _get_causal_mask.
+        self._causal_masks = {}
 
         self.reset_parameters()
 
     def reset_parameters(self) -> None:
-        # Because we are doing so many torch.bmm calls, which is fast but unstable,
+        # Because we are doing so many matrix multiplications, which are fast but unstable,
         # it is critically important to intitialise the parameters correctly such
         # that these matrix multiplications are well conditioned initially.
         # Without this initialisation, this (non-deterministically) produces
@@ -1009,6 +1025,17 @@ class MaskedMultiHeadSelfAttention(Seq2SeqEncoder):
     def get_output_dim(self):
         return self._output_dim
 
+    def _get_causal_mask(self, timesteps: int, device) -> torch.Tensor:
+        ''' (timesteps, timesteps) mask, set above the diagonal (i.e. for future
+        positions). Masks are cached per device, and grown to the longest
+        sequence seen; the top-left corner of a causal mask is a causal mask. '''
+        cached = self._causal_masks.get(str(device))
+        if cached is None or cached.size(0) < timesteps:
+            future = torch.ones(timesteps, timesteps, device=device).triu(1)
+            cached = future.bool() if hasattr(future, 'bool') else future.byte()
+            self._causal_masks[str(device)] = cached
+        return cached[:timesteps, :timesteps]
+
     def forward(self,  # pylint: disable=arguments-differ
                 inputs: torch.Tensor,
                 mask: torch.LongTensor = None) -> torch.FloatTensor:
@@ -1026,62 +1053,56 @@ class MaskedMultiHeadSelfAttention(Seq2SeqEncoder):
         where output_projection_dim = input_dim by default.
         """
         num_heads = self._num_heads
+        attention_dim, values_dim = self._attention_dim, self._values_dim
 
         batch_size, timesteps, hidden_dim = inputs.size()
         if mask is None:
             mask = Variable(inputs.data.new(batch_size, timesteps).fill_(1.0))
 
-        # Treat the queries, keys and values each as a ``num_heads`` size batch.
-        # shape (num_heads, batch_size * timesteps, hidden_dim)
-        inputs_per_head = inputs.repeat(num_heads, 1, 1).view(num_heads,
-                                                              batch_size * timesteps,
-                                                              hidden_dim)
-        # Do the projections for all the heads at once.
-        # Then reshape the result as though it had a
-        # (num_heads * batch_size) sized batch.
-        queries_per_head = torch.bmm(inputs_per_head, self._query_projections)
-        # shape (num_heads * batch_size, timesteps, attention_dim)
-        queries_per_head = queries_per_head.view(num_heads * batch_size,
-                                                 timesteps,
-                                                 self._attention_dim)
-
-        keys_per_head = torch.bmm(inputs_per_head, self._key_projections)
-        # shape (num_heads * batch_size, timesteps, attention_dim)
-        keys_per_head = keys_per_head.view(num_heads * batch_size,
-                                           timesteps,
-                                           self._attention_dim)
-
-        values_per_head = torch.bmm(inputs_per_head, self._value_projections)
-        # shape (num_heads * batch_size, timesteps, attention_dim)
-        values_per_head = values_per_head.view(num_heads * batch_size, timesteps, self._values_dim)
-
-        # shape (num_heads * batch_size, timesteps, timesteps)
-        scaled_similarities = torch.bmm(
-            queries_per_head, keys_per_head.transpose(
-                1, 2)) / self._scale
-
-        # Masking should go here
-        causality_mask = subsequent_mask(timesteps).cuda()
-        masked_scaled_similarities = scaled_similarities.masked_fill(causality_mask == 0, -1e9)
-
-        # shape (num_heads * batch_size, timesteps, timesteps)
-        # Normalise the distributions, using the same mask for all heads.
-        attention = last_dim_softmax(masked_scaled_similarities, mask.repeat(num_heads, 1))
-        attention = self._attention_dropout(attention)
-        # This is doing the following batch-wise matrix multiplication:
-        # (num_heads * batch_size, timesteps, timesteps) *
-        # (num_heads * batch_size, timesteps, values_dim)
-        # which is equivalent to a weighted sum of the values with respect to
-        # the attention distributions for each element in the num_heads * batch_size
-        # dimension.
-        # shape (num_heads * batch_size, timesteps, values_dim)
-        outputs = torch.bmm(attention, values_per_head)
-
-        # Reshape back to original shape (batch_size, timesteps, num_heads * values_dim)
-        # Note that we _cannot_ use a reshape here, because this tensor was created
-        # with num_heads being the first dimension, so reshaping naively would not
-        # throw an error, but give an incorrect result.
-        outputs = torch.cat(torch.split(outputs, batch_size, dim=0), dim=-1)
+        # Do the query, key and value projections for all the heads in one matmul.
+        # shape (input_dim, num_heads * (2 * attention_dim + values_dim))
+        qkv_weights = torch.cat([self._query_projections,
+                                 self._key_projections,
+                                 self._value_projections], dim=2)
+        qkv_weights = qkv_weights.transpose(0, 1).contiguous().view(hidden_dim, -1)
+        # shape (batch_size, timesteps, num_heads, 2 * attention_dim + values_dim)
+        qkv = torch.matmul(inputs, qkv_weights).view(batch_size, timesteps, num_heads, -1)
+        # Split and move heads to the second dimension; these are views, not copies.
+        # shape (batch_size, num_heads, timesteps, attention_dim or values_dim)
+        queries, keys, values = [x.transpose(1, 2) for x in
+                                 torch.split(qkv, [attention_dim, attention_dim, values_dim],
+                                             dim=-1)]
+
+        # shape (batch_size, 1, 1, timesteps), broadcast over heads and queries.
+        padding_mask = (mask == 0).view(batch_size, 1, 1, timesteps)
+        causal_mask = self._get_causal_mask(timesteps, inputs.device)
+
+        # Attend in blocks of queries, so that at most
+        # (batch_size, num_heads, chunk_size, timesteps) scores exist at once.
+        # Queries can't see past the end of their block, so the remaining keys
+        # are skipped.
+        chunk_size = self._chunk_size or timesteps
+        chunk_outputs = []
+        for start in range(0, timesteps, chunk_size):
+            end = min(start + chunk_size, timesteps)
+            # shape (batch_size, num_heads, end - start, end)
+            scaled_similarities = torch.matmul(queries[:, :, start:end],
+                                               keys[:, :, :end].transpose(-1, -2)) / self._scale
+            fill_value = (torch.finfo(scaled_similarities.dtype).min
+                          if hasattr(torch, 'finfo') else -1e9)
+            scaled_similarities = scaled_similarities.masked_fill(
+                causal_mask[start:end, :end] | padding_mask[..., :end], fill_value)
+            attention = torch.nn.functional.softmax(scaled_similarities, dim=-1)
+            attention = self._attention_dropout(attention)
+            # shape (batch_size, num_heads, end - start, values_dim)
+            chunk_outputs.append(torch.matmul(attention, values[:, :, :end]))
+        outputs = chunk_outputs[0] if len(chunk_outputs) == 1 else torch.cat(chunk_outputs, dim=2)
+        # As with masked_softmax, sequences with no unmasked positions attend to nothing.
+        outputs = outputs * (mask.sum(dim=1) > 0).type_as(outputs).view(batch_size, 1, 1, 1)
+
+        # Reshape to (batch_size, timesteps, num_heads * values_dim), with heads
+        # in the same order as the projection weights.
+        outputs = outputs.transpose(1, 2).contiguous().view(batch_size, timesteps, -1)
 
         # Project back to original input size.
         # shape (batch_size, timesteps, input_size)
@@ -1096,13 +1117,15 @@ class MaskedMultiHeadSelfAttention(Seq2SeqEncoder):
         values_dim = params.pop_int('values_dim')
         output_projection_dim = params.pop_int('output_projection_dim', None)
         attention_dropout_prob = params.pop_float('attention_dropout_prob', 0.1)
+        chunk_size = params.pop_int('chunk_size', 512)
         params.assert_empty(cls.__name__)
         return cls(num_heads=num_heads,
                    input_dim=input_dim,
                    attention_dim=attention_dim,
                    values_dim=values_dim,
                    output_projection_dim=output_projection_dim,
-                   attention_dropout_prob=attention_dropout_prob)
+                   attention_dropout_prob=attention_dropout_prob,
+                   chunk_size=chunk_size)
 
 
 def assert_for_log(condition, error_message):
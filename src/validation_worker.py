@@ -0,0 +1,114 @@
+""" Mid-training validation in a background process.
+
+ValidationWorker forks a child process that holds its own copy of the model
+and tasks. At each validation, the trainer submits a CPU snapshot of the
+trainable weights; the child loads it, runs the usual validation loop
+(SamplingMultiTaskTrainer._compute_val_metrics) and sends back the metrics,
+while the parent keeps training. Results come back in submission order.
+
+CPU only: the child is forked, and CUDA can't be used across a fork.
+"""
+import queue
+import traceback
+import collections
+import logging as log
+
+import torch
+import torch.multiprocessing as mp
+
+
+def _worker_loop(trainer, tasks_by_name, batch_size, n_threads, requests, results):
+    torch.set_num_threads(n_threads)
+    model = trainer._model
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        epoch, task_names, model_state, val_bests = request
+        try:
+            # model_state has only trainable params; the rest are unchanged since the fork.
+            model.load_state_dict(model_state, strict=False)
+            del model_state
+            metrics = trainer._compute_val_metrics([tasks_by_name[name] for name in task_names],
+                                                   batch_size, val_bests=val_bests)
+            results.put((epoch, metrics, None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+
+class ValidationWorker(object):
+    ''' Runs trainer's validation in a forked process, one request at a time.
+
+    Usage:
+        worker = ValidationWorker(trainer, tasks, batch_size, n_threads=4)
+        worker.submit(epoch, n_pass, val_tasks, tr_metrics, snapshot, task_states=task_states)
+        ...
+        for epoch, n_pass, val_tasks, tr_metrics, val_metrics, snapshot, task_states in \
+                worker.poll():
+            ...
+        worker.close()
+
+    Create it after the trainer is set up for training (so that the child gets
+    the validation data and task infos), and close it before training ends.
+    '''
+
+    def __init__(self, trainer, tasks, batch_size, n_threads=1):
+        ctx = mp.get_context('fork')
+        self._requests = ctx.Queue()
+        self._results = ctx.Queue()
+        tasks_by_name = {task.name: task for task in tasks}
+        self._process = ctx.Process(target=_worker_loop,
+                                    args=(trainer, tasks_by_name, batch_size, n_threads,
+                                          self._requests, self._results),
+                                    daemon=True)
+        self._process.start()
+        # epoch -> (n_pass, tasks, tr_metrics, model_state, task_states), in submission order.
+        self._pending = collections.OrderedDict()
+        log.info("Started background validation process (pid %d, %d threads)",
+                 self._process.pid, n_threads)
+
+    @property
+    def n_pending(self):
+        return len(self._pending)
+
+    def submit(self, epoch, n_pass, tasks, tr_metrics, model_state, val_bests=None,
+               task_states=None):
+        ''' Start validating model_state (a CPU snapshot, which must not be modified
+        afterwards) on tasks. val_bests are the current best validation results, for early
+        exit; the child's own metric history is from when it was forked. task_states (also a
+        snapshot) is the trainer's state at the same step, kept to be returned with the
+        results. '''
+        assert epoch not in self._pending, "Already validating epoch %d" % epoch
+        self._pending[epoch] = (n_pass, tasks, tr_metrics, model_state, task_states)
+        self._requests.put((epoch, [task.name for task in tasks], model_state, val_bests))
+
+    def poll(self, wait=False):
+        ''' Collect finished validations, as a list of
+        (epoch, n_pass, tasks, tr_metrics, val_metrics, model_state, task_states).
+
+        If wait is set, block until all submitted validations have finished. '''
+        finished = []
+        while self._pending:
+            try:
+                epoch, metrics, error = self._results.get(block=wait, timeout=10 if wait else None)
+            except queue.Empty:
+                if not wait:
+                    break
+                if not self._process.is_alive():
+                    raise RuntimeError("Validation process exited with code %s" %
+                                       str(self._process.exitcode))
+                continue
+            if error is not None:
+                raise RuntimeError("Validation failed for epoch %d:\n%s" % (epoch, error))
+            n_pass, tasks, tr_metrics, model_state, task_states = self._pending.pop(epoch)
+            finished.append((epoch, n_pass, tasks, tr_metrics, metrics, model_state, task_states))
+        return finished
+
+    def close(self):
+        ''' Stop the worker process. Results not yet collected are dropped. '''
+        if self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout=60)
+            if self._process.is_alive():
+                self._process.terminate()
+        self._pending.clear()
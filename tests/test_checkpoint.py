@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+import collections
+
+import torch
+
+from src import checkpoint
+
+
+def _state_dict():
+    state = collections.OrderedDict()
+    state['sent_encoder.weight'] = torch.randn(7, 5)
+    state['sent_encoder.bias'] = torch.randn(5)
+    state['sts-b_mdl.pooler.weight'] = torch.randn(3, 4)
+    state['rte_mdl.classifier.weight'] = torch.randn(2, 3)
+    state['rte_mdl.classifier.bias'] = torch.randn(2)
+    state['step'] = torch.tensor(3, dtype=torch.int64)  # 0-dim
+    state['mask'] = torch.tensor([[1, 0], [0, 1]], dtype=torch.uint8)
+    return state
+
+
+class TestIndexedCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "model_state_eval_best.th")
+        self.state = _state_dict()
+        checkpoint.save_indexed(self.state, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertStatesEqual(self, expected, actual):
+        self.assertEqual(list(expected.keys()), list(actual.keys()))
+        for name, tensor in expected.items():
+            self.assertEqual(tensor.dtype, actual[name].dtype, name)
+            self.assertEqual(tensor.shape, actual[name].shape, name)
+            self.assertTrue(torch.equal(tensor, actual[name]), name)
+
+    def test_round_trip(self):
+        self.assertTrue(checkpoint.is_indexed(self.path))
+        self.assertStatesEqual(self.state, checkpoint.load_indexed(self.path))
+        self.assertStatesEqual(self.state, checkpoint.load_state_dict(self.path))
+
+    def test_tensors_are_aligned(self):
+        with open(self.path, 'rb') as fd:
+            index, _ = checkpoint._read_index(fd)
+        for entry in index.values():
+            self.assertEqual(entry['offset'] % checkpoint._ALIGN, 0)
+
+    def test_prefix_load(self):
+        loaded = checkpoint.load_state_dict(self.path,
+                                            keep=lambda name: name.startswith("rte_mdl."))
+        expected = collections.OrderedDict((k, v) for k, v in self.state.items()
+                                           if k.startswith("rte_mdl."))
+        self.assertStatesEqual(expected, loaded)
+        self.assertEqual(len(checkpoint.load_indexed(self.path, keep=lambda name: False)), 0)
+
+    def test_torch_save_fallback(self):
+        path = os.path.join(self.tmp_dir, "model_state_main_epoch_1.th")
+        checkpoint.atomic_torch_save(self.state, path)
+        self.assertFalse(checkpoint.is_indexed(path))
+        loaded = checkpoint.load_state_dict(path, keep=lambda name: name.startswith("sts-b_mdl."))
+        self.assertEqual(list(loaded.keys()), ['sts-b_mdl.pooler.weight'])
+
+    def test_update_in_place(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as fd:
+            before = fd.read()
+            index, _ = checkpoint._read_index(fd)
+        update = collections.OrderedDict(
+            (k, torch.randn(*v.shape)) for k, v in self.state.items() if k.startswith("rte_mdl."))
+        checkpoint.update_indexed(update, self.path)
+
+        # Same shapes and dtypes: nothing moves, and the file keeps its size.
+        self.assertEqual(size, os.path.getsize(self.path))
+        with open(self.path, 'rb') as fd:
+            after = fd.read()
+        for name, entry in index.items():
+            start, end = entry['offset'], entry['offset'] + entry['nbytes']
+            if name.startswith("rte_mdl."):
+                self.assertNotEqual(before[start:end], after[start:end], name)
+            else:
+                self.assertEqual(before[start:end], after[start:end], name)
+        expected = collections.OrderedDict(self.state)
+        expected.update(update)
+        self.assertStatesEqual(expected, checkpoint.load_indexed(self.path))
+
+    def test_update_appends_resized(self):
+        with open(self.path, 'rb') as fd:
+            before = fd.read()
+            index, data_end = checkpoint._read_index(fd)
+        update = {'rte_mdl.classifier.weight': torch.randn(4, 3),
+                  'rte_mdl.new.weight': torch.randn(2)}
+        checkpoint.update_indexed(update, self.path)
+        with open(self.path, 'rb') as fd:
+            after = fd.read()
+        # The old tensor data is untouched; the new tensors go after it.
+        self.assertEqual(before[:data_end], after[:data_end])
+        expected = collections.OrderedDict(self.state)
+        expected.update(update)
+        self.assertStatesEqual(expected, checkpoint.load_indexed(self.path))
+
+    def test_truncated_file(self):
+        with open(self.path, 'r+b') as fd:
+            fd.truncate(os.path.getsize(self.path) // 2)
+        self.assertFalse(checkpoint.is_indexed(self.path))
+        with self.assertRaises(AssertionError):
+            checkpoint.load_indexed(self.path)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = [("model_state", _state_dict()), ("training_state", {'epoch': 2})]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_complete(self):
+        self.assertFalse(checkpoint.has_manifest(self.tmp_dir, "eval_best.th"))
+        checkpoint.write_checkpoint(self.tmp_dir, "eval_best.th", self.files,
+                                    indexed_prefixes=("model_state",))
+        self.assertTrue(checkpoint.is_complete(self.tmp_dir, "eval_best.th"))
+        path = checkpoint.get_path(self.tmp_dir, "model_state", "eval_best.th")
+        self.assertTrue(checkpoint.is_indexed(path))
+        # Updating in place keeps the checkpoint complete.
+        checkpoint.write_checkpoint(self.tmp_dir, "eval_best.th", self.files[:1],
+                                    indexed_prefixes=("model_state",), update=True)
+        self.assertTrue(checkpoint.is_complete(self.tmp_dir, "eval_best.th"))
+
+    def test_truncated_file(self):
+        checkpoint.write_checkpoint(self.tmp_dir, "eval_best.th", self.files,
+                                    indexed_prefixes=("model_state",))
+        path = checkpoint.get_path(self.tmp_dir, "model_state", "eval_best.th")
+        with open(path, 'r+b') as fd:
+            fd.truncate(os.path.getsize(path) - 1)
+        self.assertFalse(checkpoint.is_complete(self.tmp_dir, "eval_best.th"))
+
+    def test_in_progress(self):
+        checkpoint.write_checkpoint(self.tmp_dir, "eval_best.th", self.files,
+                                    indexed_prefixes=("model_state",))
+        # As left by a write that crashed after marking the checkpoint in progress.
+        checkpoint._atomic_write_json({'files': {}, 'in_progress': True, 'time': 0},
+                                      checkpoint.get_manifest_path(self.tmp_dir, "eval_best.th"))
+        self.assertTrue(checkpoint.has_manifest(self.tmp_dir, "eval_best.th"))
+        self.assertFalse(checkpoint.is_complete(self.tmp_dir, "eval_best.th"))
+
+
+if __name__ == '__main__':
+    unittest.main()
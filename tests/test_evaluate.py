@@ -0,0 +1,92 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src import evaluate
+from src import prediction_sink
+from src.prediction_sink import PredictionSink
+
+
+class _EdgeTask(object):
+    ''' The parts of an EdgeProbingTask that _write_edge_preds uses. '''
+    name = "edges-test"
+
+    def __init__(self, records):
+        self._records = records
+
+    def get_split_text(self, split):
+        return iter(self._records)
+
+    @staticmethod
+    def merge_preds(record, preds):
+        return dict(record, preds=preds)
+
+
+class TestWritePreds(unittest.TestCase):
+
+    def setUp(self):
+        self.pred_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.pred_dir)
+
+    def _read_tsv(self, name):
+        with open(os.path.join(self.pred_dir, name)) as fd:
+            return list(csv.DictReader(fd, delimiter="\t"))
+
+    def test_mnli_test_keeps_insertion_order(self):
+        # Matched, mismatched and diagnostic each start at idx 0; spilled in several runs.
+        sizes = [9796, 9847, 1104]
+        with mock.patch.object(prediction_sink, 'MAX_ROWS_IN_MEMORY', 4000):
+            sink = PredictionSink()
+            for split_id, size in enumerate(sizes):
+                for start in range(0, size, 500):
+                    idxs = list(range(start, min(start + 500, size)))
+                    sink.append({'idx': idxs, 'preds': [(i + split_id) % 3 for i in idxs]})
+        self.assertGreater(len(sink._runs), 1)
+        evaluate._write_glue_preds('mnli', sink, self.pred_dir, 'test')
+
+        pred_map = {0: 'neutral', 1: 'entailment', 2: 'contradiction'}
+        for split_id, (name, size) in enumerate(zip(['mnli-m', 'mnli-mm', 'diagnostic'], sizes)):
+            rows = self._read_tsv("%s_test.tsv" % name)
+            self.assertEqual([int(row['index']) for row in rows], list(range(size)), name)
+            self.assertEqual([row['prediction'] for row in rows],
+                             [pred_map[(i + split_id) % 3] for i in range(size)], name)
+
+    def _edge_sink(self, n_rows):
+        sink = PredictionSink(max_rows_in_memory=4)
+        # Out of order, so that the rows are merged by idx.
+        for idxs in [[3, 1], [0, 2], [5, 4], [6]]:
+            idxs = [i for i in idxs if i < n_rows]
+            sink.append({'idx': idxs, 'preds': [np.full(2, i / 10) for i in idxs]})
+        return sink
+
+    def test_edge_preds(self):
+        records = [{'text': "line %d" % i} for i in range(7)]
+        evaluate._write_edge_preds(_EdgeTask(records), self._edge_sink(7), self.pred_dir, 'val')
+        with open(os.path.join(self.pred_dir, "edges-test_val.json")) as fd:
+            written = [json.loads(line) for line in fd]
+        self.assertEqual(written, [dict(record, preds={'proba': [i / 10, i / 10]})
+                                   for i, record in enumerate(records)])
+
+    def test_edge_preds_missing_prediction(self):
+        records = [{'text': "line %d" % i} for i in range(7)]
+        with self.assertRaisesRegex(AssertionError, "missing prediction for line 5"):
+            evaluate._write_edge_preds(_EdgeTask(records), self._edge_sink(5),
+                                       self.pred_dir, 'val')
+
+    def test_edge_preds_extra_prediction(self):
+        records = [{'text': "line %d" % i} for i in range(5)]
+        with self.assertRaisesRegex(AssertionError, "line 5, past the end of the input"):
+            evaluate._write_edge_preds(_EdgeTask(records), self._edge_sink(7),
+                                       self.pred_dir, 'val')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from benchmarks import import_benchmark
+
+
+class TestImportBudget(unittest.TestCase):
+
+    def test_main_import_budget(self):
+        record, = import_benchmark.time_imports(['main'])
+        self.assertLessEqual(record['seconds'], import_benchmark.MAIN_IMPORT_BUDGET,
+                             "Importing main is over budget; slowest imports: %s" %
+                             record.get('slowest_imports'))
+
+    def test_slowest_imports(self):
+        importtime_output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 |     json.decoder",
+            "import time:       200 |        300 |   json",
+            "import time:      1000 |       1000 |   torch",
+            "import time:        50 |       1350 | main",
+        ])
+        self.assertEqual(import_benchmark.slowest_imports(importtime_output, 'main'),
+                         [('torch', 0.001), ('json', 0.0003)])
+
+
+if __name__ == '__main__':
+    unittest.main()
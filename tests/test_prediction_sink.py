@@ -0,0 +1,107 @@
+import random
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src import prediction_sink
+from src.prediction_sink import PredictionSink
+
+
+def _batches(n_batches=20, batch_size=9, seed=0):
+    ''' Batches with idx out of order and repeated, numeric, string and array
+    columns, and a column that only appears partway through. '''
+    rng = random.Random(seed)
+    batches = []
+    for b in range(n_batches):
+        idxs = [rng.randrange(60) for _ in range(batch_size)]
+        batch = {'idx': idxs,
+                 'preds': [rng.random() for _ in idxs],
+                 'labels': [rng.randrange(3) for _ in idxs],
+                 'sent1_str': ["sentence %d.%d" % (b, i) for i in range(batch_size)],
+                 'probs': [np.full(2, b * batch_size + i, dtype=np.float32)
+                           for i in range(batch_size)]}
+        if b >= n_batches // 2:
+            batch['sent2_str'] = ["other %d" % idx for idx in idxs]
+        batches.append(batch)
+    return batches
+
+
+def _in_memory_rows(batches):
+    ''' The rows of batches, in insertion order, as PredictionSink should return them. '''
+    columns = []
+    for batch in batches:
+        columns.extend(name for name in batch if name not in columns)
+    rows = []
+    for batch in batches:
+        n_rows = len(batch['idx'])
+        for i in range(n_rows):
+            rows.append({name: batch[name][i] if name in batch else None for name in columns})
+    return rows
+
+
+class TestPredictionSink(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = _batches()
+        self.expected = _in_memory_rows(self.batches)
+        # Small enough that the rows are spilled in several runs, of several blocks each.
+        with mock.patch.object(prediction_sink, 'MAX_ROWS_IN_MEMORY', 40), \
+                mock.patch.object(prediction_sink, '_BLOCK_ROWS', 16):
+            self.sink = PredictionSink()
+            for batch in self.batches:
+                self.sink.append(batch)
+        self.assertEqual(len(self.sink._runs), len(self.expected) // 45)
+
+    def assertRowsEqual(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for i, (expected_row, row) in enumerate(zip(expected, actual)):
+            self.assertEqual(list(expected_row), list(row), i)
+            for name, value in expected_row.items():
+                if isinstance(value, np.ndarray):
+                    self.assertIsInstance(row[name], np.ndarray)
+                    self.assertEqual(value.dtype, row[name].dtype)
+                    self.assertTrue(np.array_equal(value, row[name]), (i, name))
+                else:
+                    # Python scalars, as the writers expect; not NumPy ones.
+                    self.assertIs(type(value), type(row[name]), (i, name))
+                    self.assertEqual(value, row[name], (i, name))
+
+    def test_sorted_by_idx(self):
+        # A stable sort: rows with the same idx stay in insertion order.
+        expected = sorted(self.expected, key=lambda row: row['idx'])
+        self.assertRowsEqual(expected, list(self.sink.rows()))
+
+    def test_insertion_order(self):
+        self.assertRowsEqual(self.expected, list(self.sink.rows(sort_by_idx=False)))
+
+    def test_in_order_batches(self):
+        batches = _batches()
+        for batch in batches:
+            batch['idx'] = sorted(batch['idx'])
+        batches.sort(key=lambda batch: batch['idx'][0])
+        for i, batch in enumerate(batches):
+            batch['idx'] = [idx + 100 * i for idx in batch['idx']]
+        sink = PredictionSink(max_rows_in_memory=40)
+        for batch in batches:
+            sink.append(batch)
+        expected = _in_memory_rows(batches)
+        self.assertRowsEqual(expected, list(sink.rows()))
+        self.assertRowsEqual(expected, list(sink.rows(sort_by_idx=False)))
+
+    def test_column_dtypes(self):
+        sink = PredictionSink(max_rows_in_memory=10)
+        sink.append({'idx': [2, 1], 'preds': [1, 0]})
+        sink.append({'idx': [0, 3], 'preds': [0.5, 1]})  # ints and floats: float
+        rows = list(sink.rows())
+        self.assertEqual([row['idx'] for row in rows], [0, 1, 2, 3])
+        self.assertEqual([row['preds'] for row in rows], [0.5, 0.0, 1.0, 1.0])
+        self.assertTrue(all(type(row['preds']) is float for row in rows))
+
+    def test_mismatched_lengths(self):
+        with self.assertRaises(AssertionError):
+            self.sink.append({'idx': [0, 1], 'preds': [0.0]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from src import serialize
+
+
+class TestReadRecordsAt(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "val.db")
+        self.examples = [{'idx': i, 'text': "example %d" % i * (i % 3 + 1)} for i in range(50)]
+        serialize.write_records(self.examples, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_record_iterator(self):
+        records = serialize.read_records(self.path, repeatable=True)
+        self.assertIsInstance(records, serialize.RecordIterator)
+        self.assertEqual(records.filename, self.path)
+        sharded = serialize.read_records(self.path, repeatable=True, shard=(0, 2))
+        self.assertNotIsInstance(sharded, serialize.RecordIterator)
+
+    def test_shuffled_order(self):
+        offsets = serialize.record_offsets(self.path, 20)
+        self.assertEqual(len(offsets), 20)
+        random.Random("rte").shuffle(offsets)
+        expected = self.examples[:20]
+        random.Random("rte").shuffle(expected)
+        records = serialize.read_records_at(self.path, offsets, repeatable=True)
+        # The same order on every pass.
+        self.assertEqual(list(records), expected)
+        self.assertEqual(list(records), expected)
+
+    def test_all_offsets(self):
+        offsets = serialize.record_offsets(self.path)
+        self.assertEqual(list(serialize.read_records_at(self.path, offsets)), self.examples)
+
+
+if __name__ == '__main__':
+    unittest.main()